@@ -0,0 +1,45 @@
+# coding: utf-8
+"""Benchmark da ingestão em massa (ingerir_chaves), sem interface.
+
+Uso: python benchmarks/bench_ingestao.py [quantidade] [--undo]
+
+Gera 'quantidade' chaves sintéticas (10% repetidas dentro do próprio lote e uma segunda rodada inteira de
+duplicadas) num banco temporário e mede chaves/s. Com --undo, a ingestão é gravada no journal de desfazer,
+como acontece pela interface. O diretório temporário é apagado no fim.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+import nucleo
+
+def gerar_chaves(quantidade):
+    for i in range(quantidade):
+        n = i if i % 10 else i // 2  # ~10% de repetidas dentro do lote
+        yield f"BENCH-{n:08d}-{(n * 7919) % 99991:05d}"
+
+def medir(rotulo, quantidade, desfazer):
+    inicio = time.perf_counter(); _, adicionadas, duplicadas, _ = nucleo.ingerir_chaves(gerar_chaves(quantidade), "Sem Categoria", desfazer=desfazer)
+    duracao = time.perf_counter() - inicio
+    print(f"{rotulo:<22} {quantidade:>10,} chaves  {duracao:7.2f} s  {quantidade / duracao:>10,.0f} chaves/s  (+{adicionadas:,} / {duplicadas:,} dup)")
+
+def main_bench():
+    parser = argparse.ArgumentParser(description="Benchmark da ingestão em massa (ingerir_chaves), sem interface.")
+    parser.add_argument("quantidade", nargs="?", type=int, default=1_000_000, help="chaves por rodada (padrão: 1000000)")
+    parser.add_argument("--undo", action="store_true", help="grava a ingestão no journal de desfazer, como a interface")
+    args = parser.parse_args(); anterior = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix="bench_ingestao_") as pasta:
+        os.chdir(pasta)  # nucleo.DB_NAME é relativo: o banco fica no diretório temporário.
+        try:
+            nucleo.preparar_banco()
+            medir("ingestão inicial", args.quantidade, args.undo)
+            medir("tudo duplicado", args.quantidade, args.undo)
+            print(f"ordem_manual com folga regular: {nucleo.db.consultar_valor(f'SELECT MAX(ordem_manual) - MIN(ordem_manual) = (COUNT(*) - 1) * {nucleo.ORDEM_INTERVALO} FROM chaves') == 1}")
+        finally: nucleo.auditoria.encerrar(); nucleo.db.fechar(); os.chdir(anterior)  # Nada aberto na pasta antes de apagá-la.
+
+if __name__ == "__main__":
+    main_bench()
@@ -0,0 +1,75 @@
+# coding: utf-8
+"""Carga na API HTTP local (servidor_http.ServidorAPI), com clientes locais, sem interface.
+
+Uso: python benchmarks/bench_servidor.py [requisições] [--clientes N] [--trabalhadores N]
+
+Sobe o servidor numa porta livre sobre um banco temporário com estoque sintético e dispara, de N threads cliente com
+conexões keep-alive, uma mistura de 80% GET /estoque/<categoria> e 20% POST /reservas. Mostra requisições/s e
+latências p50/p95/p99 e confere que nenhuma chave foi entregue duas vezes (ids das respostas 201 contra o banco). O
+diretório temporário é apagado no fim.
+"""
+import argparse
+import asyncio
+import http.client
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+import nucleo
+from servidor_http import ServidorAPI
+
+CATEGORIAS = [f"Cat{i:02d}" for i in range(20)]
+
+def preparar(chaves_por_categoria):
+    nucleo.preparar_banco()
+    for cat in CATEGORIAS: nucleo.garantir_categoria(cat); nucleo.ingerir_chaves((f"{cat}-{i:07d}" for i in range(chaves_por_categoria)), cat)
+
+def cliente(porta, requisicoes, id_cliente, latencias, status, vendidas):
+    conn = http.client.HTTPConnection("127.0.0.1", porta, timeout=30)
+    for n in range(requisicoes):
+        cat = CATEGORIAS[(id_cliente + n) % len(CATEGORIAS)]; inicio = time.perf_counter()
+        if n % 5 == 0: conn.request("POST", "/reservas", json.dumps({"categoria": cat, "comprador": f"c{id_cliente}", "quantidade": 1}), {"Content-Type": "application/json"})
+        else: conn.request("GET", f"/estoque/{cat}")
+        resposta = conn.getresponse(); corpo = resposta.read()
+        if resposta.status == 201: vendidas.extend(c["id"] for c in json.loads(corpo)["chaves"])
+        latencias.append(time.perf_counter() - inicio); status[resposta.status] = status.get(resposta.status, 0) + 1
+    conn.close()
+
+def main_bench():
+    parser = argparse.ArgumentParser(description="Carga na API HTTP local (servidor_http.ServidorAPI), sem interface.")
+    parser.add_argument("requisicoes", nargs="?", type=int, default=20_000, help="total de requisições (padrão: 20000)")
+    parser.add_argument("--clientes", type=int, default=32, help="threads cliente com conexão keep-alive (padrão: 32)")
+    parser.add_argument("--trabalhadores", type=int, default=4, help="trabalhadores do servidor (padrão: 4)")
+    args = parser.parse_args(); anterior = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix="bench_servidor_") as pasta:
+        os.chdir(pasta)  # nucleo.DB_NAME é relativo: o banco fica no diretório temporário.
+        try: rodar_carga(args.requisicoes, args.clientes, args.trabalhadores)
+        finally: nucleo.auditoria.encerrar(); nucleo.db.fechar(); os.chdir(anterior)  # Nada aberto na pasta antes de apagá-la.
+
+def rodar_carga(total, clientes, trabalhadores):
+    preparar(10_000)
+    servidor = ServidorAPI(porta=0, trabalhadores=trabalhadores)
+    loop = asyncio.new_event_loop(); pronto = threading.Event()
+    def rodar(): asyncio.set_event_loop(loop); loop.run_until_complete(servidor.iniciar()); pronto.set(); loop.run_forever()
+    threading.Thread(target=rodar, daemon=True).start(); pronto.wait()
+    latencias, status, vendidas = [], {}, []
+    threads = [threading.Thread(target=cliente, args=(servidor.porta, total // clientes, i, latencias, status, vendidas)) for i in range(clientes)]
+    inicio = time.perf_counter()
+    for t in threads: t.start()
+    for t in threads: t.join()
+    duracao = time.perf_counter() - inicio; latencias.sort()
+    p = lambda q: latencias[min(len(latencias) - 1, int(q * len(latencias)))] * 1000
+    print(f"{len(latencias):,} requisições de {clientes} clientes em {duracao:.2f} s: {len(latencias) / duracao:,.0f} req/s")
+    print(f"latência p50 {p(0.50):.1f} ms  p95 {p(0.95):.1f} ms  p99 {p(0.99):.1f} ms  máx {latencias[-1] * 1000:.1f} ms  status {status}")
+    asyncio.run_coroutine_threadsafe(servidor.parar(), loop).result()
+    no_banco = nucleo.db.consultar_valor("SELECT COUNT(*) FROM chaves WHERE vendida = 1")
+    print(f"chaves entregues: {len(vendidas):,} em respostas 201, {len(set(vendidas)):,} distintas, {no_banco:,} vendidas no banco")
+    assert len(vendidas) == len(set(vendidas)) == no_banco, "alguma chave foi entregue a mais de um comprador"
+
+if __name__ == "__main__":
+    main_bench()
@@ -0,0 +1,188 @@
+# coding: utf-8
+"""Suíte de benchmarks reproduzível das operações quentes do app, sem interface.
+
+Uso: python benchmarks/bench_suite.py [--tamanhos 10000,100000,1000000] [--repeticoes 5] [--dir PASTA]
+                                      [--saida resultado.json] [--comparar anterior.json]
+
+Para cada tamanho gera (com semente fixa) um banco sintético com muitas categorias e canais e ~40% das chaves
+vendidas ao longo de dois anos, e mede: importação de CSV, carga do estoque (carregar_dados_do_db), refiltro da
+tabela (atualizar_tabela), modo consulta, mensagem e PDF de entrega, reserva e o relatório do dashboard. Os métodos
+da janela são medidos pelas mesmas peças do nucleo que eles usam (EstoqueCompacto, MotorBusca...).
+Com --dir, os bancos gerados ficam em PASTA/<tamanho>/ e são reaproveitados entre execuções; sem ele, vão para uma pasta
+temporária apagada no fim. O resultado vai para um JSON (versão, commit, Python, SQLite, mediana/mínimo de cada medida)
+e --comparar mostra a razão contra outro JSON.
+"""
+import argparse
+import csv
+import json
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import nullcontext
+from datetime import date, datetime, timedelta
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+import nucleo
+
+SEMENTE = 20240601
+CATEGORIAS = [f"Jogo {i:02d}" for i in range(50)]
+CANAIS = ["Loja", "Mercado Livre", "Shopee", "Amazon", "eBay", "G2A", "Kinguin", "Direto"]
+DIAS_VENDAS = 730
+FRACAO_VENDIDA = 0.4
+
+# --- Banco sintético ---
+def gerar_banco(tamanho):
+    """Preenche o banco do diretório atual com 'tamanho' chaves (determinístico para a mesma semente)."""
+    rnd = random.Random(SEMENTE); hoje = date.today(); nucleo.preparar_banco()
+    with nucleo.db.transacao() as conn:
+        conn.executemany("INSERT OR IGNORE INTO categorias (nome, instrucao_pt, instrucao_en, instrucao_es, custo_padrao_brl, custo_padrao_usd) VALUES (?, ?, ?, ?, ?, ?)",
+                         ((c, f"Ative {c} na plataforma.\nUse a chave abaixo.", f"Redeem {c} on the platform.", f"Active {c} en la plataforma.", rnd.uniform(5, 50), rnd.uniform(1, 10)) for c in CATEGORIAS))
+        conn.executemany("INSERT OR IGNORE INTO canais_venda (nome) VALUES (?)", ((c,) for c in CANAIS))
+        def linhas():
+            for i in range(tamanho):
+                cat = rnd.choice(CATEGORIAS); chave = f"{rnd.getrandbits(64):016X}-{i:08d}"
+                if rnd.random() < FRACAO_VENDIDA:
+                    dia = hoje - timedelta(days=rnd.randrange(DIAS_VENDAS))
+                    yield (chave, cat, 1, f"Cliente {rnd.randrange(tamanho // 10 + 1)}", f"{dia} {rnd.randrange(24):02d}:{rnd.randrange(60):02d}:00", i + 1, round(rnd.uniform(10, 200), 2), round(rnd.uniform(0, 40), 2) if rnd.random() < 0.3 else 0.0, rnd.choice(CANAIS))
+                else: yield (chave, cat, 0, None, None, i + 1, None, None, None)
+        conn.executemany("INSERT INTO chaves (chave, categoria, vendida, comprador, data_venda, ordem_manual, preco_venda_brl, preco_venda_usd, canal_venda) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", linhas())
+    nucleo.db.executar("PRAGMA optimize")
+
+def abrir_banco(pasta, tamanho):
+    """Entra em pasta/<tamanho>/ (nucleo.DB_NAME é relativo) e gera o banco se ainda não existir."""
+    nucleo.db.fechar(); destino = os.path.join(pasta, str(tamanho)); os.makedirs(destino, exist_ok=True); os.chdir(destino)
+    if nucleo.db.consultar_valor("SELECT COUNT(*) FROM sqlite_master WHERE name = 'chaves'") and nucleo.db.consultar_valor("SELECT COUNT(*) FROM chaves") == tamanho:
+        return nucleo.preparar_banco()
+    nucleo.db.fechar()
+    for sufixo in ("", "-wal", "-shm"):
+        if os.path.exists(nucleo.DB_NAME + sufixo): os.remove(nucleo.DB_NAME + sufixo)
+    inicio = time.perf_counter(); gerar_banco(tamanho); print(f"  banco sintético de {tamanho:,} chaves gerado em {time.perf_counter() - inicio:.1f} s")
+    return nucleo.instalar_indice_busca()
+
+# --- Medição ---
+def medir(funcao, repeticoes, preparar=None):
+    """(mediana_ms, min_ms) de 'repeticoes' chamadas; 'preparar' roda antes de cada uma, fora do tempo."""
+    tempos = []
+    for _ in range(repeticoes):
+        if preparar: preparar()
+        inicio = time.perf_counter(); funcao(); tempos.append((time.perf_counter() - inicio) * 1000)
+    return statistics.median(tempos), min(tempos)
+
+def carregar_estoque(motor):
+    """O que GerenciadorChaves.carregar_dados_do_db faz fora do modo consulta."""
+    estoque = nucleo.EstoqueCompacto().carregar(nucleo.db.conexao().execute(f"SELECT {', '.join(nucleo.COLUNAS_ESTOQUE)} FROM chaves ORDER BY id"))
+    motor.carregar_textos(estoque.textos_busca()); return estoque
+
+def filtrar_tabela(estoque, motor, busca="", categoria="Todos", canal="Todos", status="Todos"):
+    """O que GerenciadorChaves.atualizar_tabela faz fora do modo consulta (sem o Treeview)."""
+    ordens = estoque.filtrar(categoria, canal, status, motor.buscar(busca) if busca else None)
+    return ordens, [f"I{id_chave:08X}" for _, id_chave in ordens]
+
+def medir_tamanho(tamanho, pasta, repeticoes, registrar):
+    print(f"\n== {tamanho:,} chaves =="); usar_fts = abrir_banco(pasta, tamanho); rnd = random.Random(SEMENTE)
+    hoje = date.today(); categorias = {r['nome']: dict(r) for r in nucleo.db.consultar("SELECT * FROM categorias")}
+
+    # Importação: CSV novo com 10% de chaves já existentes, num banco à parte (o sintético fica intacto).
+    existentes = [r[0] for r in nucleo.db.consultar("SELECT chave FROM chaves LIMIT ?", (tamanho // 10,))]
+    with open("importar.csv", "w", newline="", encoding="utf-8") as f:
+        escritor = csv.writer(f); escritor.writerows([c] for c in existentes); escritor.writerows([f"IMP-{i:09d}"] for i in range(tamanho - len(existentes)))
+    def banco_importacao():
+        nucleo.db.fechar(); os.makedirs("importacao", exist_ok=True); os.chdir("importacao")
+        for sufixo in ("", "-wal", "-shm"):
+            if os.path.exists(nucleo.DB_NAME + sufixo): os.remove(nucleo.DB_NAME + sufixo)
+        nucleo.preparar_banco(); nucleo.ingerir_chaves(existentes, "Jogo 00")
+    def importar():
+        try: nucleo.importar_arquivo(os.path.join("..", "importar.csv"), "Jogo 01")
+        finally: nucleo.db.fechar(); os.chdir("..")
+    registrar(tamanho, "importar_csv", f"{tamanho:,} linhas", *medir(importar, min(repeticoes, 3), banco_importacao))
+
+    motor = nucleo.MotorBusca(usar_fts); modelo = {}
+    def carregar(): modelo.clear(); modelo["estoque"] = carregar_estoque(motor)
+    registrar(tamanho, "carregar_estoque", "colunas + índice de busca", *medir(carregar, repeticoes)); estoque = modelo["estoque"]
+
+    amostra = dict(estoque[rnd.choice(range(1, tamanho + 1))])  # Mesmo sorteio de rnd.choice(list(estoque)): ids 1..tamanho.
+    casos = {"sem filtro": {}, "categoria": {"categoria": "Jogo 07"}, "vendidas por canal": {"canal": "Shopee", "status": "Vendida"},
+             "busca curta": {"busca": "a1"}, "busca seletiva": {"busca": amostra['chave'][:10].lower()}, "busca + categoria": {"busca": "cliente 1", "categoria": "Jogo 03"}}
+    def sem_consulta_anterior(): motor._ultima = None  # Cada repetição parte do zero; a digitação incremental é outro caso.
+    for caso, filtros in casos.items():
+        registrar(tamanho, "filtrar_tabela", caso, *medir(lambda: filtrar_tabela(estoque, motor, **filtros), repeticoes, sem_consulta_anterior))
+    digitado = amostra['chave'][:8].lower()
+    def digitar():
+        for n in range(1, len(digitado) + 1): filtrar_tabela(estoque, motor, busca=digitado[:n])
+    registrar(tamanho, "filtrar_tabela", f"digitação de {len(digitado)} caracteres", *medir(digitar, repeticoes, sem_consulta_anterior))
+    modelo.clear(); estoque = None; motor.carregar(())  # Libera o modelo antes das medidas seguintes.
+
+    for caso, filtros in {"sem filtro": {}, "categoria": {"categoria": "Jogo 07"}, "busca seletiva": {"busca": amostra['chave'][:10].lower()}}.items():
+        sql, params = nucleo.montar_consulta_chaves(usar_fts=usar_fts, **filtros)
+        registrar(tamanho, "modo_consulta", caso, *medir(lambda: [r[0] for r in nucleo.db.consultar(sql, params)], repeticoes))
+
+    vendidas = [dict(r) for r in nucleo.db.consultar("SELECT * FROM chaves WHERE vendida = 1 LIMIT 100")]
+    for n in (1, 10, 100):
+        registrar(tamanho, "mensagem_entrega", f"{n} chaves", *medir(lambda: nucleo.construir_mensagem_entrega(vendidas[:n], categorias, 'pt_br'), repeticoes * 20))
+    if nucleo.PDF_DISPONIVEL:
+        trabalhos = [nucleo.trabalho_pdf_entrega(os.path.join("pdfs", f"bench_{i}.pdf"), vendidas[i * 10:(i + 1) * 10], categorias, 'pt_br', f"Cliente {i}") for i in range(8)]
+        os.makedirs("pdfs", exist_ok=True)
+        registrar(tamanho, "gerar_pdf", "1 entrega (10 chaves)", *medir(lambda: nucleo.renderizar_pdf_entrega(trabalhos[0]), repeticoes))
+        servico = nucleo.ServicoPDF(); servico.renderizar_lote(trabalhos[:1])  # Sobe o pool fora do tempo.
+        try: registrar(tamanho, "gerar_pdf", f"lote de {len(trabalhos)} ({servico.max_processos} processos)", *medir(lambda: servico.renderizar_lote(trabalhos), repeticoes))
+        finally: servico.encerrar()
+
+    # Cada reserva roda num SAVEPOINT desfeito depois, para o banco continuar igual entre repetições e execuções.
+    def reservar(quantidade):
+        with nucleo.db.transacao(imediata=True) as conn:
+            conn.execute("SAVEPOINT bench"); nucleo.reservar_chaves("Jogo 05", quantidade, "Bench", 10.0, canal="Loja"); conn.execute("ROLLBACK TO bench"); conn.execute("RELEASE bench")
+    for n in (1, 50): registrar(tamanho, "reservar_chaves", f"{n} chave(s)", *medir(lambda: reservar(n), repeticoes * 4))
+
+    for caso, inicio in {"últimos 30 dias": hoje - timedelta(days=30), "ano corrente": date(hoje.year, 1, 1), "dois anos": hoje - timedelta(days=DIAS_VENDAS)}.items():
+        for historica in (False, True):
+            registrar(tamanho, "dashboard", f"{caso}{' (cotação histórica)' if historica else ''}",
+                      *medir(lambda: nucleo.relatorio_vendas(f"{inicio}", f"{hoje}", 5.0, historica), repeticoes))
+    nucleo.db.fechar()
+
+# --- Resultado ---
+def commit_atual():
+    try: return subprocess.run(["git", "-C", RAIZ, "rev-parse", "--short", "HEAD"], capture_output=True, text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError): return None
+
+def comparar(resultados, caminho):
+    with open(caminho, encoding="utf-8") as f: anteriores = {(r['tamanho'], r['operacao'], r['caso']): r for r in json.load(f)['resultados']}
+    print(f"\nComparação com {caminho} (razão das medianas; < 1 é mais rápido agora):")
+    for r in resultados:
+        if (antes := anteriores.get((r['tamanho'], r['operacao'], r['caso']))) and antes['mediana_ms']:
+            print(f"  {r['tamanho']:>9,}  {r['operacao']:<18} {r['caso']:<34} {antes['mediana_ms']:>10.2f} -> {r['mediana_ms']:>10.2f} ms  x{r['mediana_ms'] / antes['mediana_ms']:.2f}")
+
+def main_bench():
+    parser = argparse.ArgumentParser(description="Suíte de benchmarks do Gerenciador de Chaves (sem interface).")
+    parser.add_argument("--tamanhos", default="10000,100000,1000000", help="quantidades de chaves, separadas por vírgula")
+    parser.add_argument("--repeticoes", type=int, default=5)
+    parser.add_argument("--dir", help="onde guardar/reaproveitar os bancos sintéticos (padrão: pasta temporária)")
+    parser.add_argument("--saida", help="arquivo JSON de resultado (padrão: bench_<versão>_<data>.json na pasta atual)")
+    parser.add_argument("--comparar", help="JSON de uma execução anterior para comparar")
+    args = parser.parse_args()
+    tamanhos = [int(t.replace("_", "")) for t in args.tamanhos.split(",") if t.strip()]
+    saida = os.path.abspath(args.saida or f"bench_{nucleo.APP_VERSION}_{datetime.now():%Y%m%d_%H%M%S}.json")
+    comparar_com = os.path.abspath(args.comparar) if args.comparar else None
+    resultados = []; anterior = os.getcwd()
+    def registrar(tamanho, operacao, caso, mediana, minimo):
+        resultados.append({"tamanho": tamanho, "operacao": operacao, "caso": caso, "mediana_ms": round(mediana, 3), "min_ms": round(minimo, 3)})
+        print(f"  {operacao:<18} {caso:<34} {mediana:>10.2f} ms (mín. {minimo:.2f})")
+    with nullcontext(args.dir) if args.dir else tempfile.TemporaryDirectory(prefix="bench_suite_") as pasta:
+        try:
+            for tamanho in tamanhos: medir_tamanho(tamanho, os.path.abspath(pasta), args.repeticoes, registrar)
+        finally: nucleo.auditoria.encerrar(); nucleo.db.fechar(); os.chdir(anterior)  # Nada aberto na pasta antes de apagá-la.
+    with open(saida, "w", encoding="utf-8") as f:
+        json.dump({"versao": nucleo.APP_VERSION, "commit": commit_atual(), "data": f"{datetime.now():%Y-%m-%d %H:%M:%S}", "python": platform.python_version(),
+                   "sqlite": sqlite3.sqlite_version, "plataforma": platform.platform(), "cpus": os.cpu_count(), "repeticoes": args.repeticoes,
+                   "pdf_disponivel": nucleo.PDF_DISPONIVEL, "resultados": resultados}, f, ensure_ascii=False, indent=2)
+    print(f"\nResultado salvo em {saida}")
+    if comparar_com: comparar(resultados, comparar_com)
+
+if __name__ == "__main__":
+    main_bench()
@@ -0,0 +1,192 @@
+# Gerenciador de Chaves - linha de comando
+# coding: utf-8
+# Uso: python cli.py <comando> [opções]   (ou python main.py <comando> ...). Não precisa de display: só usa o nucleo.
+# Toda alteração vira um passo de desfazer da linha de comando (python cli.py desfazer / refazer), separado dos do
+# aplicativo.
+import argparse
+import os
+import sqlite3
+import sys
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from nucleo import (APP_VERSION, BACKUP_DIR, STATUS_LOTE, AgendadorBackup, FilaEmail, ServicoCotacao, desfazer_passo, entregar_lote, estoque_por_categoria, excluir_chaves,
+                    exportar_chaves, fazer_backup, garantir_categoria, importar_arquivo, ingerir_chaves, ler_pedidos, listar_backups, logar_acao,
+                    auditoria, metricas, passo_undo, podar_backups, preparar_banco, refazer_passo, relatorio_vendas, salvar_relatorio_lote, verificar_backup, db)
+
+def _progresso(etapa, feitos, total):
+    print(f"\r{etapa}: {feitos}/{total}", end="", file=sys.stderr, flush=True)
+
+def _enviar_fila():
+    fila = FilaEmail(); fila.iniciar(); fila.aguardar(); fila.parar(); print(f"Emails: {fila.contagem()}")
+
+def _resumo_pedidos(pedidos):
+    contagem = defaultdict(int)
+    for pedido in pedidos: contagem[pedido["status"]] += 1
+    for status, n in contagem.items(): print(f"{STATUS_LOTE[status]}: {n}")
+
+# --- Comandos ---
+def cmd_estoque(args):
+    print(f"{'Categoria':<30} {'Disponíveis':>12} {'Vendidas':>10}")
+    for categoria, disponiveis, vendidas in estoque_por_categoria(): print(f"{categoria:<30} {disponiveis:>12,} {vendidas:>10,}")
+    return 0
+
+def cmd_adicionar(args):
+    chaves = args.chaves or (linha.strip() for linha in sys.stdin)
+    with passo_undo() as passo: garantir_categoria(args.categoria)
+    _, adicionadas, duplicadas, _ = ingerir_chaves(chaves, args.categoria, args.canal, desfazer=passo)
+    print(f"{adicionadas} chave(s) adicionada(s), {duplicadas} duplicada(s) ignorada(s)."); return 0
+
+def cmd_importar(args):
+    _, adicionadas, duplicadas, _ = importar_arquivo(args.arquivo, args.categoria, [c.strip() for c in args.colunas.split(",")], args.linha_inicio, args.planilhas, args.canal,
+                                                     ao_lote=lambda a, d: print(f"\r{a:,} nova(s), {d:,} duplicada(s)...", end="", file=sys.stderr, flush=True), desfazer=True)
+    print(file=sys.stderr)
+    print(f"{adicionadas} chave(s) nova(s) importada(s), {duplicadas} duplicada(s) ignorada(s)."); return 0
+
+def cmd_excluir(args):
+    with passo_undo(): ids = [r[0] for r in db.consultar(f"SELECT id FROM chaves WHERE chave IN ({','.join('?' * len(args.chaves))})", args.chaves)]; ids = excluir_chaves(ids)
+    print(f"{len(ids)} chave(s) excluída(s)."); return 0 if len(ids) == len(set(args.chaves)) else 1
+
+def cmd_entregar(args):
+    pedido = {"linha": 1, "comprador": args.comprador, "email": args.email or "", "categoria": args.categoria, "quantidade": str(args.quantidade),
+              "preco_brl": args.preco or "", "preco_usd": args.preco_usd or "", "canal": args.canal or "", "idioma": args.idioma}
+    pedido = entregar_lote([pedido], gerar_pdf=not args.sem_pdf, enviar_email=bool(args.email), anexar_pdf=not args.sem_anexo, desfazer=True)[0]
+    if pedido["status"] not in ("entregue", "erro_pdf"): print(f"{STATUS_LOTE[pedido['status']]}: {pedido['erro']}", file=sys.stderr); return 1
+    for chave in pedido["chaves"]: print(chave["chave"])
+    if pedido["pdf"]: print(f"PDF: {pedido['pdf']}", file=sys.stderr)
+    if pedido["erro"]: print(f"Falha no PDF: {pedido['erro']}", file=sys.stderr)
+    if args.enviar and args.email: _enviar_fila()
+    return 0
+
+def cmd_entregar_lote(args):
+    pedidos = entregar_lote(ler_pedidos(args.pedidos), idioma=args.idioma, gerar_pdf=not args.sem_pdf, enviar_email=not args.sem_email, anexar_pdf=not args.sem_anexo, ao_progresso=_progresso, desfazer=True)
+    print(file=sys.stderr)
+    relatorio = salvar_relatorio_lote(pedidos, args.relatorio or f"{os.path.splitext(args.pedidos)[0]}_resultado_{datetime.now():%Y%m%d%H%M%S}.csv")
+    _resumo_pedidos(pedidos); print(f"Relatório: {relatorio}")
+    if args.enviar and not args.sem_email: _enviar_fila()
+    return 0 if all(p["status"] == "entregue" for p in pedidos) else 1
+
+def cmd_desfazer(args):
+    """desfazer/refazer: só passos gravados pela linha de comando; os do aplicativo ficam no Editar > Desfazer dele."""
+    if (mud := (desfazer_passo if args.comando == "desfazer" else refazer_passo)()) is None: print(f"Nenhuma ação para {args.comando}."); return 1
+    logar_acao(f"Ação '{args.comando}' executada.", args.comando, chaves=sorted(mud.inseridos | mud.atualizados | mud.removidos) or None)
+    print(f"{'Desfeita' if args.comando == 'desfazer' else 'Refeita'}: {len(mud.inseridos)} chave(s) de volta, {len(mud.atualizados)} alterada(s), {len(mud.removidos)} removida(s)."); return 0
+
+def cmd_exportar(args):
+    filtros = dict(busca=(args.busca or "").lower(), categoria=args.categoria or "Todos", canal=args.canal or "Todos", status={"disponivel": "Disponível", "vendida": "Vendida"}.get(args.status, "Todos"))
+    n = exportar_chaves(args.arquivo, filtros, ao_progresso=lambda feitos, total: _progresso("Exportando", feitos, total))
+    print(file=sys.stderr); print(f"{n:,} chave(s) exportada(s) para {args.arquivo}"); return 0
+
+def cmd_relatorio(args):
+    hoje = datetime.now(); inicio, fim = args.inicio or (hoje - timedelta(days=29)).strftime("%Y-%m-%d"), args.fim or hoje.strftime("%Y-%m-%d")
+    if not (cotacao := args.cotacao):
+        servico = ServicoCotacao()
+        try: cotacao = servico.atualizar(inicio, fim).result()
+        except (OSError, ValueError, KeyError, ImportError) as e:
+            if (cotacao := servico.atual()) is None: raise ValueError(f"sem cotação gravada e não foi possível buscar uma ({e}); use --cotacao.")
+            print(f"Aviso: cotação não atualizada ({e}); usando a última gravada.", file=sys.stderr)
+        finally: servico.encerrar()
+    rel = relatorio_vendas(inicio, fim, cotacao, historica=not args.cotacao)
+    print(f"Período: {inicio} a {fim}  (cotação US$ 1 = R$ {cotacao:.2f}{'' if args.cotacao else '; cada venda pela cotação do seu dia'})")
+    print(f"Vendas: {rel['vendas']}  Receita: R$ {rel['receita']:,.2f}  Custo: R$ {rel['custo']:,.2f}  Lucro: R$ {rel['lucro']:,.2f}\n")
+    print(f"{args.por.capitalize():<30} {'Qtd':>6} {'Receita':>14} {'Custo':>14} {'Lucro':>14}")
+    for cat, d in sorted(rel[f"por_{args.por}"].items()): print(f"{cat:<30} {d['qtd']:>6} {d['rec']:>14,.2f} {d['custo']:>14,.2f} {d['rec'] - d['custo']:>14,.2f}")
+    return 0
+
+def cmd_enviar_emails(args):
+    _enviar_fila(); return 0
+
+def cmd_backup(args):
+    if args.listar or args.verificar is not None:
+        ok = True
+        for caminho in args.verificar or [c for _, c in listar_backups(args.pasta)]:
+            resultado = verificar_backup(caminho) if args.verificar is not None else ""; ok &= resultado in ("", "ok")
+            print(f"{caminho}  {os.path.getsize(caminho) / 2**20:9.1f} MiB  {resultado}".rstrip())
+        return 0 if ok else 1
+    if args.intervalo:
+        agendador = AgendadorBackup(args.intervalo * 60, args.pasta, not args.sem_compactar); agendador.iniciar()
+        print(f"Backup a cada {args.intervalo} min em {args.pasta} (Ctrl+C para parar)", file=sys.stderr)
+        try:
+            while True:
+                tipo, detalhe = agendador.eventos.get()
+                print(f"{detalhe['caminho']} ({detalhe['bytes'] / 2**20:.1f} MiB, {detalhe['segundos']:.1f} s)" if tipo == 'backup' else f"Falhou: {detalhe}", flush=True)
+        except KeyboardInterrupt: agendador.parar(); return 0
+    info = fazer_backup(args.pasta, not args.sem_compactar, ao_progresso=lambda feitas, total: _progresso("Copiando páginas", feitas, total))
+    print(file=sys.stderr); print(f"Backup criado e verificado: {info['caminho']} ({info['bytes'] / 2**20:.1f} MiB em {info['segundos']:.1f} s)")
+    if not args.sem_podar:
+        for caminho in podar_backups(args.pasta): print(f"Removido pela rotação: {caminho}")
+    return 0
+
+def cmd_auditoria(args):
+    chave = int(args.chave) if args.chave and args.chave.isdigit() and not args.texto else args.chave
+    eventos = auditoria.consultar(args.comprador, chave, args.operacao, args.categoria, args.desde, args.ate, args.limite)
+    for e in reversed(eventos):
+        detalhe = "  ".join(f"{c}={e[c]}" for c in ("comprador", "canal", "categoria", "duracao_ms") if c in e)
+        print(f"{e['ts']}  {e['operacao']:<12} {e['origem']:<4} {e.get('mensagem') or ', '.join(e.get('chaves') or map(str, e.get('ids', ())))}  {detalhe}".rstrip())
+    print(f"{len(eventos)} evento(s){' (limite atingido)' if len(eventos) == args.limite else ''}", file=sys.stderr); return 0
+
+def cmd_servidor(args):
+    from servidor_http import ServidorAPI
+    auditoria.origem = "api"
+    print(f"API local em http://{args.host}:{args.porta} (Ctrl+C para parar)", file=sys.stderr)
+    ServidorAPI(args.host, args.porta, args.trabalhadores).servir(); return 0
+
+def criar_parser():
+    parser = argparse.ArgumentParser(prog="cli.py", description=f"Gerenciador de Chaves v{APP_VERSION} (sem interface)")
+    parser.add_argument("--tempo", action="store_true", help="Mostra quanto o comando levou (stderr)")
+    parser.add_argument("--perfil", action="store_true", help="Roda o comando sob cProfile e grava o .prof/.txt em perfis/")
+    parser.add_argument("--metricas", metavar="ARQUIVO", help="Ao terminar, exporta as latências por etapa (.json ou .csv)")
+    sub = parser.add_subparsers(dest="comando", required=True)
+    p = sub.add_parser("estoque", help="Chaves disponíveis e vendidas por categoria"); p.set_defaults(func=cmd_estoque)
+    p = sub.add_parser("adicionar", help="Adiciona chaves (argumentos ou uma por linha na entrada padrão)"); p.set_defaults(func=cmd_adicionar)
+    p.add_argument("categoria"); p.add_argument("chaves", nargs="*"); p.add_argument("--canal")
+    p = sub.add_parser("importar", help="Importa chaves de XLS/XLSX/CSV/TXT"); p.set_defaults(func=cmd_importar)
+    p.add_argument("arquivo"); p.add_argument("--categoria", required=True); p.add_argument("--colunas", default="A", help="Letras ou números separados por vírgula (padrão: A)")
+    p.add_argument("--linha-inicio", type=int, default=1); p.add_argument("--planilhas", nargs="*"); p.add_argument("--canal")
+    p = sub.add_parser("excluir", help="Exclui chaves pelo texto"); p.set_defaults(func=cmd_excluir); p.add_argument("chaves", nargs="+")
+    p = sub.add_parser("entregar", help="Entrega N chaves de uma categoria (imprime as chaves)"); p.set_defaults(func=cmd_entregar)
+    p.add_argument("--categoria", required=True); p.add_argument("--comprador", required=True); p.add_argument("--quantidade", type=int, default=1)
+    p.add_argument("--email"); p.add_argument("--preco"); p.add_argument("--preco-usd"); p.add_argument("--canal"); p.add_argument("--idioma", choices=("pt_br", "en_us", "es_es"), default="pt_br")
+    p.add_argument("--sem-pdf", action="store_true"); p.add_argument("--sem-anexo", action="store_true"); p.add_argument("--enviar", action="store_true", help="Envia o email agora")
+    p = sub.add_parser("entregar-lote", help="Atende um arquivo CSV de pedidos (comprador, email, categoria, quantidade, preco, canal)"); p.set_defaults(func=cmd_entregar_lote)
+    p.add_argument("pedidos"); p.add_argument("--relatorio", help="CSV de resultado (padrão: <pedidos>_resultado_<data>.csv)")
+    p.add_argument("--idioma", choices=("pt_br", "en_us", "es_es"), default="pt_br", help="Idioma dos pedidos sem a coluna 'idioma'")
+    p.add_argument("--sem-pdf", action="store_true"); p.add_argument("--sem-email", action="store_true"); p.add_argument("--sem-anexo", action="store_true")
+    p.add_argument("--enviar", action="store_true", help="Envia os emails agora (senão ficam na fila para o aplicativo)")
+    p = sub.add_parser("desfazer", help="Desfaz a última alteração feita pela linha de comando"); p.set_defaults(func=cmd_desfazer)
+    p = sub.add_parser("refazer", help="Refaz a última alteração desfeita pela linha de comando"); p.set_defaults(func=cmd_desfazer)
+    p = sub.add_parser("exportar", help="Exporta o estoque (formato pela extensão: .csv, .xlsx, .jsonl; .csv.gz/.jsonl.gz compactados)"); p.set_defaults(func=cmd_exportar)
+    p.add_argument("arquivo"); p.add_argument("--categoria"); p.add_argument("--canal", help="Nome do canal ou 'Nenhum'"); p.add_argument("--status", choices=("disponivel", "vendida"))
+    p.add_argument("--busca", help="Texto em chave, categoria, comprador ou canal")
+    p = sub.add_parser("relatorio", help="Resumo de vendas por categoria"); p.set_defaults(func=cmd_relatorio)
+    p.add_argument("--inicio", help="AAAA-MM-DD (padrão: 30 dias atrás)"); p.add_argument("--fim", help="AAAA-MM-DD (padrão: hoje)"); p.add_argument("--cotacao", type=float, help="R$ por US$ para todas as vendas (padrão: cotação do dia de cada venda)")
+    p.add_argument("--por", choices=("categoria", "canal", "dia"), default="categoria", help="Agrupamento do detalhe (padrão: categoria)")
+    p = sub.add_parser("enviar-emails", help="Envia os emails pendentes da fila"); p.set_defaults(func=cmd_enviar_emails)
+    p = sub.add_parser("backup", help="Backup online verificado do banco, com rotação (horário/diário/semanal)"); p.set_defaults(func=cmd_backup)
+    p.add_argument("--pasta", default=BACKUP_DIR); p.add_argument("--sem-compactar", action="store_true", help="Grava .db em vez de .db.gz"); p.add_argument("--sem-podar", action="store_true", help="Não apaga backups antigos")
+    p.add_argument("--intervalo", type=int, help="Fica rodando e faz um backup a cada N minutos (se o banco mudou)")
+    p.add_argument("--listar", action="store_true"); p.add_argument("--verificar", nargs="*", metavar="ARQUIVO", help="Roda integrity_check nos arquivos (padrão: todos da pasta)")
+    p = sub.add_parser("auditoria", help="Consulta o registro de auditoria (mais recentes por último)"); p.set_defaults(func=cmd_auditoria)
+    p.add_argument("--comprador"); p.add_argument("--chave", help="Id ou texto da chave"); p.add_argument("--texto", action="store_true", help="--chave é sempre o texto, mesmo só com dígitos")
+    p.add_argument("--operacao", help="venda, conflito, importacao, exclusao, entrega_lote, email, backup, ..."); p.add_argument("--categoria")
+    p.add_argument("--desde", help="AAAA-MM-DD[ HH:MM:SS]"); p.add_argument("--ate", help="AAAA-MM-DD[ HH:MM:SS]"); p.add_argument("--limite", type=int, default=100)
+    p = sub.add_parser("servidor", help="API HTTP local para automações (estoque, reservas, entregas, mensagem, PDF)"); p.set_defaults(func=cmd_servidor)
+    p.add_argument("--host", default="127.0.0.1", help="Endereço local (127.0.0.1 ou ::1)"); p.add_argument("--porta", type=int, default=8765)
+    p.add_argument("--trabalhadores", type=int, default=4, help="Threads de leitura do banco")
+    return parser
+
+def main(argv=None):
+    args = criar_parser().parse_args(argv); inicio = time.perf_counter(); auditoria.origem = "cli"
+    preparar_banco()
+    if args.perfil: metricas.iniciar_perfil()
+    try:
+        with metricas.span(f"cli.{args.comando}"): return args.func(args)
+    except (OSError, ValueError, ImportError, sqlite3.Error) as e: print(f"Erro: {e}", file=sys.stderr); return 2
+    finally:
+        if args.tempo: print(f"[{args.comando}] {time.perf_counter() - inicio:.3f} s", file=sys.stderr)
+        if args.perfil: print(f"Perfil: {metricas.parar_perfil()}", file=sys.stderr)
+        if args.metricas: print(f"Métricas: {metricas.exportar(args.metricas)}", file=sys.stderr)
+
+if __name__ == "__main__":
+    sys.exit(main())
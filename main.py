@@ -1,253 +1,33 @@
 # Gerenciador de Chaves v9.5 - Por Vinícius Leão
 # coding: utf-8
+import time
+_INICIO_PROCESSO = time.perf_counter()  # Referência do relatório de tempos de inicialização.
 import tkinter as tk
 from tkinter import ttk, messagebox, simpledialog, filedialog
+import sys
 import json
+import csv
 import os
 import sqlite3
 from datetime import datetime, timedelta
 import pyperclip
-import shutil
 from collections import defaultdict
-import requests
-import smtplib
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from email.mime.application import MIMEApplication
 import threading
-import re
-import html
+import queue
+import bisect
 import webbrowser # Para a pré-visualização
-
-# --- Biblioteca para gerar PDF ---
-try:
-    from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, PageBreak, Image, Table, TableStyle
-    from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-    from reportlab.lib.units import inch, cm
-    from reportlab.lib import colors
-    from reportlab.lib.enums import TA_CENTER, TA_LEFT, TA_RIGHT, TA_JUSTIFY
-    from reportlab.lib.utils import ImageReader
-    PDF_DISPONIVEL = True
-except ImportError:
-    PDF_DISPONIVEL = False
-
-# --- Biblioteca para importar de XLS (NOVO) ---
-try:
-    import pandas as pd
-    PANDAS_DISPONIVEL = True
-except ImportError:
-    PANDAS_DISPONIVEL = False
-
-# --- Constantes ---
-DB_NAME = "gerenciador.db"
-UNDO_FILE = "gerenciador.db.undo"
-REDO_FILE = "gerenciador.db.redo"
-BACKUP_DIR = "backups"
-PDF_DIR = "pdfs"
-EMAIL_CONFIG_FILE = "email_config.json"
-APP_VERSION = "9.5" # Versão atualizada com a nova funcionalidade
-
-# --- Utilitários ---
-def _sanitize_filename(filename):
-    return re.sub(r'[<>:"/\\|?*]', '', filename)
-
-def _converter_markdown_para_html(texto):
-    """Converte uma marcação simples (tipo Markdown) para tags HTML que o ReportLab entende."""
-    texto = re.sub(r'\*\*(.*?)\*\*', r'<b>\1</b>', texto)
-    texto = re.sub(r'\*(.*?)\*', r'<i>\1</i>', texto)
-    texto = re.sub(r'__(.*?)__', r'<u>\1</u>', texto)
-    texto = texto.replace('\n', '<br/>')
-    return texto
-
-# --- Classe Geradora de PDF (integrada para melhor organização) ---
-class GeradorPDF:
-    def __init__(self, nome_arquivo):
-        self.nome_arquivo = nome_arquivo
-        self.story = []
-        self._setup_estilos()
-
-    def _setup_estilos(self):
-        self.estilos = getSampleStyleSheet()
-        self.estilos.add(ParagraphStyle(name='HeaderStyle', fontName='Helvetica-Bold', fontSize=16, alignment=TA_CENTER, spaceAfter=15))
-        self.estilos.add(ParagraphStyle(name='InfoLabel', fontName='Helvetica-Bold', fontSize=10, alignment=TA_LEFT, textColor=colors.darkblue))
-        self.estilos.add(ParagraphStyle(name='InfoText', fontName='Helvetica', fontSize=10, alignment=TA_LEFT))
-        self.estilos.add(ParagraphStyle(name='KeyLabel', fontName='Helvetica-Bold', fontSize=12, alignment=TA_CENTER, spaceBefore=10, spaceAfter=5))
-        self.estilos.add(ParagraphStyle(name='KeyStyle', fontName='Courier-Bold', fontSize=16, alignment=TA_CENTER, backColor=colors.HexColor('#f0f0f0'), textColor=colors.black, borderRadius=5, borderWidth=1.5, borderColor=colors.black, padding=12, leading=20))
-        self.estilos.add(ParagraphStyle(name='InstructionTitleStyle', fontName='Helvetica-Bold', fontSize=14, alignment=TA_CENTER, spaceBefore=20, spaceAfter=10, textColor=colors.HexColor("#094771")))
-        self.estilos.add(ParagraphStyle(name='InstructionBody', fontName='Helvetica', fontSize=10, leading=14, leftIndent=20))
-        self.estilos.add(ParagraphStyle(name='FooterStyle', fontName='Helvetica-Oblique', fontSize=9, alignment=TA_CENTER, spaceBefore=30, textColor=colors.grey))
-
-    def adicionar_paragrafo(self, texto, estilo='Normal'):
-        texto_seguro = html.escape(texto)
-        texto_formatado = _converter_markdown_para_html(texto_seguro)
-        p = Paragraph(texto_formatado, self.estilos[estilo])
-        self.story.append(p)
-
-    def adicionar_imagem(self, caminho_imagem, largura_cm):
-        if not (caminho_imagem and os.path.exists(caminho_imagem)): return
-        try:
-            img_reader = ImageReader(caminho_imagem)
-            iw, ih = img_reader.getSize()
-            aspect = ih / float(iw) if iw > 0 else 0
-            largura = largura_cm * cm
-            altura = (largura * aspect) if aspect > 0 else 0
-            img = Image(caminho_imagem, width=largura, height=altura)
-            img.hAlign = 'CENTER'
-            self.story.append(img)
-            self.adicionar_espaco_cm(0.8)
-        except Exception as e:
-            print(f"Erro ao carregar logo: {e}")
-
-    def adicionar_tabela_info(self, dados, col_widths_cm):
-        col_widths = [w * cm for w in col_widths_cm]
-        tabela_formatada = []
-        for rotulo, texto in dados:
-            if texto:
-                p_rotulo = Paragraph(f"🔹 <b>{rotulo}</b>", self.estilos['InfoText'])
-                p_texto = Paragraph(texto, self.estilos['InfoText'])
-                tabela_formatada.append([p_rotulo, p_texto])
-        if tabela_formatada:
-            tabela = Table(tabela_formatada, colWidths=col_widths)
-            tabela.setStyle(TableStyle([('VALIGN', (0,0), (-1,-1), 'TOP'), ('LEFTPADDING', (0,0), (-1,-1), 0), ('TOPPADDING', (0,0), (-1,-1), 2)]))
-            self.story.append(tabela)
-
-    def adicionar_espaco_cm(self, altura_cm):
-        self.story.append(Spacer(1, altura_cm * cm))
-    
-    def adicionar_quebra_pagina(self):
-        self.story.append(PageBreak())
-
-    def construir(self):
-        try:
-            doc = SimpleDocTemplate(self.nome_arquivo, topMargin=0.5*inch, bottomMargin=0.5*inch, leftMargin=0.7*inch, rightMargin=0.7*inch)
-            doc.build(self.story)
-            return True
-        except Exception as e:
-            messagebox.showerror("Erro de PDF", f"Não foi possível gerar o arquivo PDF.\nErro: {e}")
-            logar_acao(f"FALHA ao gerar PDF. Erro: {e}")
-            return False
-
-# --- Funções de Banco de Dados e Utilitárias ---
-def init_db():
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS chaves (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        chave TEXT NOT NULL UNIQUE,
-        categoria TEXT NOT NULL,
-        vendida INTEGER NOT NULL DEFAULT 0,
-        comprador TEXT,
-        data_venda TEXT,
-        ordem_manual INTEGER,
-        preco_venda_brl REAL,
-        preco_venda_usd REAL,
-        canal_venda TEXT
-    )
-    ''')
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS categorias (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        nome TEXT NOT NULL UNIQUE,
-        instrucao_pt TEXT,
-        instrucao_en TEXT,
-        custo_padrao_brl REAL,
-        custo_padrao_usd REAL,
-        logo_path TEXT,
-        info_licenca_pt TEXT, info_licenca_en TEXT,
-        info_idioma_pt TEXT, info_idioma_en TEXT,
-        info_entrega_pt TEXT, info_entrega_en TEXT,
-        layout_pdf_pt TEXT, layout_pdf_en TEXT,
-        instrucao_es TEXT,
-        info_licenca_es TEXT,
-        info_idioma_es TEXT,
-        info_entrega_es TEXT,
-        layout_pdf_es TEXT
-    )
-    ''')
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS canais_venda (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        nome TEXT NOT NULL UNIQUE
-    )
-    ''')
-    conn.commit()
-    conn.close()
-
-def _adicionar_coluna_se_nao_existir(cursor, tabela, coluna, tipo):
-    cursor.execute(f"PRAGMA table_info({tabela})")
-    colunas = [info[1] for info in cursor.fetchall()]
-    if coluna not in colunas:
-        try:
-            cursor.execute(f"ALTER TABLE {tabela} ADD COLUMN {coluna} {tipo}")
-            print(f"Coluna '{coluna}' adicionada à tabela '{tabela}' com sucesso.")
-            return True
-        except Exception as e:
-            print(f"Erro ao adicionar coluna '{coluna}': {e}")
-            messagebox.showerror("Erro de Banco de Dados", f"Não foi possível atualizar o banco de dados para a nova versão.\nErro: {e}")
-            return False
-    return True
-
-def verificar_e_migrar_schema():
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    sucesso = True
-    sucesso &= _adicionar_coluna_se_nao_existir(cursor, 'chaves', 'ordem_manual', 'INTEGER')
-    sucesso &= _adicionar_coluna_se_nao_existir(cursor, 'chaves', 'preco_venda_brl', 'REAL')
-    sucesso &= _adicionar_coluna_se_nao_existir(cursor, 'chaves', 'preco_venda_usd', 'REAL')
-    sucesso &= _adicionar_coluna_se_nao_existir(cursor, 'chaves', 'canal_venda', 'TEXT')
-    sucesso &= _adicionar_coluna_se_nao_existir(cursor, 'categorias', 'custo_padrao_brl', 'REAL')
-    sucesso &= _adicionar_coluna_se_nao_existir(cursor, 'categorias', 'custo_padrao_usd', 'REAL')
-    sucesso &= _adicionar_coluna_se_nao_existir(cursor, 'categorias', 'logo_path', 'TEXT')
-    sucesso &= _adicionar_coluna_se_nao_existir(cursor, 'categorias', 'info_licenca_pt', 'TEXT')
-    sucesso &= _adicionar_coluna_se_nao_existir(cursor, 'categorias', 'info_licenca_en', 'TEXT')
-    sucesso &= _adicionar_coluna_se_nao_existir(cursor, 'categorias', 'info_idioma_pt', 'TEXT')
-    sucesso &= _adicionar_coluna_se_nao_existir(cursor, 'categorias', 'info_idioma_en', 'TEXT')
-    sucesso &= _adicionar_coluna_se_nao_existir(cursor, 'categorias', 'info_entrega_pt', 'TEXT')
-    sucesso &= _adicionar_coluna_se_nao_existir(cursor, 'categorias', 'info_entrega_en', 'TEXT')
-    sucesso &= _adicionar_coluna_se_nao_existir(cursor, 'categorias', 'layout_pdf_pt', 'TEXT')
-    sucesso &= _adicionar_coluna_se_nao_existir(cursor, 'categorias', 'layout_pdf_en', 'TEXT')
-    sucesso &= _adicionar_coluna_se_nao_existir(cursor, 'categorias', 'instrucao_es', 'TEXT')
-    sucesso &= _adicionar_coluna_se_nao_existir(cursor, 'categorias', 'info_licenca_es', 'TEXT')
-    sucesso &= _adicionar_coluna_se_nao_existir(cursor, 'categorias', 'info_idioma_es', 'TEXT')
-    sucesso &= _adicionar_coluna_se_nao_existir(cursor, 'categorias', 'info_entrega_es', 'TEXT')
-    sucesso &= _adicionar_coluna_se_nao_existir(cursor, 'categorias', 'layout_pdf_es', 'TEXT')
-    cursor.execute("SELECT COUNT(*) FROM chaves WHERE ordem_manual IS NULL")
-    if cursor.fetchone()[0] > 0: cursor.execute("UPDATE chaves SET ordem_manual = id WHERE ordem_manual IS NULL")
-    conn.commit()
-    conn.close()
-    if not sucesso: exit()
-
-def migrar_de_json_para_sqlite():
-    if not os.path.exists("estoque.json") and not os.path.exists("categorias.json"): return
-    conn = sqlite3.connect(DB_NAME); cursor = conn.cursor()
-    cursor.execute("SELECT COUNT(id) FROM chaves")
-    if cursor.fetchone()[0] > 0 and not (os.path.exists("estoque.json") or os.path.exists("categorias.json")):
-        conn.close(); return
-    if not messagebox.askyesno("Migração de Dados Detectada", "Arquivos .json antigos foram encontrados. Deseja migrar os dados?"):
-        conn.close(); return
-    if os.path.exists("estoque.json"):
-        try:
-            with open("estoque.json", "r", encoding="utf-8") as f: estoque_json = json.load(f)
-            chaves = [(item['chave'], item.get('categoria', 'S/C'), 1 if item.get('vendida') else 0, item.get('comprador'), item.get('data_venda')) for item in estoque_json]
-            cursor.executemany("INSERT OR IGNORE INTO chaves (chave, categoria, vendida, comprador, data_venda) VALUES (?, ?, ?, ?, ?)", chaves)
-            os.rename("estoque.json", "estoque.json.bak")
-        except Exception as e: print(f"Erro ao migrar estoque.json: {e}")
-    if os.path.exists("categorias.json"):
-        try:
-            with open("categorias.json", "r", encoding="utf-8") as f: categorias_json = json.load(f)
-            cats = [(cat, "", "") for cat in categorias_json] if categorias_json and isinstance(categorias_json[0], str) else [(c['nome'], c.get('inst_pt',''), c.get('inst_en','')) for c in categorias_json]
-            cursor.executemany("INSERT OR IGNORE INTO categorias (nome, instrucao_pt, instrucao_en) VALUES (?, ?, ?)", cats)
-            os.rename("categorias.json", "categorias.json.bak")
-        except Exception as e: print(f"Erro ao migrar categorias.json: {e}")
-    cursor.execute("INSERT OR IGNORE INTO categorias (nome) VALUES ('Sem Categoria')")
-    conn.commit(); conn.close()
-    messagebox.showinfo("Atualização", "Dados migrados com sucesso!")
-
-def logar_acao(acao):
-    try:
-        with open("log.txt", "a", encoding="utf-8") as log: log.write(f"[{datetime.now():%Y-%m-%d %H:%M:%S}] {acao}\n")
-    except IOError: pass
+# Regras de negócio, banco e serviços sem interface.
+from nucleo import (APP_VERSION, ASSUNTOS_EMAIL, COLUNAS_ESTOQUE, AgendadorBackup, ConjuntoMudancas, DB_NAME, EMAIL_CONFIG_FILE, EstoqueCompacto, EstoquePaginado, FilaEmail, LeitorChaves, MotorBusca,
+                    OPENPYXL_DISPONIVEL, PDF_DIR, PDF_DISPONIVEL, STATUS_LOTE, ServicoCotacao, ServicoPDF, caminho_pdf_entrega, carregar_config_email, chave_ordem,
+                    config_email_completa, construir_mensagem_entrega, contar_passos_undo, db, desfazer_passo, entregar_lote, excluir_chaves, exportar_chaves,
+                    filtro_chaves, formato_exportacao, ingerir_chaves, init_db, instalar_indice_busca, instalar_journal_undo, ler_pedidos,
+                    logar_acao, metricas, migrar_de_json_para_sqlite, montar_consulta_chaves, mover_chaves, passo_undo, refazer_passo, relatorio_vendas, salvar_relatorio_lote,
+                    trabalho_pdf_entrega, vender_chaves, verificar_e_migrar_schema)
+
+# --- Constantes da Interface ---
+BUSCA_DEBOUNCE_MS = 150
+CARGA_PRIMEIRA_PAGINA, CARGA_LOTE = 500, 10_000  # Início rápido: linhas lidas antes da janela e por lote depois dela.
+MODO_CONSULTA_LIMIAR = 100_000  # Acima disso o app abre no modo consulta (inventário fora da memória).
 
 class CustomAskStringDialog(simpledialog.Dialog):
     def __init__(self, parent, title=None, prompt=None, style_colors=None):
@@ -265,77 +45,298 @@ class CustomAskStringDialog(simpledialog.Dialog):
         self.bind("<Return>", self.ok); self.bind("<Escape>", self.cancel); box.pack()
     def apply(self): self.result = self.entry.get().strip()
 
+class TabelaVirtual:
+    """Rolagem virtual sobre uma ttk.Treeview: as linhas (já filtradas/ordenadas) ficam numa lista de ids e só as
+    visíveis, mais um pequeno buffer, são materializadas num pool fixo de itens reaproveitados a cada rolagem.
+    A seleção é guardada pelos ids das linhas, nunca pelos itens do pool."""
+    BUFFER = 2
+
+    def __init__(self, tree, scrollbar, valores_de, multipla=True):
+        self.tree, self.scrollbar, self.valores_de, self.multipla = tree, scrollbar, valores_de, multipla
+        self.linhas, self._presentes, self.selecionados = [], set(), set()
+        self.offset, self.ancora, self.visiveis, self.pool = 0, None, 20, []
+        self._colapsar = None  # Clique simples numa linha de uma seleção múltipla: só vira seleção única ao soltar sem arrastar.
+        self.ao_pressionar = None  # callback(evento, indice) chamado após a seleção do clique (ex.: início de drag)
+        self.pre_carregar = None  # callback(linhas, offset) antes de desenhar a janela (ex.: leitura paginada do BD)
+        scrollbar.configure(command=self.yview); tree.configure(yscrollcommand=lambda *a: None)
+        tree.bind("<Configure>", self._ao_redimensionar, add="+"); tree.bind("<ButtonPress-1>", self._ao_clicar)
+        for seq in ("<MouseWheel>", "<Button-4>", "<Button-5>"): tree.bind(seq, self._ao_rolar_roda)
+        for seq, passo in (("<Up>", -1), ("<Down>", 1)): tree.bind(seq, lambda e, p=passo: self._ao_teclar(e, p))
+        for seq, passo in (("<Prior>", -1), ("<Next>", 1)): tree.bind(seq, lambda e, p=passo: (self.rolar(p * self.visiveis), "break")[1])
+        tree.bind("<Home>", lambda e: (self.rolar(-len(self.linhas)), "break")[1]); tree.bind("<End>", lambda e: (self.rolar(len(self.linhas)), "break")[1])
+
+    def __contains__(self, id_linha): return id_linha in self._presentes
+    def __len__(self): return len(self.linhas)
+
+    # --- Dados ---
+    def definir_linhas(self, linhas):
+        self.linhas = list(linhas); self._presentes = set(self.linhas); self.selecionados &= self._presentes
+        self.offset = min(self.offset, max(0, len(self.linhas) - self.visiveis)); self.renderizar()
+
+    def inserir(self, pos, id_linha): self.linhas.insert(pos, id_linha); self._presentes.add(id_linha)
+
+    def remover(self, id_linha, pos=None):
+        if pos is None or pos >= len(self.linhas) or self.linhas[pos] != id_linha: pos = self.linhas.index(id_linha)
+        del self.linhas[pos]; self._presentes.discard(id_linha); self.selecionados.discard(id_linha)
+
+    def agrupar(self, ids, indice):
+        """Junta as linhas 'ids' (na ordem dada) num bloco contíguo em volta de 'indice' e devolve onde o bloco começa."""
+        bloco = set(ids); inicio = indice - sum(1 for i in self.linhas[:indice] if i in bloco)
+        resto = [i for i in self.linhas if i not in bloco]; self.linhas = resto[:inicio] + list(ids) + resto[inicio:]; self._colapsar = None
+        return inicio
+
+    def mover_bloco(self, de, tamanho, para):
+        """Move as 'tamanho' linhas contíguas que começam em 'de' para começarem em 'para'."""
+        bloco = self.linhas[de:de + tamanho]; del self.linhas[de:de + tamanho]; self.linhas[para:para] = bloco; self.renderizar()
+
+    def soltar(self):
+        """Fim de um clique sem arrasto: conclui a seleção única adiada por _ao_clicar."""
+        if self._colapsar is not None: self.selecionar([self._colapsar]); self._colapsar = None
+
+    def ordenar(self, key, reverse=False): self.linhas.sort(key=key, reverse=reverse); self.renderizar()
+
+    # --- Seleção ---
+    def selecao(self):
+        """Ids selecionados na ordem de exibição."""
+        if len(self.selecionados) <= 1: return list(self.selecionados)
+        return [i for i in self.linhas if i in self.selecionados]
+
+    def selecionar(self, ids):
+        self.selecionados = set(ids) & self._presentes; self.renderizar(); self.tree.event_generate("<<TreeviewSelect>>")
+
+    def indice_em(self, y):
+        """Índice virtual da linha sob a coordenada y, ou None."""
+        if not (item := self.tree.identify_row(y)) or item not in self.pool: return None
+        indice = self.offset + self.pool.index(item)
+        return indice if indice < len(self.linhas) else None
+
+    def _ao_clicar(self, e):
+        if self.tree.identify_region(e.x, e.y) not in ("cell", "tree"): return  # Cabeçalho/separador: comportamento padrão.
+        self.tree.focus_set()
+        if (indice := self.indice_em(e.y)) is None: return "break"
+        id_linha = self.linhas[indice]
+        if self.multipla and e.state & 0x0001 and self.ancora is not None:
+            ini, fim = sorted((self.ancora, indice)); self.selecionados = set(self.linhas[ini:fim + 1])
+        elif self.multipla and e.state & 0x0004:
+            self.selecionados ^= {id_linha}; self.ancora = indice
+        elif len(self.selecionados) > 1 and id_linha in self.selecionados: self._colapsar = id_linha; self.ancora = indice  # Pode ser o início de um arrasto do bloco.
+        else: self.selecionados = {id_linha}; self.ancora = indice
+        self.renderizar(); self.tree.event_generate("<<TreeviewSelect>>")
+        if self.ao_pressionar: self.ao_pressionar(e, indice)
+        return "break"
+
+    def _ao_teclar(self, e, passo):
+        if not self.linhas: return "break"
+        indice = max(0, min(len(self.linhas) - 1, (self.ancora if self.ancora is not None else -passo) + passo))
+        self.ancora = indice; self.selecionados = {self.linhas[indice]}; self.garantir_visivel(indice); self.tree.event_generate("<<TreeviewSelect>>")
+        return "break"
+
+    # --- Rolagem e renderização ---
+    def garantir_visivel(self, indice):
+        if indice < self.offset: self.offset = indice
+        elif indice >= self.offset + self.visiveis: self.offset = indice - self.visiveis + 1
+        self.renderizar()
+
+    def rolar(self, linhas):
+        self.offset = max(0, min(self.offset + linhas, max(0, len(self.linhas) - self.visiveis))); self.renderizar()
+
+    def yview(self, *args):
+        if not args: return
+        if args[0] == "moveto": self.offset = int(float(args[1]) * len(self.linhas)); self.rolar(0)
+        elif args[0] == "scroll": self.rolar(int(args[1]) * (self.visiveis if args[2] == "pages" else 1))
+
+    def _ao_rolar_roda(self, e):
+        if e.num == 4: passo = -3
+        elif e.num == 5: passo = 3
+        else: passo = -3 if e.delta > 0 else 3
+        self.rolar(passo); return "break"
+
+    def _ao_redimensionar(self, e=None):
+        altura_linha = int(ttk.Style(self.tree).lookup("Treeview", "rowheight") or 20)
+        topo = self.tree.bbox(self.pool[0])[1] if self.pool and self.tree.bbox(self.pool[0]) else altura_linha
+        self.visiveis = max(1, (self.tree.winfo_height() - topo) // altura_linha); self.rolar(0)
+
+    @metricas.medido("tabela.renderizar")
+    def renderizar(self):
+        if self.pre_carregar: self.pre_carregar(self.linhas, self.offset)
+        for k in range(len(self.pool), self.visiveis + self.BUFFER): self.pool.append(self.tree.insert("", tk.END, iid=f"V{k}"))
+        sel_pool = []
+        for k, item in enumerate(self.pool):
+            indice = self.offset + k
+            if k >= self.visiveis + self.BUFFER or indice >= len(self.linhas): self.tree.detach(item); continue
+            id_linha = self.linhas[indice]; valores, tag = self.valores_de(id_linha)
+            self.tree.item(item, values=valores, tags=(tag,) if tag else ()); self.tree.move(item, "", k)  # move reanexa itens desanexados
+            if id_linha in self.selecionados: sel_pool.append(item)
+        self.tree.selection_set(sel_pool)
+        total = len(self.linhas); metricas.contar("linhas_renderizadas", max(0, min(self.visiveis + self.BUFFER, total - self.offset)))
+        self.scrollbar.set(*((self.offset / total, min(1.0, (self.offset + self.visiveis) / total)) if total else (0.0, 1.0)))
+
 # --- Classe Principal ---
 class GerenciadorChaves(tk.Tk):
     def __init__(self):
+        self.tempos_inicio, self._ultimo_tempo, self._carga_pendente = [], _INICIO_PROCESSO, None; self._marcar_tempo("Importações")
         super().__init__(); self.title(f"Gerenciador de Chaves v{APP_VERSION} - por Vinícius Leão")
-        self.state('zoomed'); self.resizable(True, True)
-        init_db(); verificar_e_migrar_schema(); migrar_de_json_para_sqlite(); self.migrar_canais_para_tabela()
+        self.state('zoomed'); self.resizable(True, True); self._marcar_tempo("Janela Tk")
+        init_db()
+        try: verificar_e_migrar_schema()
+        except sqlite3.Error as e: messagebox.showerror("Erro de Banco de Dados", f"Não foi possível atualizar o banco de dados para a nova versão.\nErro: {e}"); sys.exit(1)
+        if migrar_de_json_para_sqlite(confirmar=lambda: messagebox.askyesno("Migração de Dados Detectada", "Arquivos .json antigos foram encontrados. Deseja migrar os dados?")): messagebox.showinfo("Atualização", "Dados migrados com sucesso!")
+        instalar_journal_undo()
+        self.motor_busca, self._busca_pendente, self._busca_aplicada = MotorBusca(instalar_indice_busca()), None, None
+        limiar = db.consultar_valor(f"SELECT COUNT(*) FROM (SELECT 1 FROM chaves LIMIT {MODO_CONSULTA_LIMIAR + 1})")
+        self.modo_consulta, self._ordem_sql = limiar > MODO_CONSULTA_LIMIAR, None; self._marcar_tempo("Banco de dados e migrações")
         self.is_manually_sorted, self.drag_data = True, {"item": None}
-        self.configurar_tema_escuro(); self.carregar_dados_do_db()
-        self.email_subject_pt = "Seu Pedido de Chave(s) de Ativação"
-        self.email_subject_en = "Your Activation Key(s) Order"
-        self.email_subject_es = "Su Pedido de Clave(s) de Activación"
+        self.configurar_tema_escuro(); self.carregar_dados_do_db(progressivo=True); self._marcar_tempo("Primeira página do estoque")
+        self.email_subject_pt, self.email_subject_en, self.email_subject_es = ASSUNTOS_EMAIL["pt_br"], ASSUNTOS_EMAIL["en_us"], ASSUNTOS_EMAIL["es_es"]
         self.criar_menus(); self.criar_widgets()
-        self.atualizar_tabela(); self.atualizar_status_bar(); self.atualizar_menus_undo_redo()
+        self.atualizar_tabela(); self.atualizar_status_bar(); self.atualizar_menus_undo_redo(); self._marcar_tempo("Interface")
+        self.servico_pdf = ServicoPDF(); self.servico_cotacao = ServicoCotacao(); self.fila_email = FilaEmail(); self.fila_email.iniciar(); self._atualizar_status_email(); self.after(500, self._processar_eventos_email)
+        self.agendador_backup = AgendadorBackup(); self._backup_manual = False; self.agendador_backup.iniciar(); self.after(1000, self._processar_eventos_backup)
+        self.after_idle(self._marcar_tempo, "Janela exibida")
         if not PDF_DISPONIVEL: messagebox.showwarning("Biblioteca Faltando", "A biblioteca 'reportlab' não foi encontrada.\nA funcionalidade de gerar PDF estará desativada.\n\nInstale com: pip install reportlab")
-        # --- NOVO: Verificação da biblioteca pandas ---
-        if not PANDAS_DISPONIVEL: messagebox.showwarning("Biblioteca Faltando", "A biblioteca 'pandas' não foi encontrada.\nA funcionalidade de importar de XLS/XLSX estará desativada.\n\nInstale com: pip install pandas xlrd openpyxl")
-
-    def migrar_canais_para_tabela(self):
-        conn = sqlite3.connect(DB_NAME); cursor = conn.cursor()
-        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='canais_venda'")
-        if cursor.fetchone():
-            cursor.execute("SELECT DISTINCT canal_venda FROM chaves WHERE canal_venda IS NOT NULL AND canal_venda != ''")
-            canais_existentes = [row[0] for row in cursor.fetchall()]
-            if canais_existentes: cursor.executemany("INSERT OR IGNORE INTO canais_venda (nome) VALUES (?)", [(c,) for c in canais_existentes])
-            conn.commit()
-        conn.close()
-
-    def carregar_dados_do_db(self):
-        conn = sqlite3.connect(DB_NAME); conn.row_factory = sqlite3.Row; cursor = conn.cursor()
-        self.estoque = [dict(row) for row in cursor.execute("SELECT * FROM chaves").fetchall()]
-        for item in self.estoque: item['tree_id'] = f"I{item['id']:08X}"
-        self.categorias = [dict(row) for row in cursor.execute("SELECT * FROM categorias").fetchall()]
-        conn.close(); self._atualizar_estoque_dict()
+        if not OPENPYXL_DISPONIVEL: messagebox.showwarning("Biblioteca Faltando", "A biblioteca 'openpyxl' não foi encontrada.\nA importação de XLSX estará desativada (CSV/TXT continuam disponíveis).\n\nInstale com: pip install openpyxl xlrd")
+
+    @metricas.medido("estoque.carregar")
+    def carregar_dados_do_db(self, progressivo=False):
+        """Recarrega o modelo. progressivo=True (início do app) lê só a primeira página na ordem de exibição e
+        agenda o restante em lotes, para a janela aparecer sem esperar o estoque inteiro."""
+        if self._carga_pendente: self.after_cancel(self._carga_pendente); self._carga_pendente = None
+        progressivo &= not self.modo_consulta
+        if self.modo_consulta: self.estoque = EstoquePaginado(); self.motor_busca.carregar(())
+        else:
+            colunas = ", ".join(COLUNAS_ESTOQUE)
+            self.estoque = EstoqueCompacto().carregar(db.conexao().execute(f"SELECT {colunas} FROM chaves ORDER BY ordem_manual, id LIMIT {CARGA_PRIMEIRA_PAGINA}" if progressivo else f"SELECT {colunas} FROM chaves ORDER BY id"))
+            self.motor_busca.carregar_textos(self.estoque.textos_busca()); metricas.contar("linhas_carregadas", len(self.estoque))
+        self.categorias = [dict(row) for row in db.consultar("SELECT * FROM categorias")]
+        self._atualizar_estoque_dict()
+        if progressivo: self._carga_pendente = self.after(1, self._carregar_proximo_lote, 0)
+
+    @metricas.medido("estoque.lote")
+    def _carregar_proximo_lote(self, ultimo_id):
+        """Traz o restante do estoque por faixas de id, cedendo o loop do Tk entre os lotes. Linhas que já estão no
+        modelo (primeira página ou escritas feitas nesse meio tempo) são mantidas como estão."""
+        linhas = db.consultar(f"SELECT {', '.join(COLUNAS_ESTOQUE)} FROM chaves WHERE id > ? ORDER BY id LIMIT ?", (ultimo_id, CARGA_LOTE)); metricas.contar("linhas_carregadas", len(linhas))
+        for id_chave in self.estoque.acrescentar(linhas): self.motor_busca.atualizar(self.estoque[id_chave])
+        if len(linhas) == CARGA_LOTE: self._carga_pendente = self.after(1, self._carregar_proximo_lote, linhas[-1][0]); self.atualizar_status_bar(); return
+        self._carga_pendente = None; self.atualizar_tabela(); self._marcar_tempo("Restante do estoque")
+        logar_acao(f"Inicialização: janela em {self._tempo_ate('Janela exibida'):.0f} ms, estoque completo ({len(self.estoque)} chaves) em {self._tempo_ate('Restante do estoque'):.0f} ms.")
+
+    # --- Tempos de inicialização ---
+    def _marcar_tempo(self, etapa):
+        agora = time.perf_counter(); self.tempos_inicio.append((etapa, (agora - self._ultimo_tempo) * 1000)); self._ultimo_tempo = agora
+
+    def _tempo_ate(self, etapa):
+        total = 0.0
+        for nome, ms in self.tempos_inicio:
+            total += ms
+            if nome == etapa: break
+        return total
+
+    def mostrar_tempos_inicializacao(self):
+        linhas = [f"{etapa}: {ms:.1f} ms" for etapa, ms in self.tempos_inicio]
+        messagebox.showinfo("Tempos de Inicialização", "\n".join(linhas + ["", f"Total: {sum(ms for _, ms in self.tempos_inicio):.1f} ms"]), parent=self)
+
+    # --- Desempenho ---
+    def janela_desempenho(self):
+        """Latências p50/p95 por ação e contadores (ver nucleo.Metricas), atualizados a cada segundo enquanto a janela está aberta."""
+        popup = tk.Toplevel(self); popup.title("Desempenho"); popup.geometry("760x480"); popup.configure(bg=self.bg_color)
+        frame_tree = ttk.Frame(popup, style="TFrame"); frame_tree.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
+        colunas = ("acao", "n", "p50", "p95", "max", "media"); tree = ttk.Treeview(frame_tree, columns=colunas, show="headings")
+        for c, t, w in zip(colunas, ("Ação", "Chamadas", "p50 (ms)", "p95 (ms)", "Máx. (ms)", "Média (ms)"), (220, 80, 90, 90, 90, 90)): tree.heading(c, text=t); tree.column(c, width=w, anchor=tk.W if c == "acao" else tk.E)
+        scrollbar = ttk.Scrollbar(frame_tree, orient="vertical", command=tree.yview); tree.configure(yscrollcommand=scrollbar.set); scrollbar.pack(side=tk.RIGHT, fill=tk.Y); tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        contadores_var = tk.StringVar(); ttk.Label(popup, textvariable=contadores_var, wraplength=720).pack(anchor="w", padx=10)
+        def carregar():
+            if not popup.winfo_exists(): return
+            tree.delete(*tree.get_children())
+            for r in metricas.resumo(): tree.insert("", tk.END, values=(r["acao"], r["n"], *(f"{r[c]:.1f}" for c in ("p50", "p95", "max", "media"))))
+            contadores_var.set("   ".join(f"{nome}: {valor:,}" for nome, valor in sorted(metricas.contagens().items())) or "Nenhum contador ainda.")
+            popup.after(1000, carregar)
+        def exportar():
+            if caminho := filedialog.asksaveasfilename(parent=popup, defaultextension=".json", initialfile=f"metricas_{datetime.now():%Y%m%d_%H%M%S}.json", filetypes=[("JSON (com amostras)", "*.json"), ("CSV (resumo)", "*.csv")]):
+                try: metricas.exportar(caminho); messagebox.showinfo("Desempenho", f"Métricas exportadas para:\n{caminho}", parent=popup)
+                except OSError as e: messagebox.showerror("Desempenho", f"Não foi possível exportar.\nErro: {e}", parent=popup)
+        fb = ttk.Frame(popup, style="TFrame"); fb.pack(pady=10)
+        ttk.Button(fb, text="Exportar...", command=exportar).pack(side=tk.LEFT, padx=5); ttk.Button(fb, text="Zerar", command=lambda: (metricas.limpar(), tree.delete(*tree.get_children()))).pack(side=tk.LEFT, padx=5); ttk.Button(fb, text="Fechar", command=popup.destroy).pack(side=tk.LEFT, padx=5)
+        carregar()
+
+    def alternar_perfil(self):
+        """Liga/desliga o cProfile na thread da interface; ao desligar grava o .prof e um resumo .txt em PERFIL_DIR."""
+        if self.perfil_var.get(): metricas.iniciar_perfil(); return
+        try: caminho = metricas.parar_perfil()
+        except OSError as e: messagebox.showerror("Perfil", f"Não foi possível gravar o perfil.\nErro: {e}"); return
+        if caminho: logar_acao(f"Perfil gravado em {caminho}", "perfil"); messagebox.showinfo("Perfil", f"Perfil gravado em:\n{caminho}\n\nResumo (funções mais caras): {caminho[:-5]}.txt")
+
+    def _carregar_categorias(self):
+        self.categorias = [dict(row) for row in db.consultar("SELECT * FROM categorias")]
+        self.categoria_dict = {cat['nome']: cat for cat in self.categorias}
 
     def _get_lista_canais_venda(self):
-        conn = sqlite3.connect(DB_NAME); cursor = conn.cursor()
-        cursor.execute("SELECT nome FROM canais_venda ORDER BY nome"); nomes = [row[0] for row in cursor.fetchall()]
-        conn.close(); return nomes
+        return [row[0] for row in db.consultar("SELECT nome FROM canais_venda ORDER BY nome")]
 
     def _garantir_canal_venda_existe(self, nome_canal):
         if not nome_canal or not nome_canal.strip(): return
-        nome_canal = nome_canal.strip(); conn = sqlite3.connect(DB_NAME); cursor = conn.cursor()
-        cursor.execute("INSERT OR IGNORE INTO canais_venda (nome) VALUES (?)", (nome_canal,)); conn.commit(); conn.close()
+        db.executar("INSERT OR IGNORE INTO canais_venda (nome) VALUES (?)", (nome_canal.strip(),))
 
     def _atualizar_estoque_dict(self):
-        self.estoque_dict = {item['chave']: item for item in self.estoque}
-        self.tree_id_map = {item['tree_id']: item for item in self.estoque}
+        self.estoque_dict, self.tree_id_map = self.estoque.por_chave, self.estoque.por_tree_id  # Índices do próprio estoque, sem cópias.
         self.categoria_dict = {cat['nome']: cat for cat in self.categorias}
 
+    def _linhas_disponiveis(self):
+        return [f"I{row[0]:08X}" for row in db.consultar("SELECT id FROM chaves WHERE vendida = 0 ORDER BY categoria, id")]
+
+    def alternar_modo_consulta(self):
+        self.modo_consulta = self.modo_consulta_var.get(); self.salvar_e_atualizar_tudo()
+
+    def _pre_carregar_pagina(self, linhas, offset):
+        if not self.modo_consulta: return
+        ini = offset - offset % EstoquePaginado.PAGINA  # Página atual e a seguinte: rolar não consulta o BD a cada linha.
+        self.estoque.carregar([int(tid[1:], 16) for tid in linhas[ini:ini + 2 * EstoquePaginado.PAGINA]])
+
     def salvar_e_atualizar_tudo(self):
         self.carregar_dados_do_db(); self.atualizar_combo_categoria()
         self.atualizar_combo_canal_venda(); self.atualizar_tabela(); self.atualizar_menus_undo_redo()
 
-    def registrar_undo(self):
-        if os.path.exists(DB_NAME): shutil.copy2(DB_NAME, UNDO_FILE)
-        if os.path.exists(REDO_FILE): os.remove(REDO_FILE)
-        self.atualizar_menus_undo_redo()
+    def aplicar_mudancas(self, mud):
+        """Atualiza índices em memória e a tabela virtual apenas para as linhas do ConjuntoMudancas (O(linhas alteradas))."""
+        if mud.categorias: self._carregar_categorias(); self.atualizar_combo_categoria()
+        if mud.canais: self.atualizar_combo_canal_venda()
+        if self.modo_consulta:  # Sem modelo em memória: descarta do cache as linhas tocadas e refaz a consulta.
+            self.estoque.invalidar(mud.removidos | mud.inseridos | mud.atualizados); self._consultar_tabela()
+            self.atualizar_status_bar(); self.atualizar_menus_undo_redo(); return
+        for id_chave in mud.removidos: self._remover_item_modelo(id_chave)
+        ids, encontrados = list(mud.inseridos | mud.atualizados), set()
+        for i in range(0, len(ids), 500):
+            lote = ids[i:i + 500]
+            for row in db.consultar(f"SELECT * FROM chaves WHERE id IN ({','.join('?' * len(lote))})", lote):
+                encontrados.add(row['id']); self._gravar_item_modelo(dict(row))
+        for id_chave in set(ids) - encontrados: self._remover_item_modelo(id_chave)
+        self.tabela.renderizar(); self.atualizar_status_bar(); self.atualizar_menus_undo_redo()
+
+    def _gravar_item_modelo(self, dados):
+        ordem_antiga = self._chave_ordem(item) if (item := self.estoque.get(dados['id'])) else None
+        item = self.estoque.gravar(dados)  # Atualiza no lugar: itens já entregues (popups, seleção) leem os valores novos.
+        self.motor_busca.atualizar(item); self._atualizar_linha_tree(item, ordem_antiga)
+
+    def _remover_item_modelo(self, id_chave):
+        if not (item := self.estoque.get(id_chave)): return
+        self._remover_linha_tree(item); self.estoque.remover(id_chave); self.motor_busca.remover(id_chave)
 
     def desfazer(self, event=None):
-        if not os.path.exists(UNDO_FILE): messagebox.showinfo("Desfazer", "Nenhuma ação para desfazer."); return
-        shutil.copy2(DB_NAME, REDO_FILE); shutil.copy2(UNDO_FILE, DB_NAME); os.remove(UNDO_FILE)
-        self.salvar_e_atualizar_tudo(); logar_acao("Ação 'desfazer' executada."); messagebox.showinfo("Desfazer", "A última ação foi desfeita.")
+        try: mud = desfazer_passo()
+        except ValueError as e: self.atualizar_menus_undo_redo(); messagebox.showwarning("Desfazer", f"A última ação não pode mais ser desfeita.\n\n{e}"); return
+        if mud is None: messagebox.showinfo("Desfazer", "Nenhuma ação para desfazer."); return
+        self.aplicar_mudancas(mud); logar_acao("Ação 'desfazer' executada.", "desfazer"); messagebox.showinfo("Desfazer", "A última ação foi desfeita.")
 
     def refazer(self, event=None):
-        if not os.path.exists(REDO_FILE): messagebox.showinfo("Refazer", "Nenhuma ação para refazer."); return
-        shutil.copy2(DB_NAME, UNDO_FILE); shutil.copy2(REDO_FILE, DB_NAME); os.remove(REDO_FILE)
-        self.salvar_e_atualizar_tudo(); logar_acao("Ação 'refazer' executada."); messagebox.showinfo("Refazer", "Ação refeita com sucesso.")
+        try: mud = refazer_passo()
+        except ValueError as e: self.atualizar_menus_undo_redo(); messagebox.showwarning("Refazer", f"A ação não pode mais ser refeita.\n\n{e}"); return
+        if mud is None: messagebox.showinfo("Refazer", "Nenhuma ação para refazer."); return
+        self.aplicar_mudancas(mud); logar_acao("Ação 'refazer' executada.", "refazer"); messagebox.showinfo("Refazer", "Ação refeita com sucesso.")
 
     def atualizar_menus_undo_redo(self):
-        self.menu_editar.entryconfig("Desfazer", state="normal" if os.path.exists(UNDO_FILE) else "disabled")
-        self.menu_editar.entryconfig("Refazer", state="normal" if os.path.exists(REDO_FILE) else "disabled")
+        n_undo, n_redo = contar_passos_undo()
+        self.menu_editar.entryconfig("Desfazer", state="normal" if n_undo else "disabled")
+        self.menu_editar.entryconfig("Refazer", state="normal" if n_redo else "disabled")
 
     def configurar_tema_escuro(self):
         style = ttk.Style(self); style.theme_use("clam")
@@ -362,19 +363,22 @@ class GerenciadorChaves(tk.Tk):
         menubar = tk.Menu(self, **self.menu_style); self.config(menu=menubar)
         menu_arquivo = tk.Menu(menubar, **self.menu_style)
         # --- NOVO: Comando de importação ---
-        menu_arquivo.add_command(label="Importar Chaves de XLS...", command=self.janela_importar_xls, state="normal" if PANDAS_DISPONIVEL else "disabled")
+        menu_arquivo.add_command(label="Importar Chaves de Arquivo (XLS/CSV/TXT)...", command=self.janela_importar_xls)
         menu_arquivo.add_command(label="Exportar Estoque", command=self.exportar_estoque); menu_arquivo.add_separator(); menu_arquivo.add_command(label="Sair", command=self.quit)
         self.menu_editar = tk.Menu(menubar, **self.menu_style); self.menu_editar.add_command(label="Desfazer", command=self.desfazer, accelerator="Ctrl+Z"); self.menu_editar.add_command(label="Refazer", command=self.refazer, accelerator="Ctrl+Y"); self.menu_editar.add_separator(); self.menu_editar.add_command(label="Copiar Chave(s)", command=self.copiar_chave_selecionada, accelerator="Ctrl+C"); self.menu_editar.add_command(label="Editar Chave(s)", command=self.acao_editar_selecao, accelerator="F2"); self.menu_editar.add_command(label="Excluir Chave(s)", command=self.excluir_chave_selecionada, accelerator="Delete")
         menu_exibir = tk.Menu(menubar, **self.menu_style); menu_exibir.add_command(label="Atualizar Tabela", command=lambda: self.salvar_e_atualizar_tudo(), accelerator="F5")
+        self.modo_consulta_var = tk.BooleanVar(value=self.modo_consulta); menu_exibir.add_checkbutton(label="Modo Consulta (SQL paginado)", variable=self.modo_consulta_var, command=self.alternar_modo_consulta)
         menu_ferramentas = tk.Menu(menubar, **self.menu_style)
         menu_ferramentas.add_command(label="Entregar Chave Única...", command=self.janela_entregar_chave_fluxo_antigo)
         menu_ferramentas.add_command(label="Entregar Várias Chaves...", command=self.janela_entregar_varias_chaves)
+        menu_ferramentas.add_command(label="Entregar Lote de Pedidos (CSV)...", command=self.janela_entrega_lote)
         menu_ferramentas.add_separator(); menu_ferramentas.add_command(label="Gerenciar Categorias...", command=self.janela_gerenciar_categorias)
         menu_ferramentas.add_command(label="Gerenciar Canais de Venda...", command=self.janela_gerenciar_canais_venda)
         menu_ferramentas.add_command(label="Dashboard de Vendas...", command=self.janela_dashboard_vendas)
-        menu_ferramentas.add_separator(); menu_ferramentas.add_command(label="Configurar Email...", command=self.janela_configurar_email); menu_ferramentas.add_separator()
+        menu_ferramentas.add_separator(); menu_ferramentas.add_command(label="Configurar Email...", command=self.janela_configurar_email); menu_ferramentas.add_command(label="Fila de Emails...", command=self.janela_fila_email); menu_ferramentas.add_separator()
         menu_ferramentas.add_command(label="Fazer Backup do BD", command=self.fazer_backup_db)
-        menu_ajuda = tk.Menu(menubar, **self.menu_style); menu_ajuda.add_command(label=f"Notas da Versão v{APP_VERSION}", command=self.mostrar_notas_atualizacao); menu_ajuda.add_separator(); menu_ajuda.add_command(label="Sobre", command=lambda: messagebox.showinfo("Sobre", f"Gerenciador de Chaves v{APP_VERSION}\n\nDesenvolvido por Vinícius Leão."))
+        menu_ajuda = tk.Menu(menubar, **self.menu_style); menu_ajuda.add_command(label=f"Notas da Versão v{APP_VERSION}", command=self.mostrar_notas_atualizacao); menu_ajuda.add_command(label="Tempos de Inicialização", command=self.mostrar_tempos_inicializacao)
+        self.perfil_var = tk.BooleanVar(value=False); menu_ajuda.add_command(label="Desempenho...", command=self.janela_desempenho); menu_ajuda.add_checkbutton(label="Capturar Perfil (cProfile)", variable=self.perfil_var, command=self.alternar_perfil); menu_ajuda.add_separator(); menu_ajuda.add_command(label="Sobre", command=lambda: messagebox.showinfo("Sobre", f"Gerenciador de Chaves v{APP_VERSION}\n\nDesenvolvido por Vinícius Leão."))
         menubar.add_cascade(label="Arquivo", menu=menu_arquivo); menubar.add_cascade(label="Editar", menu=self.menu_editar); menubar.add_cascade(label="Exibir", menu=menu_exibir); menubar.add_cascade(label="Ferramentas", menu=menu_ferramentas); menubar.add_cascade(label="Ajuda", menu=menu_ajuda)
         self.bind_all("<Control-z>", self.desfazer); self.bind_all("<Control-y>", self.refazer); self.bind_all("<Control-c>", self.copiar_chave_selecionada); self.bind_all("<Delete>", self.excluir_chave_selecionada); self.bind_all("<F5>", lambda e: self.salvar_e_atualizar_tudo()); self.bind_all("<F2>", self.acao_editar_selecao)
 
@@ -382,15 +386,26 @@ class GerenciadorChaves(tk.Tk):
         messagebox.showinfo(f"Notas da Versão v{APP_VERSION}",
         f"v{APP_VERSION} - Importação de Chaves de Planilhas (XLS/XLSX)\n\n"
         "- **NOVO: Importação Direta de Arquivos Excel!** Agora você pode importar chaves diretamente de arquivos .xls e .xlsx, como os que recebe de seus fornecedores.\n\n"
-        "- **Como usar:** Vá em `Arquivo` > `Importar Chaves de XLS...`.\n\n"
+        "- **Como usar:** Vá em `Arquivo` > `Importar Chaves de Arquivo (XLS/CSV/TXT)...`.\n\n"
         "- **Janela de Configuração:** Após selecionar o arquivo, uma janela pedirá para você especificar a coluna (ex: B), a linha de início (ex: 4) e a categoria para as novas chaves.\n\n"
         "- **Validação Automática:** O sistema evita a importação de chaves duplicadas, garantindo a integridade do seu estoque.\n\n"
-        "- **Dependência:** Esta função requer a biblioteca 'pandas'. Se não estiver instalada, o programa avisará e a opção de menu ficará desabilitada. (Instale com: pip install pandas xlrd openpyxl)")
+        "- **Dependência:** Planilhas .xlsx usam a biblioteca 'openpyxl' e .xls a 'xlrd'. Sem elas, o programa avisa e só CSV/TXT podem ser importados. (Instale com: pip install openpyxl xlrd)")
     
     def fazer_backup_db(self):
-        os.makedirs(BACKUP_DIR, exist_ok=True); nome_backup = f"backup_db_{datetime.now():%Y%m%d_%H%M%S}.db"; caminho_backup = os.path.join(BACKUP_DIR, nome_backup)
-        if os.path.exists(DB_NAME): shutil.copy2(DB_NAME, caminho_backup); messagebox.showinfo("Backup", f"Backup criado em:\n{caminho_backup}")
-        else: messagebox.showwarning("Backup", "Banco de dados não encontrado.")
+        """Pede um backup imediato ao agendador (a cópia roda na thread dele; o resultado chega por _processar_eventos_backup)."""
+        if not os.path.exists(DB_NAME): messagebox.showwarning("Backup", "Banco de dados não encontrado."); return
+        self._backup_manual = True; self.agendador_backup.agora(); self._atualizar_status_email("Backup em andamento...")
+
+    def _processar_eventos_backup(self):
+        try:
+            while True:
+                tipo, detalhe = self.agendador_backup.eventos.get_nowait(); manual, self._backup_manual = self._backup_manual, False
+                if tipo == 'backup':
+                    self._atualizar_status_email(f"Backup criado ({datetime.now():%H:%M}).")
+                    if manual: messagebox.showinfo("Backup", f"Backup criado e verificado em:\n{os.path.abspath(detalhe['caminho'])}\n\n{detalhe['bytes'] / 2**20:.1f} MiB em {detalhe['segundos']:.1f} s.", parent=self)
+                else: self._atualizar_status_email(); messagebox.showerror("Backup", f"Não foi possível criar o backup.\n\nErro: {detalhe}", parent=self)
+        except queue.Empty: pass
+        self.after(1000, self._processar_eventos_backup)
 
     def criar_widgets(self):
         frame_top = ttk.Frame(self); frame_top.pack(fill=tk.X, padx=10, pady=10)
@@ -403,37 +418,56 @@ class GerenciadorChaves(tk.Tk):
         self.combo_canal_venda.pack(side=tk.RIGHT, padx=(5,0)); ttk.Label(frame_filtros, text="Canal:").pack(side=tk.RIGHT)
         self.combo_categoria.pack(side=tk.RIGHT, padx=(5,0)); ttk.Label(frame_filtros, text="Categoria:").pack(side=tk.RIGHT)
         entry_busca.pack(side=tk.RIGHT, fill=tk.X, expand=True); ttk.Label(frame_filtros, text="Buscar:").pack(side=tk.RIGHT, padx=(10, 2))
-        entry_busca.bind("<KeyRelease>", lambda e: self.atualizar_tabela()); self.combo_categoria.bind("<<ComboboxSelected>>", lambda e: self.atualizar_tabela()); self.combo_canal_venda.bind("<<ComboboxSelected>>", lambda e: self.atualizar_tabela()); self.status_var.trace_add("write", lambda *args: self.atualizar_tabela()); self.atualizar_combo_categoria(); self.atualizar_combo_canal_venda()
+        entry_busca.bind("<KeyRelease>", self._agendar_busca); self.combo_categoria.bind("<<ComboboxSelected>>", lambda e: self.atualizar_tabela()); self.combo_canal_venda.bind("<<ComboboxSelected>>", lambda e: self.atualizar_tabela()); self.status_var.trace_add("write", lambda *args: self.atualizar_tabela()); self.atualizar_combo_categoria(); self.atualizar_combo_canal_venda()
         ttk.Separator(self, orient='horizontal').pack(fill='x', padx=10, pady=(0, 5))
         frame_tree = ttk.Frame(self); frame_tree.pack(fill=tk.BOTH, expand=True, padx=10, pady=0)
-        colunas = ("chave", "categoria", "status", "comprador", "canal_venda", "data_venda"); self.tree = ttk.Treeview(frame_tree, columns=colunas, show="headings", selectmode="extended"); yscrollbar = ttk.Scrollbar(frame_tree, orient="vertical", command=self.tree.yview); self.tree.configure(yscrollcommand=yscrollbar.set); yscrollbar.pack(side=tk.RIGHT, fill=tk.Y); self.tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        colunas = ("chave", "categoria", "status", "comprador", "canal_venda", "data_venda"); self.tree = ttk.Treeview(frame_tree, columns=colunas, show="headings", selectmode="extended"); yscrollbar = ttk.Scrollbar(frame_tree, orient="vertical"); yscrollbar.pack(side=tk.RIGHT, fill=tk.Y); self.tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
         headings = {"chave": "Chave", "categoria": "Categoria", "status": "Status", "comprador": "Comprador", "canal_venda": "Canal de Venda", "data_venda": "Data da Venda"}; [self.tree.heading(c, text=t, command=lambda c=c: self.ordenar_por(c)) for c,t in headings.items()]
         col_widths = {"chave": 350, "categoria": 180, "status": 100, "comprador": 150, "canal_venda": 120, "data_venda": 160}; [self.tree.column(c, width=w, anchor=tk.W) for c,w in col_widths.items()]
-        self.tree.bind("<Double-1>", self.on_double_click_edit); self.tree.bind("<Button-3>", self.menu_contexto_tree); self.tree.bind("<<TreeviewSelect>>", self.atualizar_status_bar); self.tree.bind("<ButtonPress-1>", self.on_drag_start); self.tree.bind("<B1-Motion>", self.on_drag_motion); self.tree.bind("<ButtonRelease-1>", self.on_drag_end)
-        self.status_bar_frame = ttk.Frame(self, style="TFrame"); self.status_bar_frame.pack(side=tk.BOTTOM, fill=tk.X, padx=10, pady=5); self.status_counts_var = tk.StringVar(); ttk.Label(self.status_bar_frame, textvariable=self.status_counts_var).pack(side=tk.LEFT); ttk.Label(self.status_bar_frame, text=f"v{APP_VERSION} - por Vinícius Leão", font=('Segoe UI', 8)).pack(side=tk.RIGHT)
+        self.tabela = TabelaVirtual(self.tree, yscrollbar, lambda tid: self._valores_linha(self.tree_id_map[tid])); self.tabela.ao_pressionar = self.on_drag_start; self.tabela.pre_carregar = self._pre_carregar_pagina
+        self.tree.bind("<Double-1>", self.on_double_click_edit); self.tree.bind("<Button-3>", self.menu_contexto_tree); self.tree.bind("<<TreeviewSelect>>", self.atualizar_status_bar); self.tree.bind("<B1-Motion>", self.on_drag_motion); self.tree.bind("<ButtonRelease-1>", self.on_drag_end)
+        self.status_bar_frame = ttk.Frame(self, style="TFrame"); self.status_bar_frame.pack(side=tk.BOTTOM, fill=tk.X, padx=10, pady=5); self.status_counts_var = tk.StringVar(); ttk.Label(self.status_bar_frame, textvariable=self.status_counts_var).pack(side=tk.LEFT); self.status_email_var = tk.StringVar(); ttk.Label(self.status_bar_frame, textvariable=self.status_email_var).pack(side=tk.LEFT, padx=20); ttk.Label(self.status_bar_frame, text=f"v{APP_VERSION} - por Vinícius Leão", font=('Segoe UI', 8)).pack(side=tk.RIGHT)
 
-    def on_drag_start(self, e):
-        if not self.is_manually_sorted or self.tree.identify_region(e.x, e.y) == "heading": return
-        if (item := self.tree.identify_row(e.y)) and len(self.tree.selection()) <= 1: self.drag_data["item"] = item
+    def on_drag_start(self, e, indice):
+        # Arrasta a linha clicada ou, se ela fizer parte de uma seleção múltipla, a seleção inteira (vira um bloco no primeiro movimento).
+        if self.is_manually_sorted: self.drag_data["item"] = {"indice": indice, "id": self.tabela.linhas[indice], "inicio": None, "tamanho": 1, "deslocamento": 0}
 
     def on_drag_motion(self, e):
-        if not self.drag_data["item"]: return
-        if dest_item := self.tree.identify_row(e.y): self.tree.move(self.drag_data["item"], '', self.tree.index(dest_item))
+        if (arrasto := self.drag_data["item"]) is None: return
+        if e.y < 0: self.tabela.rolar(-1)  # Arrastar além das bordas rola a janela virtual.
+        elif e.y > self.tree.winfo_height(): self.tabela.rolar(1)
+        if (destino := self.tabela.indice_em(max(1, min(e.y, self.tree.winfo_height() - 1)))) is None: return
+        if arrasto["inicio"] is None:
+            if destino == arrasto["indice"]: return
+            ids = self.tabela.selecao() if arrasto["id"] in self.tabela.selecionados else [arrasto["id"]]
+            arrasto.update(inicio=self.tabela.agrupar(ids, arrasto["indice"]), tamanho=len(ids), deslocamento=ids.index(arrasto["id"]))
+        para = max(0, min(destino - arrasto["deslocamento"], len(self.tabela) - arrasto["tamanho"]))
+        if para != arrasto["inicio"]: self.tabela.mover_bloco(arrasto["inicio"], arrasto["tamanho"], para); arrasto["inicio"] = para
 
     def on_drag_end(self, event):
-        if not self.drag_data["item"]: return
-        self.registrar_undo(); self._update_order_in_db(); self.drag_data["item"] = None
-
-    def _update_order_in_db(self):
-        ordered_keys = [(i, self.tree_id_map[iid]['chave']) for i, iid in enumerate(self.tree.get_children()) if iid in self.tree_id_map]
-        if not ordered_keys: return
-        conn = sqlite3.connect(DB_NAME); cursor = conn.cursor()
-        try: cursor.executemany("UPDATE chaves SET ordem_manual = ? WHERE chave = ?", ordered_keys); conn.commit(); logar_acao("Ordem das chaves atualizada.")
-        except Exception as e: conn.rollback(); messagebox.showerror("Erro de DB", f"Não foi possível salvar a ordem: {e}")
-        finally: conn.close(); self.salvar_e_atualizar_tudo()
+        arrasto, self.drag_data["item"] = self.drag_data["item"], None
+        if arrasto is None or arrasto["inicio"] is None: self.tabela.soltar(); return  # Clique sem arrasto.
+        self._update_order_in_db(arrasto["inicio"], arrasto["tamanho"])
+
+    def _update_order_in_db(self, inicio, tamanho):
+        """Grava a nova posição do bloco arrastado (linhas inicio..inicio+tamanho da tabela): só as chaves movidas, mais
+        as vizinhas que mover_chaves precisar reespaçar, em vez de renumerar a tabela inteira."""
+        linhas = self.tabela.linhas; ids = [int(tid[1:], 16) for tid in linhas[inicio:inicio + tamanho]]
+        try:
+            with passo_undo(): novas = mover_chaves(ids, int(linhas[inicio - 1][1:], 16) if inicio else None)
+            logar_acao(f"Ordem manual: {len(ids)} chave(s) movida(s), {len(novas)} linha(s) gravada(s).", "ordem", chaves=ids)
+        except (sqlite3.Error, ValueError) as e: messagebox.showerror("Erro de DB", f"Não foi possível salvar a ordem: {e}"); self.salvar_e_atualizar_tudo(); return
+        # A tabela já está na ordem nova: basta refletir as ordens alteradas no modelo e em _ordens_exibidas (ainda ordenada pelas antigas).
+        if self.modo_consulta: self.estoque.invalidar(list(novas)); self.atualizar_menus_undo_redo(); return
+        for id_chave, ordem in novas.items():
+            if (item := self.estoque.get(id_chave)) is None: continue
+            if exibida := item['tree_id'] in self.tabela: self._descartar_ordem_exibida(chave_ordem(item))
+            item['ordem_manual'] = ordem
+            if exibida: bisect.insort(self._ordens_exibidas, chave_ordem(item))
+        self.atualizar_menus_undo_redo()
 
     def on_double_click_edit(self, e):
-        if len(self.tree.selection()) == 1: self.janela_editar_chave(e)
+        if len(self.tabela.selecionados) == 1: self.janela_editar_chave(e)
 
     def _popup_finalizar_entrega_unica(self, chave_obj):
         popup = tk.Toplevel(self); popup.title("Finalizar Entrega"); popup.geometry("450x700"); popup.resizable(False, False); popup.grab_set(); popup.configure(bg=self.bg_color)
@@ -496,39 +530,40 @@ class GerenciadorChaves(tk.Tk):
             try: preco_brl, preco_usd = float(preco_brl_var.get().replace(",", ".")), float(preco_usd_var.get().replace(",", "."))
             except ValueError: messagebox.showerror("Erro de Formato", "Preços devem ser números.", parent=popup); return
             
-            self.registrar_undo(); data_venda = f"{datetime.now():%Y-%m-%d %H:%M:%S}"
-            conn = sqlite3.connect(DB_NAME); conn.execute("UPDATE chaves SET vendida=1, comprador=?, data_venda=?, preco_venda_brl=?, preco_venda_usd=?, canal_venda=? WHERE id=?", (comprador, data_venda, preco_brl, preco_usd, canal_venda, chave_obj['id'])); conn.commit(); conn.close()
-            self.salvar_e_atualizar_tudo()
+            with metricas.span("entrega.db"), passo_undo(): vendidas, conflitos = vender_chaves([chave_obj['id']], comprador, preco_brl, preco_usd, canal_venda)
+            self.aplicar_mudancas(ConjuntoMudancas(atualizados=[chave_obj['id']], canais=bool(canal_venda)))
+            if conflitos:
+                popup.destroy()
+                messagebox.showwarning("Chave Indisponível", f"A chave '{chave_obj['chave']}' já foi vendida (por outra instância ou processo usando o mesmo banco).\n\nA tabela foi atualizada; escolha outra chave.", parent=self); return
             
-            chave_atualizada = self.estoque_dict.get(chave_obj['chave'])
-            caminho_pdf_gerado, texto_email = None, None
-            acao_selecionada = acao_entrega_var.get()
+            chave_atualizada = vendidas[0]
+            idioma_pdf, acao_selecionada = None, acao_entrega_var.get()
             
             if acao_selecionada == "copiar_chave":
-                pyperclip.copy(chave_atualizada['chave']); messagebox.showinfo("Copiado", "Chave copiada com sucesso!", parent=self)
+                self._copiar_entrega(chave_atualizada['chave']); messagebox.showinfo("Copiado", "Chave copiada com sucesso!", parent=self)
             
             elif acao_selecionada == "copiar_msg_pt":
-                pyperclip.copy(self._construir_mensagem_entrega([chave_atualizada], 'pt_br')); messagebox.showinfo("Copiado", "Mensagem em PT-BR copiada!", parent=self)
+                self._copiar_entrega(self._construir_mensagem_entrega([chave_atualizada], 'pt_br')); messagebox.showinfo("Copiado", "Mensagem em PT-BR copiada!", parent=self)
             elif acao_selecionada == "copiar_msg_en":
-                pyperclip.copy(self._construir_mensagem_entrega([chave_atualizada], 'en_us')); messagebox.showinfo("Copiado", "Mensagem em EN-US copiada!", parent=self)
+                self._copiar_entrega(self._construir_mensagem_entrega([chave_atualizada], 'en_us')); messagebox.showinfo("Copiado", "Mensagem em EN-US copiada!", parent=self)
             elif acao_selecionada == "copiar_msg_es":
-                pyperclip.copy(self._construir_mensagem_entrega([chave_atualizada], 'es_es')); messagebox.showinfo("Copiado", "Mensagem em ES copiada!", parent=self)
+                self._copiar_entrega(self._construir_mensagem_entrega([chave_atualizada], 'es_es')); messagebox.showinfo("Copiado", "Mensagem em ES copiada!", parent=self)
 
             elif acao_selecionada.startswith("pdf_"):
-                idioma = "en_us" if acao_selecionada == "pdf_en" else "es_es" if acao_selecionada == "pdf_es" else "pt_br"
-                caminho_pdf_gerado = self.gerar_pdf_entrega([chave_atualizada], idioma, comprador, email_comprador)
-                if caminho_pdf_gerado: messagebox.showinfo("PDF Gerado", f"PDF salvo em:\n{caminho_pdf_gerado}", parent=self)
+                idioma_pdf = "en_us" if acao_selecionada == "pdf_en" else "es_es" if acao_selecionada == "pdf_es" else "pt_br"
 
             elif acao_selecionada.startswith("copiar_msg_e_pdf_"):
-                idioma = "en_us" if acao_selecionada == "copiar_msg_e_pdf_en" else "es_es" if acao_selecionada == "copiar_msg_e_pdf_es" else "pt_br"
-                pyperclip.copy(self._construir_mensagem_entrega([chave_atualizada], idioma))
-                caminho_pdf_gerado = self.gerar_pdf_entrega([chave_atualizada], idioma, comprador, email_comprador)
-                if caminho_pdf_gerado:
-                    messagebox.showinfo("Sucesso", "Mensagem copiada e PDF gerado com sucesso!", parent=self)
-                else:
-                    messagebox.showwarning("Sucesso Parcial", "Mensagem copiada, mas houve uma falha ao gerar o PDF.", parent=self)
-
-            if enviar_email_var.get():
+                idioma_pdf = "en_us" if acao_selecionada == "copiar_msg_e_pdf_en" else "es_es" if acao_selecionada == "copiar_msg_e_pdf_es" else "pt_br"
+                self._copiar_entrega(self._construir_mensagem_entrega([chave_atualizada], idioma_pdf))
+
+            enviar_email, anexar_pdf = enviar_email_var.get(), anexar_pdf_var.get()
+            def concluir(caminho_pdf_gerado):
+                """Continua a entrega depois do PDF (renderizado no ServicoPDF sem travar a janela)."""
+                if acao_selecionada.startswith("pdf_") and caminho_pdf_gerado: messagebox.showinfo("PDF Gerado", f"PDF salvo em:\n{caminho_pdf_gerado}", parent=self)
+                elif acao_selecionada.startswith("copiar_msg_e_pdf_"):
+                    if caminho_pdf_gerado: messagebox.showinfo("Sucesso", "Mensagem copiada e PDF gerado com sucesso!", parent=self)
+                    else: messagebox.showwarning("Sucesso Parcial", "Mensagem copiada, mas houve uma falha ao gerar o PDF.", parent=self)
+                if not enviar_email: return
                 if "en" in acao_selecionada: idioma_email = "en_us"
                 elif "es" in acao_selecionada: idioma_email = "es_es"
                 else: idioma_email = "pt_br"
@@ -539,84 +574,46 @@ class GerenciadorChaves(tk.Tk):
                 elif idioma_email == "es_es": assunto_email = self.email_subject_es
                 else: assunto_email = self.email_subject_pt
 
-                anexo = caminho_pdf_gerado if anexar_pdf_var.get() else None
-                threading.Thread(target=self.enviar_email_com_chave, args=(email_comprador, assunto_email, texto_email, anexo), daemon=True).start()
+                anexo = caminho_pdf_gerado if anexar_pdf else None
+                self.enviar_email_com_chave(email_comprador, assunto_email, texto_email, anexo)
 
-            logar_acao(f"Chave '{chave_obj['chave']}' entregue para {comprador}")
             popup.destroy()
+            if idioma_pdf: self.gerar_pdf_entrega([chave_atualizada], idioma_pdf, comprador, email_comprador, ao_concluir=concluir)
+            else: concluir(None)
 
         frame_botoes = ttk.Frame(popup, style="TFrame"); frame_botoes.pack(pady=10); ttk.Button(frame_botoes, text="Confirmar Entrega", command=entregar).pack(side=tk.LEFT, padx=5); ttk.Button(frame_botoes, text="Cancelar", command=popup.destroy).pack(side=tk.LEFT, padx=5)
 
-    def gerar_pdf_entrega(self, chaves_entregues, idioma, comprador, email_comprador="", preview_mode=False, caminho_salvar_override=None):
-        if not PDF_DISPONIVEL: return None
+    def gerar_pdf_entrega(self, chaves_entregues, idioma, comprador, email_comprador="", preview_mode=False, caminho_salvar_override=None, ao_concluir=None):
+        """Renderiza o PDF no ServicoPDF; ao_concluir(caminho ou None) é chamado na thread da interface quando terminar."""
+        if not PDF_DISPONIVEL:
+            if ao_concluir: ao_concluir(None)
+            return
         if caminho_salvar_override: caminho_salvar = caminho_salvar_override
-        elif preview_mode:
-            os.makedirs(PDF_DIR, exist_ok=True); caminho_salvar = os.path.join(PDF_DIR, "preview_temp.pdf")
-        else:
-            os.makedirs(PDF_DIR, exist_ok=True); data_hoje = datetime.now().strftime("%Y-%m-%d"); pasta_data = os.path.join(PDF_DIR, data_hoje)
-            os.makedirs(pasta_data, exist_ok=True); safe_comprador_name = _sanitize_filename(comprador)
-            nome_arquivo = f"Entrega_{safe_comprador_name.replace(' ','_')}_{datetime.now():%Y%m%d%H%M%S}.pdf"; caminho_salvar = os.path.join(pasta_data, nome_arquivo)
-        pdf = GeradorPDF(caminho_salvar)
-        header_text = "Thank you for your purchase!" if idioma == "en_us" else "¡Gracias por su compra!" if idioma == "es_es" else "Obrigado por sua compra!"
-        footer_text = "If you have any questions, please contact us." if idioma == "en_us" else "Cualquier duda o problema, por favor, entre en contacto."
-        chaves_por_cat = defaultdict(list)
-        for chave in chaves_entregues: chaves_por_cat[chave.get("categoria", "S/C")].append(chave['chave'])
-        for i, (cat_nome, chaves_lista) in enumerate(sorted(chaves_por_cat.items())):
-            if i > 0: pdf.adicionar_quebra_pagina()
-            cat_obj = self.categoria_dict.get(cat_nome)
-            pdf.adicionar_imagem(cat_obj.get("logo_path") if cat_obj else None, largura_cm=6.5)
-            pdf.adicionar_paragrafo(header_text, estilo='HeaderStyle')
-            if cat_obj:
-                pt_map = {"Comprador": comprador, "Email": email_comprador, "Produto": cat_nome, "Tipo de licença": cat_obj.get('info_licenca_pt', ''), "Idioma": cat_obj.get('info_idioma_pt', ''), "Entrega": cat_obj.get('info_entrega_pt', '')}
-                en_map = {"Buyer": comprador, "Email": email_comprador, "Product": cat_nome, "License type": cat_obj.get('info_licenca_en', ''), "Language": cat_obj.get('info_idioma_en', ''), "Delivery": cat_obj.get('info_entrega_en', '')}
-                es_map = {"Comprador": comprador, "Email": email_comprador, "Producto": cat_nome, "Tipo de licencia": cat_obj.get('info_licenca_es', ''), "Idioma": cat_obj.get('info_idioma_es', ''), "Entrega": cat_obj.get('info_entrega_es', '')}
-                info_map = en_map if idioma == 'en_us' else es_map if idioma == 'es_es' else pt_map
-                info_dados_escapados = {k: html.escape(v) for k, v in info_map.items()}; pdf.adicionar_tabela_info(info_dados_escapados.items(), col_widths_cm=[4.5, 11]); pdf.adicionar_espaco_cm(0.8)
-            key_label = 'Your Activation Keys:' if len(chaves_lista) > 1 else 'Your Activation Key:' if idioma == 'en_us' else 'Sus Claves de Activación:' if len(chaves_lista) > 1 else 'Su Clave de Activación:' if idioma == 'es_es' else 'Suas Chaves de Ativação:' if len(chaves_lista) > 1 else 'Sua Chave de Ativação:'
-            pdf.adicionar_paragrafo(key_label, estilo='KeyLabel')
-            for chave_str in chaves_lista: pdf.adicionar_paragrafo(html.escape(chave_str), estilo='KeyStyle'); pdf.adicionar_espaco_cm(0.2)
-            inst_key = 'layout_pdf_en' if idioma == 'en_us' else 'layout_pdf_es' if idioma == 'es_es' else 'layout_pdf_pt'
-            instrucao_texto = (cat_obj.get(inst_key) if cat_obj else '').strip()
-            if instrucao_texto:
-                chaves_formatadas_str = "\n".join(chaves_lista); saudacao_str = "Bom dia" if 5 <= datetime.now().hour < 12 else "Boa tarde" if 12 <= datetime.now().hour < 18 else "Boa noite"
-                instrucao_texto = instrucao_texto.replace("{chave_entregue}", chaves_formatadas_str); instrucao_texto = instrucao_texto.replace("{comprador}", comprador); instrucao_texto = instrucao_texto.replace("{saudacao}", saudacao_str)
-            if instrucao_texto:
-                inst_header = "Activation Instructions" if idioma == "en_us" else "Instrucciones de Activación" if idioma == "es_es" else "Instruções de Ativação"
-                pdf.adicionar_paragrafo(inst_header, estilo='InstructionTitleStyle')
-                secoes = instrucao_texto.split('[NOVA_PAGINA]')
-                for idx, secao in enumerate(secoes):
-                    if secao.strip(): pdf.adicionar_paragrafo(secao, estilo='InstructionBody')
-                    if idx < len(secoes) - 1: pdf.adicionar_quebra_pagina()
-        pdf.adicionar_espaco_cm(1.5); pdf.adicionar_paragrafo(footer_text, estilo='FooterStyle')
-        if pdf.construir():
-            if not preview_mode and not caminho_salvar_override: logar_acao(f"PDF gerado com sucesso em {caminho_salvar}")
-            return caminho_salvar
-        return None
-
+        elif preview_mode: os.makedirs(PDF_DIR, exist_ok=True); caminho_salvar = os.path.join(PDF_DIR, "preview_temp.pdf")
+        else: caminho_salvar = caminho_pdf_entrega(comprador)
+        inicio = time.perf_counter(); futuro = self.servico_pdf.submeter(trabalho_pdf_entrega(caminho_salvar, chaves_entregues, self.categoria_dict, idioma, comprador, email_comprador))
+        futuro.add_done_callback(lambda f: metricas.registrar("pdf.gerar", (time.perf_counter() - inicio) * 1000))  # Do pedido ao PDF pronto, fila do pool incluída.
+        self._acompanhar_pdf(futuro, ao_concluir, registrar=not preview_mode and not caminho_salvar_override)
+
+    def _acompanhar_pdf(self, futuro, ao_concluir, registrar):
+        """Espera o PDF sem bloquear o loop do Tk e entrega o caminho (ou None) a ao_concluir na thread da interface."""
+        if not futuro.done(): self.after(50, self._acompanhar_pdf, futuro, ao_concluir, registrar); return
+        try: caminho, erro = futuro.result()
+        except Exception as e: caminho, erro = None, str(e)
+        if erro: messagebox.showerror("Erro de PDF", f"Não foi possível gerar o arquivo PDF.\nErro: {erro}"); logar_acao(f"FALHA ao gerar PDF. Erro: {erro}", "pdf", erro=str(erro))
+        elif registrar: logar_acao(f"PDF gerado com sucesso em {caminho}", "pdf")
+        if ao_concluir: ao_concluir(caminho)
+
+    @metricas.medido("entrega.mensagem")
     def _construir_mensagem_entrega(self, chaves_entregues, idioma='pt_br'):
-        if idioma == 'en_us':
-            header = "Thank you for your purchase! Here are your order details:"
-            footer = "If you have any questions or issues with activation, please contact us."
-        elif idioma == 'es_es':
-            header = "¡Gracias por su compra! Siguen los detalles de su pedido:"
-            footer = "Cualquier duda o problema con la activación, por favor, póngase en contacto."
-        else: # pt_br
-            header = "Obrigado por sua compra! Seguem os detalhes do seu pedido:"
-            footer = "Qualquer dúvida ou problema com a ativação, por favor, entre em contato."
-        partes_chaves, partes_instrucoes = [], []; chaves_por_cat = defaultdict(list)
-        for chave in chaves_entregues: chaves_por_cat[chave.get("categoria", "S/C")].append(chave['chave'])
-        for cat_nome, chaves in sorted(chaves_por_cat.items()):
-            partes_chaves.append(f"**{cat_nome}:**"); partes_chaves.extend(chaves); partes_chaves.append("")
-            if cat_obj := self.categoria_dict.get(cat_nome):
-                inst_key, inst_header_tpl = ('instrucao_en', "**Instructions for {cat_nome} (EN-US):**") if idioma == 'en_us' else ('instrucao_es', "**Instrucciones para {cat_nome} (ES):**") if idioma == 'es_es' else ('instrucao_pt', "**Instruções para {cat_nome} (PT-BR):**")
-                if inst_text := (cat_obj.get(inst_key) or "").strip():
-                    partes_instrucoes.extend(["----------", inst_header_tpl.format(cat_nome=cat_nome), inst_text, ""])
-        mensagem_final = [header, "", *partes_chaves]
-        if partes_instrucoes: mensagem_final.extend(partes_instrucoes)
-        mensagem_final.extend([footer]); return "\n".join(mensagem_final)
+        return construir_mensagem_entrega(chaves_entregues, self.categoria_dict, idioma)
+
+    @metricas.medido("entrega.clipboard")
+    def _copiar_entrega(self, texto):
+        pyperclip.copy(texto)
 
     def janela_entregar_chave_fluxo_rapido(self):
-        if not (sel := self.tree.selection()): return
+        if not (sel := self.tabela.selecao()): return
         if not (chave_obj := self.tree_id_map.get(sel[0])): messagebox.showerror("Erro", "Chave não encontrada."); return
         if chave_obj.get("vendida"): messagebox.showwarning("Aviso", "Esta chave já foi vendida."); return
         self._popup_finalizar_entrega_unica(chave_obj)
@@ -626,19 +623,19 @@ class GerenciadorChaves(tk.Tk):
         ttk.Label(popup, text="Selecione uma chave disponível:").pack(pady=5, padx=10, anchor="w")
         frame_tree = ttk.Frame(popup, style="TFrame"); frame_tree.pack(fill=tk.BOTH, expand=True, padx=10, pady=5)
         tree = ttk.Treeview(frame_tree, columns=("chave", "categoria"), show="headings"); tree.heading("chave", text="Chave"); tree.heading("categoria", text="Categoria"); tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
-        scrollbar = ttk.Scrollbar(frame_tree, orient="vertical", command=tree.yview); tree.configure(yscrollcommand=scrollbar.set); scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
-        chaves_disponiveis = [item for item in sorted(self.estoque, key=lambda x: (x.get("vendida", 0), x.get("categoria", ""))) if not item.get("vendida")]
-        for item in chaves_disponiveis: tree.insert("", "end", values=(item["chave"], item.get("categoria", "S/C")))
+        scrollbar = ttk.Scrollbar(frame_tree, orient="vertical"); scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        tabela = TabelaVirtual(tree, scrollbar, lambda tid: ((self.tree_id_map[tid]["chave"], self.tree_id_map[tid].get("categoria", "S/C")), None), multipla=False)
+        tabela.pre_carregar = self._pre_carregar_pagina; tabela.definir_linhas(self._linhas_disponiveis())
         def prosseguir():
-            if not (sel := tree.selection()): messagebox.showwarning("Aviso", "Selecione uma chave.", parent=popup); return
-            if chave_obj := self.estoque_dict.get(tree.item(sel[0], "values")[0]):
+            if not (sel := tabela.selecao()): messagebox.showwarning("Aviso", "Selecione uma chave.", parent=popup); return
+            if chave_obj := self.tree_id_map.get(sel[0]):
                 popup.destroy(); self._popup_finalizar_entrega_unica(chave_obj)
         tree.bind("<Double-1>", lambda e: prosseguir())
         frame_botoes = ttk.Frame(popup, style="TFrame"); frame_botoes.pack(pady=10); ttk.Button(frame_botoes, text="Prosseguir", command=prosseguir).pack(side=tk.LEFT, padx=5); ttk.Button(frame_botoes, text="Cancelar", command=popup.destroy).pack(side=tk.LEFT, padx=5)
 
     def menu_contexto_tree(self, event):
-        sel = self.tree.selection()
-        if not sel and (item := self.tree.identify_row(event.y)): self.tree.selection_set(item); sel = self.tree.selection()
+        sel = self.tabela.selecao()
+        if not sel and (indice := self.tabela.indice_em(event.y)) is not None: self.tabela.selecionar([self.tabela.linhas[indice]]); sel = self.tabela.selecao()
         if sel:
             menu = tk.Menu(self, **self.menu_style)
             if len(sel) == 1 and (chave_obj := self.tree_id_map.get(sel[0])) and not chave_obj.get("vendida"):
@@ -660,38 +657,25 @@ class GerenciadorChaves(tk.Tk):
             dialog = CustomAskStringDialog(parent=popup, title="Nova Categoria", prompt="Nome da categoria:", style_colors={'bg':self.bg_color, 'fg':self.fg_color, 'entry_bg':self.entry_bg, 'text':self.text_color})
             if nova := dialog.result:
                 if any(c['nome'].lower() == nova.lower() for c in self.categorias): messagebox.showwarning("Aviso", "Categoria já existe.", parent=popup); return
-                self.registrar_undo(); conn=sqlite3.connect(DB_NAME); conn.execute("INSERT INTO categorias(nome) VALUES (?)", (nova,)); conn.commit(); conn.close()
-                self.salvar_e_atualizar_tudo(); combo['values'] = [c['nome'] for c in self.categorias]; combo.set(nova); logar_acao(f"Categoria adicionada: {nova}")
+                with passo_undo(): db.executar("INSERT INTO categorias(nome) VALUES (?)", (nova,))
+                self.aplicar_mudancas(ConjuntoMudancas(categorias=True)); combo['values'] = [c['nome'] for c in self.categorias]; combo.set(nova); logar_acao(f"Categoria adicionada: {nova}", "categoria", categoria=nova)
         def adicionar():
             chaves = [c.strip() for c in texto_chaves.get("1.0", tk.END).strip().splitlines() if c.strip()]
             if not chaves: messagebox.showwarning("Aviso", "Nenhuma chave digitada.", parent=popup); return
-            self.registrar_undo(); cat_sel = cat_var.get() or "Sem Categoria"; canal_sel = canal_var.get().strip() or None; add_c, dup_c = 0, 0
-            if canal_sel: self._garantir_canal_venda_existe(canal_sel)
-            conn=sqlite3.connect(DB_NAME); cursor = conn.cursor(); cursor.execute("SELECT MAX(ordem_manual) FROM chaves"); max_o = cursor.fetchone()[0] or 0; to_insert = []
-            for i, chave in enumerate(chaves):
-                if chave not in self.estoque_dict: to_insert.append((chave, cat_sel, max_o + i + 1, canal_sel)); add_c+=1
-                else: dup_c+=1
-            if add_c > 0: cursor.executemany("INSERT INTO chaves(chave, categoria, ordem_manual, canal_venda) VALUES(?, ?, ?, ?)", to_insert); conn.commit(); self.salvar_e_atualizar_tudo(); logar_acao(f"{add_c} chaves adicionadas")
-            conn.close(); msg = f"{add_c} chave(s) adicionada(s)."; msg+= f"\n{dup_c} duplicada(s) foi(ram) ignorada(s)." if dup_c else ""; messagebox.showinfo("Resultado", msg, parent=popup); popup.destroy()
+            cat_sel = cat_var.get() or "Sem Categoria"; canal_sel = canal_var.get().strip() or None
+            with passo_undo():
+                if canal_sel: self._garantir_canal_venda_existe(canal_sel)
+                novos_ids, add_c, dup_c, _ = ingerir_chaves(chaves, cat_sel, canal_sel)
+            if add_c > 0: self.aplicar_mudancas(ConjuntoMudancas(inseridos=novos_ids, canais=bool(canal_sel)))
+            msg = f"{add_c} chave(s) adicionada(s)."; msg+= f"\n{dup_c} duplicada(s) foi(ram) ignorada(s)." if dup_c else ""; messagebox.showinfo("Resultado", msg, parent=popup); popup.destroy()
         frame_b = ttk.Frame(popup, style="TFrame"); frame_b.pack(pady=10); ttk.Button(frame_b, text="Adicionar", command=adicionar).pack(side=tk.LEFT,padx=5); ttk.Button(frame_b, text="Cancelar", command=popup.destroy).pack(side=tk.LEFT,padx=5)
 
     # --- INÍCIO: NOVAS FUNÇÕES PARA IMPORTAÇÃO DE XLS ---
-    def _excel_col_to_int(self, col_str):
-        """Converte uma string de coluna do Excel (ex: 'A', 'B', 'AA') para um índice 0."""
-        index = 0
-        for char in col_str:
-            index = index * 26 + (ord(char.upper()) - ord('A') + 1)
-        return index - 1
-
     def janela_importar_xls(self):
-        """Abre o diálogo para selecionar um arquivo XLS/XLSX e, em seguida, o popup de configuração."""
-        if not PANDAS_DISPONIVEL:
-            messagebox.showerror("Função Indisponível", "A biblioteca 'pandas' é necessária para esta função.")
-            return
-
+        """Abre o diálogo para selecionar uma planilha (XLS/XLSX) ou arquivo CSV/TXT e, em seguida, o popup de configuração."""
         caminho_arquivo = filedialog.askopenfilename(
-            title="Selecione o arquivo XLS ou XLSX",
-            filetypes=[("Arquivos Excel", "*.xls *.xlsx"), ("Todos os arquivos", "*.*")]
+            title="Selecione o arquivo de chaves",
+            filetypes=[("Planilhas e texto", "*.xlsx *.xlsm *.xls *.csv *.txt"), ("Arquivos Excel", "*.xls *.xlsx *.xlsm"), ("CSV/TXT", "*.csv *.txt"), ("Todos os arquivos", "*.*")]
         )
         if not caminho_arquivo:
             return
@@ -699,10 +683,16 @@ class GerenciadorChaves(tk.Tk):
         self._popup_configurar_importacao_xls(caminho_arquivo)
 
     def _popup_configurar_importacao_xls(self, caminho_arquivo):
-        """Cria um popup para o usuário configurar os parâmetros de importação do Excel."""
+        """Cria um popup para o usuário configurar colunas, linha de início, planilhas e categoria da importação."""
+        leitor = LeitorChaves(caminho_arquivo)
+        try: planilhas = leitor.nomes_planilhas()
+        except ImportError as e: messagebox.showerror("Biblioteca Faltando", f"Não foi possível ler este formato.\n\n{e}\n\nInstale com: pip install openpyxl xlrd"); return
+        except Exception as e: messagebox.showerror("Erro na Leitura", f"Não foi possível abrir o arquivo.\n\nDetalhes do erro: {e}"); return
+        texto = not planilhas
+
         popup = tk.Toplevel(self)
-        popup.title("Configurar Importação de XLS")
-        popup.geometry("400x250")
+        popup.title("Configurar Importação")
+        popup.geometry("420x250" if texto else "420x400")
         popup.resizable(False, False)
         popup.grab_set()
         popup.configure(bg=self.bg_color)
@@ -711,16 +701,16 @@ class GerenciadorChaves(tk.Tk):
         mf.pack(fill=tk.BOTH, expand=True)
         mf.columnconfigure(1, weight=1)
 
-        # Campo para Coluna
-        ttk.Label(mf, text="Coluna das Chaves (Letra):").grid(row=0, column=0, sticky="w", pady=5, padx=5)
-        col_var = tk.StringVar(value="B")
-        col_entry = ttk.Entry(mf, textvariable=col_var, width=10)
+        # Campo para Colunas (uma ou mais, separadas por vírgula)
+        ttk.Label(mf, text="Coluna(s) das Chaves (ex: B ou B, D):").grid(row=0, column=0, sticky="w", pady=5, padx=5)
+        col_var = tk.StringVar(value="A" if leitor.extensao == ".txt" else "B")
+        col_entry = ttk.Entry(mf, textvariable=col_var, width=10, state="disabled" if leitor.extensao == ".txt" else "normal")
         col_entry.grid(row=0, column=1, sticky="w", pady=5, padx=5)
         col_entry.focus()
 
         # Campo para Linha de Início
         ttk.Label(mf, text="Linha de Início (Número):").grid(row=1, column=0, sticky="w", pady=5, padx=5)
-        linha_var = tk.StringVar(value="4")
+        linha_var = tk.StringVar(value="1" if texto else "4")
         linha_entry = ttk.Entry(mf, textvariable=linha_var, width=10)
         linha_entry.grid(row=1, column=1, sticky="w", pady=5, padx=5)
 
@@ -731,14 +721,25 @@ class GerenciadorChaves(tk.Tk):
         if self.categorias: cat_combo.set(self.categorias[0]['nome'])
         cat_combo.grid(row=2, column=1, sticky="ew", pady=5, padx=5)
 
+        # Planilhas (só para XLS/XLSX): a primeira vem selecionada
+        lista_planilhas = None
+        if not texto:
+            ttk.Label(mf, text="Planilha(s):").grid(row=3, column=0, sticky="nw", pady=5, padx=5)
+            lista_planilhas = tk.Listbox(mf, selectmode=tk.EXTENDED, height=6, exportselection=False, bg=self.entry_bg, fg=self.text_color, relief="flat")
+            for nome in planilhas: lista_planilhas.insert(tk.END, nome)
+            lista_planilhas.selection_set(0); lista_planilhas.grid(row=3, column=1, sticky="ew", pady=5, padx=5)
+
         def processar_importacao():
-            col_letra = col_var.get().strip().upper()
+            colunas = [c.strip().upper() for c in col_var.get().split(",") if c.strip()]
             linha_inicio_str = linha_var.get().strip()
             categoria_sel = cat_var.get()
 
-            if not col_letra or not linha_inicio_str or not categoria_sel:
+            if not colunas or not linha_inicio_str or not categoria_sel:
                 messagebox.showerror("Erro de Validação", "Todos os campos são obrigatórios.", parent=popup)
                 return
+            if not all(c.isalpha() and c.isascii() for c in colunas):
+                messagebox.showerror("Erro de Validação", "Informe as colunas por letra (ex: B ou B, D).", parent=popup)
+                return
             
             try:
                 linha_inicio = int(linha_inicio_str)
@@ -747,71 +748,109 @@ class GerenciadorChaves(tk.Tk):
                 messagebox.showerror("Erro de Validação", "A linha de início deve ser um número positivo.", parent=popup)
                 return
 
-            try:
-                col_index = self._excel_col_to_int(col_letra)
-                # Lê o arquivo sem tratar a primeira linha como cabeçalho
-                df = pd.read_excel(caminho_arquivo, header=None, sheet_name=0)
-                
-                # Seleciona a coluna pelo índice e a partir da linha de início, removendo valores nulos
-                chaves_a_importar = df.iloc[linha_inicio - 1:, col_index].dropna().astype(str).tolist()
-
-                if not chaves_a_importar:
-                    messagebox.showwarning("Nenhum Dado", "Nenhuma chave foi encontrada na coluna e linha especificadas.", parent=popup)
-                    return
-                
-                self.registrar_undo()
-                add_c, dup_c = 0, 0
-                conn = sqlite3.connect(DB_NAME)
-                cursor = conn.cursor()
-                cursor.execute("SELECT MAX(ordem_manual) FROM chaves")
-                max_ordem = (cursor.fetchone()[0] or 0)
-                
-                to_insert = []
-                for i, chave in enumerate(chaves_a_importar):
-                    chave_limpa = chave.strip()
-                    if chave_limpa and chave_limpa not in self.estoque_dict:
-                        to_insert.append((chave_limpa, categoria_sel, max_ordem + i + 1, None))
-                        add_c += 1
-                    elif chave_limpa:
-                        dup_c += 1
-                
-                if add_c > 0:
-                    cursor.executemany("INSERT INTO chaves(chave, categoria, ordem_manual, canal_venda) VALUES(?, ?, ?, ?)", to_insert)
-                    conn.commit()
-                    self.salvar_e_atualizar_tudo()
-                    logar_acao(f"{add_c} chaves importadas do arquivo {os.path.basename(caminho_arquivo)}")
-                
-                conn.close()
-                msg_final = f"{add_c} chave(s) nova(s) importada(s) com sucesso!"
-                if dup_c > 0:
-                    msg_final += f"\n{dup_c} chave(s) duplicada(s) foi(ram) ignorada(s)."
-                
-                messagebox.showinfo("Importação Concluída", msg_final, parent=self)
-                popup.destroy()
+            selecionadas = [planilhas[i] for i in lista_planilhas.curselection()] if lista_planilhas else []
+            if lista_planilhas and not selecionadas:
+                messagebox.showerror("Erro de Validação", "Selecione ao menos uma planilha.", parent=popup)
+                return
 
-            except FileNotFoundError:
-                messagebox.showerror("Erro de Arquivo", f"O arquivo não foi encontrado:\n{caminho_arquivo}", parent=popup)
-            except Exception as e:
-                messagebox.showerror("Erro na Leitura", f"Ocorreu um erro ao processar o arquivo Excel.\n\nVerifique se a coluna '{col_letra}' existe e se o arquivo não está corrompido.\n\nDetalhes do erro: {e}", parent=popup)
+            popup.destroy()
+            self._executar_importacao(LeitorChaves(caminho_arquivo, colunas, linha_inicio, selecionadas), categoria_sel)
 
         botoes_f = ttk.Frame(mf, style="TFrame")
-        botoes_f.grid(row=3, column=0, columnspan=2, pady=20)
+        botoes_f.grid(row=4, column=0, columnspan=2, pady=20)
         ttk.Button(botoes_f, text="Importar", command=processar_importacao, style="Accent.TButton").pack(side=tk.LEFT, padx=5)
         ttk.Button(botoes_f, text="Cancelar", command=popup.destroy).pack(side=tk.LEFT, padx=5)
 
+    def _executar_importacao(self, leitor, categoria):
+        """Roda ingerir_chaves numa thread de trabalho; a janela acompanha o progresso por polling e pode cancelar
+        (o que já foi gravado fica, e pode ser desfeito como um único passo)."""
+        popup = tk.Toplevel(self); popup.title("Importando Chaves"); popup.geometry("420x150"); popup.resizable(False, False); popup.grab_set(); popup.configure(bg=self.bg_color)
+        mf = ttk.Frame(popup, padding=15, style="TFrame"); mf.pack(fill=tk.BOTH, expand=True)
+        ttk.Label(mf, text=f"Importando {os.path.basename(leitor.caminho)}...").pack(anchor="w")
+        barra = ttk.Progressbar(mf, mode="determinate", maximum=1.0); barra.pack(fill=tk.X, pady=8)
+        status_var = tk.StringVar(value="Lendo arquivo..."); ttk.Label(mf, textvariable=status_var).pack(anchor="w")
+        cancelar, estado = threading.Event(), {"adicionadas": 0, "duplicadas": 0, "resultado": None, "erro": None}
+        botao = ttk.Button(mf, text="Cancelar", command=lambda: (cancelar.set(), botao.config(state="disabled"), status_var.set("Cancelando..."))); botao.pack(pady=(8, 0))
+        popup.protocol("WM_DELETE_WINDOW", cancelar.set)
+        def trabalhar():
+            try: estado["resultado"] = ingerir_chaves(leitor, categoria, cancelar=cancelar, ao_lote=lambda a, d: estado.update(adicionadas=a, duplicadas=d), desfazer=True)
+            except Exception as e: estado["erro"] = e
+            finally: db.fechar_da_thread()
+        threading.Thread(target=trabalhar, daemon=True).start()
+        def acompanhar():
+            if estado["resultado"] is None and estado["erro"] is None:
+                barra["value"] = leitor.progresso
+                if not cancelar.is_set(): status_var.set(f"{estado['adicionadas']} nova(s), {estado['duplicadas']} duplicada(s)...")
+                popup.after(100, acompanhar); return
+            popup.destroy()
+            if (erro := estado["erro"]) is not None:
+                self.salvar_e_atualizar_tudo()  # Lotes já gravados antes do erro entram na tabela.
+                if isinstance(erro, ImportError): messagebox.showerror("Biblioteca Faltando", f"Não foi possível ler este formato.\n\n{erro}\n\nInstale com: pip install openpyxl xlrd", parent=self)
+                else: messagebox.showerror("Erro na Leitura", f"Ocorreu um erro ao processar o arquivo.\n\nVerifique as colunas/planilhas e se o arquivo não está corrompido.\n\nDetalhes do erro: {erro}", parent=self)
+                return
+            novos_ids, add_c, dup_c, interrompida = estado["resultado"]
+            if novos_ids: self.aplicar_mudancas(ConjuntoMudancas(inseridos=novos_ids))
+            if not add_c and not dup_c and not interrompida:
+                messagebox.showwarning("Nenhum Dado", "Nenhuma chave foi encontrada nas colunas e linhas especificadas.", parent=self); return
+            msg_final = f"{add_c} chave(s) nova(s) importada(s) com sucesso!"
+            if dup_c > 0: msg_final += f"\n{dup_c} chave(s) duplicada(s) foi(ram) ignorada(s)."
+            if interrompida: msg_final += "\n\nImportação cancelada: as chaves acima já foram gravadas (use Desfazer para removê-las)."
+            messagebox.showinfo("Importação Concluída", msg_final, parent=self)
+        popup.after(100, acompanhar)
+
     # --- FIM: NOVAS FUNÇÕES PARA IMPORTAÇÃO DE XLS ---
 
+    def janela_entrega_lote(self):
+        """Atende um arquivo de pedidos com entregar_lote numa thread de trabalho (um único passo de desfazer) e grava
+        o relatório ao lado do arquivo."""
+        if not (caminho := filedialog.askopenfilename(title="Selecione o Arquivo de Pedidos", filetypes=[("Arquivos CSV", "*.csv"), ("Todos os arquivos", "*.*")])): return
+        try: pedidos = ler_pedidos(caminho)
+        except (OSError, ValueError, UnicodeDecodeError, csv.Error) as e: messagebox.showerror("Erro na Leitura", f"Não foi possível ler o arquivo de pedidos.\n\n{e}"); return
+        if not pedidos: messagebox.showwarning("Nenhum Pedido", "O arquivo não contém pedidos."); return
+        popup = tk.Toplevel(self); popup.title("Entrega em Lote"); popup.geometry("440x260"); popup.resizable(False, False); popup.grab_set(); popup.configure(bg=self.bg_color)
+        mf = ttk.Frame(popup, padding=15, style="TFrame"); mf.pack(fill=tk.BOTH, expand=True)
+        ttk.Label(mf, text=f"{len(pedidos)} pedido(s) em {os.path.basename(caminho)}").pack(anchor="w")
+        idiomas = {"Português (PT-BR)": "pt_br", "English (EN-US)": "en_us", "Español (ES)": "es_es"}; idioma_var = tk.StringVar(value="Português (PT-BR)")
+        fi = ttk.Frame(mf, style="TFrame"); fi.pack(fill=tk.X, pady=(8, 0)); ttk.Label(fi, text="Idioma padrão:").pack(side=tk.LEFT); ttk.Combobox(fi, textvariable=idioma_var, values=list(idiomas), state="readonly", width=20).pack(side=tk.LEFT, padx=5)
+        pdf_var, email_var, anexo_var = tk.BooleanVar(value=PDF_DISPONIVEL), tk.BooleanVar(value=True), tk.BooleanVar(value=PDF_DISPONIVEL)
+        ttk.Checkbutton(mf, text="Gerar PDF de cada pedido", variable=pdf_var, state="normal" if PDF_DISPONIVEL else "disabled").pack(anchor="w", pady=(8, 0))
+        ttk.Checkbutton(mf, text="Enfileirar email para os compradores", variable=email_var).pack(anchor="w"); ttk.Checkbutton(mf, text="Anexar PDF ao email", variable=anexo_var, state="normal" if PDF_DISPONIVEL else "disabled").pack(anchor="w", padx=(20, 0))
+        barra = ttk.Progressbar(mf, mode="determinate", maximum=1.0); barra.pack(fill=tk.X, pady=8); status_var = tk.StringVar(); ttk.Label(mf, textvariable=status_var).pack(anchor="w")
+        estado = {"resultado": None, "erro": None, "etapa": "", "feitos": 0, "total": 1}
+        def iniciar():
+            if email_var.get() and not config_email_completa(carregar_config_email()) and not messagebox.askyesno("Email não Configurado", "As configurações de email estão incompletas.\nOs emails ficarão na fila até serem configurados. Continuar?", parent=popup): return
+            botao.config(state="disabled"); popup.protocol("WM_DELETE_WINDOW", lambda: None)
+            opcoes = dict(idioma=idiomas[idioma_var.get()], gerar_pdf=pdf_var.get(), enviar_email=email_var.get(), anexar_pdf=anexo_var.get(), servico_pdf=self.servico_pdf, fila_email=self.fila_email, desfazer=True)
+            def trabalhar():
+                try: estado["resultado"] = entregar_lote(pedidos, ao_progresso=lambda etapa, feitos, total: estado.update(etapa=etapa, feitos=feitos, total=max(total, 1)), **opcoes)
+                except Exception as e: estado["erro"] = e
+                finally: db.fechar_da_thread()
+            threading.Thread(target=trabalhar, daemon=True).start(); popup.after(100, acompanhar)
+        def acompanhar():
+            if estado["resultado"] is None and estado["erro"] is None:
+                barra["value"] = estado["feitos"] / estado["total"]; status_var.set(f"{estado['etapa']}... {estado['feitos']}/{estado['total']}"); popup.after(100, acompanhar); return
+            popup.destroy()
+            if (erro := estado["erro"]) is not None: self.salvar_e_atualizar_tudo(); messagebox.showerror("Erro na Entrega em Lote", f"A entrega em lote falhou.\n\nDetalhes do erro: {erro}", parent=self); return
+            resultado = estado["resultado"]; ids = [c["id"] for p in resultado for c in p["chaves"]]
+            if ids: self.aplicar_mudancas(ConjuntoMudancas(atualizados=ids, canais=any(p["canal"] for p in resultado)))
+            self._atualizar_status_email(); contagem = defaultdict(int)
+            for p in resultado: contagem[p["status"]] += 1
+            relatorio = salvar_relatorio_lote(resultado, f"{os.path.splitext(caminho)[0]}_resultado_{datetime.now():%Y%m%d%H%M%S}.csv")
+            resumo = "\n".join(f"{STATUS_LOTE[s]}: {n}" for s, n in contagem.items())
+            if messagebox.askyesno("Entrega em Lote Concluída", f"{len(ids)} chave(s) entregue(s).\n\n{resumo}\n\nRelatório salvo em:\n{relatorio}\n\nAbrir o relatório?", parent=self): webbrowser.open_new(f'file://{os.path.realpath(relatorio)}')
+        fb = ttk.Frame(popup, style="TFrame"); fb.pack(pady=(0, 10)); botao = ttk.Button(fb, text="Entregar", command=iniciar); botao.pack(side=tk.LEFT, padx=5); ttk.Button(fb, text="Fechar", command=popup.destroy).pack(side=tk.LEFT, padx=5)
+
     def janela_entregar_varias_chaves(self):
         popup = tk.Toplevel(self); popup.title("Entregar Várias Chaves"); popup.geometry("800x850"); popup.grab_set(); popup.configure(bg=self.bg_color)
         frame_info = ttk.Frame(popup, style="TFrame"); frame_info.pack(fill=tk.X, padx=10, pady=5); ttk.Label(frame_info, text="Selecione as chaves:").pack(side=tk.LEFT); self.contador_sel_var = tk.StringVar(value="0 selecionadas"); ttk.Label(frame_info, textvariable=self.contador_sel_var, font=('Segoe UI', 9, 'italic')).pack(side=tk.RIGHT)
         frame_tree = ttk.Frame(popup, style="TFrame"); frame_tree.pack(fill=tk.BOTH, expand=True, padx=10, pady=5); tree = ttk.Treeview(frame_tree, columns=("chave", "categoria"), show="headings", selectmode="extended")
         tree.heading("chave", text="Chave", anchor=tk.CENTER); tree.heading("categoria", text="Categoria", anchor=tk.CENTER)
         tree.column("chave", width=450, anchor=tk.CENTER); tree.column("categoria", width=250, anchor=tk.CENTER)
-        scrollbar = ttk.Scrollbar(frame_tree, orient="vertical", command=tree.yview); tree.configure(yscrollcommand=scrollbar.set); tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True); scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
-        def upd_count(e=None): self.contador_sel_var.set(f"{len(tree.selection())} selecionadas")
+        scrollbar = ttk.Scrollbar(frame_tree, orient="vertical"); tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True); scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        tabela = TabelaVirtual(tree, scrollbar, lambda tid: ((self.tree_id_map[tid]["chave"], self.tree_id_map[tid].get("categoria", "S/C")), None))
+        def upd_count(e=None): self.contador_sel_var.set(f"{len(tabela.selecionados)} selecionadas")
         tree.bind("<<TreeviewSelect>>", upd_count)
-        chaves_disponiveis = [item for item in sorted(self.estoque, key=lambda x: (x.get("vendida",0), x.get("categoria",""))) if not item.get("vendida")]
-        for item in chaves_disponiveis: tree.insert("", "end", iid=item['tree_id'], values=(item["chave"], item.get("categoria", "S/C")))
+        tabela.pre_carregar = self._pre_carregar_pagina; tabela.definir_linhas(self._linhas_disponiveis())
         frame_form = ttk.Frame(popup, style="TFrame"); frame_form.pack(fill=tk.X, padx=10, pady=10); frame_form.columnconfigure(1, weight=1); frame_form.columnconfigure(3, weight=1)
         ttk.Label(frame_form, text="Comprador:").grid(row=0, column=0, sticky="w", pady=2, padx=(0,5)); comprador_var = tk.StringVar(); entry_comprador = ttk.Entry(frame_form, textvariable=comprador_var); entry_comprador.grid(row=0, column=1, sticky="ew"); entry_comprador.focus()
         ttk.Label(frame_form, text="Email do Comprador:").grid(row=0, column=2, sticky="w", pady=2, padx=(10,5)); email_comprador_var = tk.StringVar(); ttk.Entry(frame_form, textvariable=email_comprador_var).grid(row=0, column=3, sticky="ew")
@@ -853,7 +892,7 @@ class GerenciadorChaves(tk.Tk):
         acao_entrega_var.trace_add("write", toggle_anexo); enviar_email_var.trace_add("write", toggle_anexo)
 
         def entregar():
-            sel_ids = tree.selection(); comprador = comprador_var.get().strip()
+            sel_ids = tabela.selecao(); comprador = comprador_var.get().strip()
             if not sel_ids or not comprador: messagebox.showwarning("Aviso", "Selecione chaves e informe o comprador.", parent=popup); return
             email_comprador = email_comprador_var.get().strip(); canal_venda = canal_venda_var.get().strip() or None
             if enviar_email_var.get() and not email_comprador: messagebox.showwarning("Aviso", "Informe o email.", parent=popup); return
@@ -862,43 +901,44 @@ class GerenciadorChaves(tk.Tk):
             except ValueError: messagebox.showerror("Erro de Formato", "Preços devem ser números.", parent=popup); return
             if not messagebox.askyesno("Confirmar Entrega", f"Entregar {len(sel_ids)} chaves para '{comprador}'?", parent=popup): return
             
-            self.registrar_undo(); data_venda = f"{datetime.now():%Y-%m-%d %H:%M:%S}"; entregues_obj, para_update = [], []
-            for sel_id in sel_ids:
-                if item := self.tree_id_map.get(sel_id): 
-                    para_update.append((comprador, data_venda, preco_brl, preco_usd, canal_venda, item['id']))
-                    item.update({'vendida':1, 'comprador':comprador, 'data_venda':data_venda, 'preco_venda_brl': preco_brl, 'preco_venda_usd': preco_usd, 'canal_venda': canal_venda})
-                    entregues_obj.append(item)
-            
-            conn=sqlite3.connect(DB_NAME); conn.executemany("UPDATE chaves SET vendida=1, comprador=?, data_venda=?, preco_venda_brl=?, preco_venda_usd=?, canal_venda=? WHERE id=?", para_update); conn.commit(); conn.close()
-            self.salvar_e_atualizar_tudo()
+            ids = [item['id'] for sel_id in sel_ids if (item := self.tree_id_map.get(sel_id))]
+            with metricas.span("entrega.db"), passo_undo(): entregues_obj, conflitos = vender_chaves(ids, comprador, preco_brl, preco_usd, canal_venda)
+            if conflitos:
+                self.aplicar_mudancas(ConjuntoMudancas(atualizados=conflitos))
+                restantes = [i for i in ids if i not in set(conflitos)]
+                if not restantes: messagebox.showwarning("Chaves Indisponíveis", "Todas as chaves selecionadas já foram vendidas (por outra instância ou processo usando o mesmo banco).", parent=popup); popup.destroy(); return
+                if not messagebox.askyesno("Chaves Indisponíveis", f"{len(conflitos)} chave(s) selecionada(s) já foram vendidas por outra instância ou processo.\n\nEntregar apenas as outras {len(restantes)} para '{comprador}'?", parent=popup): popup.destroy(); return
+                with metricas.span("entrega.db"), passo_undo(): entregues_obj, conflitos = vender_chaves(restantes, comprador, preco_brl, preco_usd, canal_venda, parcial=True)
+            self.aplicar_mudancas(ConjuntoMudancas(atualizados=ids, canais=bool(canal_venda)))
+            if not entregues_obj: popup.destroy(); return
             
-            caminho_pdf_gerado = None; acao_selecionada = acao_entrega_var.get()
+            idioma_pdf, acao_selecionada = None, acao_entrega_var.get()
             
             if acao_selecionada == "copiar_chave":
-                pyperclip.copy("\n".join([c['chave'] for c in entregues_obj])); messagebox.showinfo("Copiado", f"{len(entregues_obj)} Chaves copiadas!", parent=self)
+                self._copiar_entrega("\n".join([c['chave'] for c in entregues_obj])); messagebox.showinfo("Copiado", f"{len(entregues_obj)} Chaves copiadas!", parent=self)
 
             elif acao_selecionada == "copiar_msg_pt":
-                pyperclip.copy(self._construir_mensagem_entrega(entregues_obj, 'pt_br')); messagebox.showinfo("Copiado", "Mensagem em PT-BR copiada!", parent=self)
+                self._copiar_entrega(self._construir_mensagem_entrega(entregues_obj, 'pt_br')); messagebox.showinfo("Copiado", "Mensagem em PT-BR copiada!", parent=self)
             elif acao_selecionada == "copiar_msg_en":
-                pyperclip.copy(self._construir_mensagem_entrega(entregues_obj, 'en_us')); messagebox.showinfo("Copiado", "Mensagem em EN-US copiada!", parent=self)
+                self._copiar_entrega(self._construir_mensagem_entrega(entregues_obj, 'en_us')); messagebox.showinfo("Copiado", "Mensagem em EN-US copiada!", parent=self)
             elif acao_selecionada == "copiar_msg_es":
-                pyperclip.copy(self._construir_mensagem_entrega(entregues_obj, 'es_es')); messagebox.showinfo("Copiado", "Mensagem em ES copiada!", parent=self)
+                self._copiar_entrega(self._construir_mensagem_entrega(entregues_obj, 'es_es')); messagebox.showinfo("Copiado", "Mensagem em ES copiada!", parent=self)
             
             elif acao_selecionada.startswith("pdf_"):
-                idioma = "en_us" if acao_selecionada == "pdf_en" else "es_es" if acao_selecionada == "pdf_es" else "pt_br"
-                caminho_pdf_gerado = self.gerar_pdf_entrega(entregues_obj, idioma, comprador, email_comprador)
-                if caminho_pdf_gerado: messagebox.showinfo("PDF Gerado", f"PDF salvo em:\n{caminho_pdf_gerado}", parent=self)
+                idioma_pdf = "en_us" if acao_selecionada == "pdf_en" else "es_es" if acao_selecionada == "pdf_es" else "pt_br"
             
             elif acao_selecionada.startswith("copiar_msg_e_pdf_"):
-                idioma = "en_us" if acao_selecionada == "copiar_msg_e_pdf_en" else "es_es" if acao_selecionada == "copiar_msg_e_pdf_es" else "pt_br"
-                pyperclip.copy(self._construir_mensagem_entrega(entregues_obj, idioma))
-                caminho_pdf_gerado = self.gerar_pdf_entrega(entregues_obj, idioma, comprador, email_comprador)
-                if caminho_pdf_gerado:
-                    messagebox.showinfo("Sucesso", "Mensagem copiada e PDF gerado com sucesso!", parent=self)
-                else:
-                    messagebox.showwarning("Sucesso Parcial", "Mensagem copiada, mas houve uma falha ao gerar o PDF.", parent=self)
-
-            if enviar_email_var.get():
+                idioma_pdf = "en_us" if acao_selecionada == "copiar_msg_e_pdf_en" else "es_es" if acao_selecionada == "copiar_msg_e_pdf_es" else "pt_br"
+                self._copiar_entrega(self._construir_mensagem_entrega(entregues_obj, idioma_pdf))
+
+            enviar_email, anexar_pdf = enviar_email_var.get(), anexar_pdf_var.get()
+            def concluir(caminho_pdf_gerado):
+                """Continua a entrega depois do PDF (renderizado no ServicoPDF sem travar a janela)."""
+                if acao_selecionada.startswith("pdf_") and caminho_pdf_gerado: messagebox.showinfo("PDF Gerado", f"PDF salvo em:\n{caminho_pdf_gerado}", parent=self)
+                elif acao_selecionada.startswith("copiar_msg_e_pdf_"):
+                    if caminho_pdf_gerado: messagebox.showinfo("Sucesso", "Mensagem copiada e PDF gerado com sucesso!", parent=self)
+                    else: messagebox.showwarning("Sucesso Parcial", "Mensagem copiada, mas houve uma falha ao gerar o PDF.", parent=self)
+                if not enviar_email: return
                 if "en" in acao_selecionada: idioma_email = "en_us"
                 elif "es" in acao_selecionada: idioma_email = "es_es"
                 else: idioma_email = "pt_br"
@@ -909,10 +949,12 @@ class GerenciadorChaves(tk.Tk):
                 elif idioma_email == "es_es": assunto_email = self.email_subject_es
                 else: assunto_email = self.email_subject_pt
 
-                anexo = caminho_pdf_gerado if anexar_pdf_var.get() else None
-                threading.Thread(target=self.enviar_email_com_chave, args=(email_comprador, assunto_email, texto_email, anexo), daemon=True).start()
+                anexo = caminho_pdf_gerado if anexar_pdf else None
+                self.enviar_email_com_chave(email_comprador, assunto_email, texto_email, anexo)
                 
-            logar_acao(f"{len(entregues_obj)} chaves entregues para {comprador}"); popup.destroy()
+            popup.destroy()
+            if idioma_pdf: self.gerar_pdf_entrega(entregues_obj, idioma_pdf, comprador, email_comprador, ao_concluir=concluir)
+            else: concluir(None)
 
         f_botoes=ttk.Frame(popup, style="TFrame"); f_botoes.pack(pady=10); ttk.Button(f_botoes, text="Confirmar Entrega", command=entregar).pack(side=tk.LEFT,padx=5); ttk.Button(f_botoes, text="Cancelar", command=popup.destroy).pack(side=tk.LEFT,padx=5)
 
@@ -997,10 +1039,10 @@ class GerenciadorChaves(tk.Tk):
             cat_nome = listbox.get(sel_idx[0])
             try: custo_brl, custo_usd = float(custo_brl_var.get().replace(",",".")), float(custo_usd_var.get().replace(",","."))
             except ValueError: messagebox.showerror("Erro de Formato", "Custos devem ser números.", parent=popup); return
-            self.registrar_undo(); conn = sqlite3.connect(DB_NAME)
             dados = (text_pt.get("1.0",tk.END).strip(),text_en.get("1.0",tk.END).strip(),text_es.get("1.0",tk.END).strip(),custo_brl,custo_usd,logo_path_var.get().strip(),lic_pt_var.get().strip(),lic_en_var.get().strip(),lic_es_var.get().strip(),idiom_pt_var.get().strip(),idiom_en_var.get().strip(),idiom_es_var.get().strip(),entr_pt_var.get().strip(),entr_en_var.get().strip(),entr_es_var.get().strip(),layout_pt.get("1.0",tk.END).strip(),layout_en.get("1.0",tk.END).strip(),layout_es.get("1.0",tk.END).strip(),cat_nome)
             query = "UPDATE categorias SET instrucao_pt=?,instrucao_en=?,instrucao_es=?,custo_padrao_brl=?,custo_padrao_usd=?,logo_path=?,info_licenca_pt=?,info_licenca_en=?,info_licenca_es=?,info_idioma_pt=?,info_idioma_en=?,info_idioma_es=?,info_entrega_pt=?,info_entrega_en=?,info_entrega_es=?,layout_pdf_pt=?,layout_pdf_en=?,layout_pdf_es=? WHERE nome=?"
-            conn.execute(query, dados); conn.commit(); conn.close(); self.salvar_e_atualizar_tudo(); messagebox.showinfo("Sucesso", f"Dados de '{cat_nome}' salvos.", parent=popup)
+            with passo_undo(): db.executar(query, dados)
+            self.aplicar_mudancas(ConjuntoMudancas(categorias=True)); messagebox.showinfo("Sucesso", f"Dados de '{cat_nome}' salvos.", parent=popup)
         def previsualizar_pdf_selecionado():
             if not (sel_idx := listbox.curselection()): messagebox.showwarning("Aviso", "Selecione uma categoria.", parent=popup); return
             cat_nome = listbox.get(sel_idx[0]); idioma_foco = 'pt_br'; focused_widget = popup.focus_get()
@@ -1012,24 +1054,24 @@ class GerenciadorChaves(tk.Tk):
             else: chave_dummy['layout_pdf_es'] = layout_es.get("1.0", tk.END).strip()
             cat_obj_preview = chave_dummy.copy(); cat_obj_preview.update({"logo_path": logo_path_var.get(),"info_licenca_pt": lic_pt_var.get(),"info_idioma_pt": idiom_pt_var.get(),"info_entrega_pt": entr_pt_var.get(),"info_licenca_en": lic_en_var.get(),"info_idioma_en": idiom_en_var.get(),"info_entrega_en": entr_en_var.get(),"info_licenca_es": lic_es_var.get(),"info_idioma_es": idiom_es_var.get(),"info_entrega_es": entr_es_var.get(),})
             self.categoria_dict[cat_nome] = cat_obj_preview
-            caminho_preview = self.gerar_pdf_entrega(chaves_entregues=[chave_dummy],idioma=idioma_foco,comprador="Comprador de Teste",email_comprador="teste@email.com",preview_mode=True)
-            if caminho_preview: webbrowser.open_new(f'file://{os.path.realpath(caminho_preview)}')
-            self.carregar_dados_do_db()
+            abrir = lambda caminho_preview: caminho_preview and webbrowser.open_new(f'file://{os.path.realpath(caminho_preview)}')
+            self.gerar_pdf_entrega(chaves_entregues=[chave_dummy],idioma=idioma_foco,comprador="Comprador de Teste",email_comprador="teste@email.com",preview_mode=True,ao_concluir=abrir)
+            self._carregar_categorias()
         btn_frame = ttk.Frame(main_frame, style="TFrame"); btn_frame.grid(row=1, column=1, sticky="sew", pady=(10,0))
         def add_cat(cb):
             d = CustomAskStringDialog(parent=popup, title="Nova Categoria", prompt="Nome:", style_colors={'bg': self.bg_color, 'fg': self.fg_color, 'entry_bg': self.entry_bg, 'text': self.text_color})
             if nova := d.result:
                 if any(c['nome'].lower() == nova.lower() for c in self.categorias): messagebox.showwarning("Aviso", "Categoria já existe.", parent=popup); return
-                self.registrar_undo(); conn = sqlite3.connect(DB_NAME); conn.execute("INSERT INTO categorias(nome,custo_padrao_brl,custo_padrao_usd) VALUES(?,0.0,0.0)", (nova,)); conn.commit(); conn.close()
-                self.salvar_e_atualizar_tudo(); cb(); logar_acao(f"Categoria adicionada: {nova}")
+                with passo_undo(): db.executar("INSERT INTO categorias(nome,custo_padrao_brl,custo_padrao_usd) VALUES(?,0.0,0.0)", (nova,))
+                self.aplicar_mudancas(ConjuntoMudancas(categorias=True)); cb(); logar_acao(f"Categoria adicionada: {nova}", "categoria", categoria=nova)
         def del_cat(l, cb):
             if not (s := l.curselection()): messagebox.showwarning("Aviso", "Selecione uma categoria.", parent=popup); return
             nc = l.get(s[0])
             if nc == "Sem Categoria": messagebox.showerror("Erro", "'Sem Categoria' não pode ser excluída.", parent=popup); return
             if messagebox.askyesno("Excluir Categoria", f"Deseja excluir '{nc}'?", parent=popup, icon='warning'):
-                self.registrar_undo(); conn = sqlite3.connect(DB_NAME); c = conn.cursor()
-                c.execute("UPDATE chaves SET categoria='Sem Categoria' WHERE categoria=?", (nc,)); c.execute("DELETE FROM categorias WHERE nome=?", (nc,)); conn.commit(); conn.close()
-                self.salvar_e_atualizar_tudo(); cb(); logar_acao(f"Categoria excluída: {nc}")
+                with passo_undo(), db.transacao() as conn:
+                    afetados = [row[0] for row in conn.execute("UPDATE chaves SET categoria='Sem Categoria' WHERE categoria=? RETURNING id", (nc,)).fetchall()]; conn.execute("DELETE FROM categorias WHERE nome=?", (nc,))
+                self.aplicar_mudancas(ConjuntoMudancas(atualizados=afetados, categorias=True)); cb(); logar_acao(f"Categoria excluída: {nc}", "categoria", categoria=nc, chaves=afetados)
         ttk.Button(btn_frame, text="Nova", command=lambda: add_cat(fill_lb)).pack(side=tk.LEFT, padx=(0,5))
         ttk.Button(btn_frame, text="Excluir", command=lambda: del_cat(listbox, fill_lb)).pack(side=tk.LEFT, padx=(0,5))
         ttk.Button(btn_frame, text="Salvar Alterações", command=save_cat, style="Accent.TButton").pack(side=tk.RIGHT)
@@ -1048,7 +1090,7 @@ class GerenciadorChaves(tk.Tk):
             novo_nome = simpledialog.askstring("Adicionar Canal", "Digite o nome do novo canal:", parent=popup)
             if novo_nome and (nome_limpo := novo_nome.strip()):
                 if nome_limpo in self._get_lista_canais_venda(): messagebox.showerror("Erro", f"O canal '{nome_limpo}' já existe.", parent=popup); return
-                self._garantir_canal_venda_existe(nome_limpo); self.salvar_e_atualizar_tudo(); logar_acao(f"Canal '{nome_limpo}' adicionado."); fill_lb()
+                self._garantir_canal_venda_existe(nome_limpo); self.aplicar_mudancas(ConjuntoMudancas(canais=True)); logar_acao(f"Canal '{nome_limpo}' adicionado.", "canal", canal=nome_limpo); fill_lb()
         def renomear_canal():
             if not (sel := lb.curselection()): messagebox.showwarning("Aviso", "Selecione um canal para renomear.", parent=popup); return
             canal_antigo = lb.get(sel[0])
@@ -1056,39 +1098,63 @@ class GerenciadorChaves(tk.Tk):
             if novo_nome and (nome_limpo := novo_nome.strip()):
                 if nome_limpo == canal_antigo: return
                 if nome_limpo in self._get_lista_canais_venda(): messagebox.showerror("Erro", f"O canal '{nome_limpo}' já existe.", parent=popup); return
-                self.registrar_undo(); conn = sqlite3.connect(DB_NAME)
-                conn.execute("UPDATE canais_venda SET nome=? WHERE nome=?", (nome_limpo, canal_antigo)); conn.execute("UPDATE chaves SET canal_venda=? WHERE canal_venda=?", (nome_limpo, canal_antigo)); conn.commit(); conn.close()
-                self.salvar_e_atualizar_tudo(); logar_acao(f"Canal '{canal_antigo}' renomeado para '{nome_limpo}'"); fill_lb()
+                with passo_undo(), db.transacao() as conn:
+                    conn.execute("UPDATE canais_venda SET nome=? WHERE nome=?", (nome_limpo, canal_antigo)); afetados = [row[0] for row in conn.execute("UPDATE chaves SET canal_venda=? WHERE canal_venda=? RETURNING id", (nome_limpo, canal_antigo)).fetchall()]
+                self.aplicar_mudancas(ConjuntoMudancas(atualizados=afetados, canais=True)); logar_acao(f"Canal '{canal_antigo}' renomeado para '{nome_limpo}'", "canal", canal=nome_limpo, chaves=afetados); fill_lb()
         def excluir_canal():
             if not (sel := lb.curselection()): messagebox.showwarning("Aviso", "Selecione um canal para excluir.", parent=popup); return
             canal = lb.get(sel[0])
             if messagebox.askyesno("Confirmar Exclusão", f"Tem certeza que deseja remover o canal '{canal}'?\nIsso o removerá de todas as chaves associadas.", icon='warning', parent=popup):
-                self.registrar_undo(); conn = sqlite3.connect(DB_NAME)
-                conn.execute("DELETE FROM canais_venda WHERE nome=?", (canal,)); conn.execute("UPDATE chaves SET canal_venda=NULL WHERE canal_venda=?", (canal,)); conn.commit(); conn.close()
-                self.salvar_e_atualizar_tudo(); logar_acao(f"Canal '{canal}' excluído"); fill_lb()
+                with passo_undo(), db.transacao() as conn:
+                    conn.execute("DELETE FROM canais_venda WHERE nome=?", (canal,)); afetados = [row[0] for row in conn.execute("UPDATE chaves SET canal_venda=NULL WHERE canal_venda=? RETURNING id", (canal,)).fetchall()]
+                self.aplicar_mudancas(ConjuntoMudancas(atualizados=afetados, canais=True)); logar_acao(f"Canal '{canal}' excluído", "canal", canal=canal, chaves=afetados); fill_lb()
         btn_frame = ttk.Frame(mf, style="TFrame"); btn_frame.grid(row=2, column=0, columnspan=2, pady=(10, 0))
         ttk.Button(btn_frame, text="Adicionar", command=adicionar_canal).pack(side=tk.LEFT, padx=5); ttk.Button(btn_frame, text="Renomear", command=renomear_canal).pack(side=tk.LEFT, padx=5); ttk.Button(btn_frame, text="Excluir", command=excluir_canal).pack(side=tk.LEFT, padx=5); ttk.Button(btn_frame, text="Fechar", command=popup.destroy).pack(side=tk.RIGHT, padx=5)
         fill_lb()
 
     def excluir_chave_selecionada(self, event=None):
-        if not (sel := self.tree.selection()): messagebox.showwarning("Excluir", "Selecione chaves."); return
+        if not (sel := self.tabela.selecao()): messagebox.showwarning("Excluir", "Selecione chaves."); return
         if not messagebox.askyesno("Confirmar", f"Excluir permanentemente as {len(sel)} chaves?", icon='warning'): return
         ids=[self.tree_id_map[i]['id'] for i in sel if i in self.tree_id_map]
         if not ids: messagebox.showerror("Erro","Chaves não encontradas."); return
-        self.registrar_undo(); conn=sqlite3.connect(DB_NAME); conn.execute(f"DELETE FROM chaves WHERE id IN ({','.join('?'*len(ids))})", ids); conn.commit(); conn.close()
-        self.salvar_e_atualizar_tudo(); logar_acao(f"{len(ids)} chaves excluídas."); messagebox.showinfo("Excluído",f"{len(ids)} chaves excluídas.")
+        with passo_undo(): excluidas = excluir_chaves(ids)
+        self.aplicar_mudancas(ConjuntoMudancas(removidos=ids)); messagebox.showinfo("Excluído",f"{len(excluidas)} chaves excluídas.")
 
     def exportar_estoque(self):
-        if not (caminho := filedialog.asksaveasfilename(defaultextension=".csv", filetypes=[("CSV", "*.csv"), ("All", "*.*")])): return
-        try:
-            conn=sqlite3.connect(DB_NAME); cursor=conn.cursor()
-            cursor.execute("SELECT chave, categoria, vendida, comprador, canal_venda, data_venda, preco_venda_brl, preco_venda_usd FROM chaves ORDER BY ordem_manual ASC")
-            with open(caminho,"w",encoding="utf-8",newline='') as f:
-                import csv
-                w=csv.writer(f); w.writerow(["Chave","Categoria","Status","Comprador", "Canal de Venda", "Data","PrecoBRL","PrecoUSD"])
-                for row in cursor.fetchall(): r=list(row); r[2]="Vendida" if r[2]==1 else "Disponível"; w.writerow(r)
-            conn.close(); messagebox.showinfo("Exportar", "Estoque exportado com sucesso.")
-        except Exception as e: messagebox.showerror("Erro", f"Erro ao exportar:\n{e}")
+        """Exporta em segundo plano (exportar_chaves), com progresso e cancelamento; com algum filtro ativo na barra,
+        pergunta se exporta só o que está filtrado."""
+        filtros = dict(busca=self._busca_aplicada, categoria=self.categoria_var.get(), canal=self.canal_venda_var.get(), status=self.status_var.get(), usar_fts=self.motor_busca.usar_fts)
+        if self.modo_consulta and self._ordem_sql: filtros.update(ordenar_por=self._ordem_sql[0], decrescente=self._ordem_sql[1])
+        if filtros["busca"] or any(filtros[f] != "Todos" for f in ("categoria", "canal", "status")):
+            if (so_filtradas := messagebox.askyesnocancel("Exportar", f"Exportar só as {len(self.tabela.linhas):,} chave(s) do filtro atual?\n\n(Não = estoque inteiro)")) is None: return
+            if not so_filtradas: filtros = dict(usar_fts=self.motor_busca.usar_fts)
+        tipos = [("CSV", "*.csv"), ("CSV compactado", "*.csv.gz"), ("Excel", "*.xlsx"), ("JSON Lines", "*.jsonl"), ("JSON Lines compactado", "*.jsonl.gz")]
+        if not (caminho := filedialog.asksaveasfilename(defaultextension=".csv", filetypes=tipos)): return
+        try: formato_exportacao(caminho)
+        except ValueError as e: messagebox.showerror("Exportar", str(e)); return
+        popup = tk.Toplevel(self); popup.title("Exportando Estoque"); popup.geometry("420x150"); popup.resizable(False, False); popup.grab_set(); popup.configure(bg=self.bg_color)
+        mf = ttk.Frame(popup, padding=15, style="TFrame"); mf.pack(fill=tk.BOTH, expand=True)
+        ttk.Label(mf, text=f"Exportando para {os.path.basename(caminho)}...").pack(anchor="w")
+        barra = ttk.Progressbar(mf, mode="determinate", maximum=1.0); barra.pack(fill=tk.X, pady=8)
+        status_var = tk.StringVar(value="Consultando..."); ttk.Label(mf, textvariable=status_var).pack(anchor="w")
+        cancelar, estado = threading.Event(), {"feitos": 0, "total": 0, "concluido": False, "resultado": None, "erro": None}
+        botao = ttk.Button(mf, text="Cancelar", command=lambda: (cancelar.set(), botao.config(state="disabled"), status_var.set("Cancelando..."))); botao.pack(pady=(8, 0))
+        popup.protocol("WM_DELETE_WINDOW", cancelar.set)
+        def trabalhar():
+            try: estado["resultado"] = exportar_chaves(caminho, filtros, cancelar=cancelar, ao_progresso=lambda feitos, total: estado.update(feitos=feitos, total=total))
+            except Exception as e: estado["erro"] = e
+            finally: estado["concluido"] = True; db.fechar_da_thread()
+        threading.Thread(target=trabalhar, daemon=True).start()
+        def acompanhar():
+            if not estado["concluido"]:
+                if estado["total"]: barra["value"] = estado["feitos"] / estado["total"]
+                if not cancelar.is_set(): status_var.set(f"{estado['feitos']:,} de {estado['total']:,} chave(s)...")
+                popup.after(100, acompanhar); return
+            popup.destroy()
+            if isinstance(erro := estado["erro"], ImportError): messagebox.showerror("Biblioteca Faltando", str(erro), parent=self)
+            elif erro is not None: messagebox.showerror("Erro", f"Erro ao exportar:\n{erro}", parent=self)
+            elif estado["resultado"] is not None: logar_acao(f"{estado['resultado']} chaves exportadas para {caminho}", "exportacao"); messagebox.showinfo("Exportar", f"{estado['resultado']:,} chave(s) exportada(s) com sucesso.", parent=self)
+        popup.after(100, acompanhar)
 
     def atualizar_combo_categoria(self):
         nomes = sorted([cat['nome'] for cat in self.categorias]); self.combo_categoria['values'] = ["Todos"] + nomes
@@ -1098,52 +1164,97 @@ class GerenciadorChaves(tk.Tk):
         nomes = self._get_lista_canais_venda(); self.combo_canal_venda['values'] = ["Todos", "Nenhum"] + nomes
         if self.canal_venda_var.get() not in self.combo_canal_venda['values']: self.canal_venda_var.set("Todos")
 
+    def _filtro_atual(self):
+        """Predicado dos filtros da barra (lidos uma vez; ler as variáveis do Tk por item custa caro em estoques grandes)."""
+        return filtro_chaves(self.busca_var.get().lower(), self.categoria_var.get(), self.canal_venda_var.get(), self.status_var.get(), self.motor_busca.corresponde)
+
+    def _passa_filtro(self, i): return self._filtro_atual()(i)
+
+    _chave_ordem = staticmethod(chave_ordem)
+
+    @staticmethod
+    def _valores_linha(item):
+        tag="vendida" if item.get("vendida",0) else "disponivel"
+        return (item["chave"], item.get("categoria","S/C"), "Vendida" if item.get("vendida") else "Disponível", item.get("comprador") or "", item.get("canal_venda") or "", item.get("data_venda") or ""), tag
+
+    def _agendar_busca(self, event=None):
+        """Debounce da busca: só refiltra quando a digitação pausa e o texto de fato mudou."""
+        if self._busca_pendente: self.after_cancel(self._busca_pendente)
+        self._busca_pendente = self.after(BUSCA_DEBOUNCE_MS, self._executar_busca)
+
+    def _executar_busca(self):
+        self._busca_pendente = None
+        if self.busca_var.get().lower() != self._busca_aplicada: self.atualizar_tabela()
+
+    @metricas.medido("tabela.atualizar")
     def atualizar_tabela(self, event=None):
-        self.is_manually_sorted=True; sel_previa = self.tree.selection(); self.tree.delete(*self.tree.get_children()); self.tree_id_map={i['tree_id']:i for i in self.estoque}
+        self.is_manually_sorted=True
         self.tree.tag_configure("vendida",background="#4a2e2e",foreground="#f09090"); self.tree.tag_configure("disponivel",background="#2e4d2e",foreground="#a0eea0")
-        busca,cat_f,stat_f,canal_f = self.busca_var.get().lower(),self.categoria_var.get(),self.status_var.get(),self.canal_venda_var.get()
-        filtrada=self.estoque
-        if busca: filtrada=[i for i in filtrada if busca in i['chave'].lower() or busca in i.get('categoria','').lower() or busca in (i.get('comprador')or'').lower() or busca in (i.get('canal_venda')or'').lower()]
-        if cat_f != "Todos": filtrada=[i for i in filtrada if i.get("categoria")==cat_f]
-        if canal_f == "Todos": pass
-        elif canal_f == "Nenhum": filtrada = [i for i in filtrada if not i.get("canal_venda")]
-        else: filtrada = [i for i in filtrada if i.get("canal_venda") == canal_f]
-        if stat_f != "Todos": filtrada=[i for i in filtrada if i.get("vendida",0)==(1 if stat_f=="Vendida" else 0)]
-        filtrada.sort(key=lambda x:x.get('ordem_manual',x.get('id')))
-        for item in filtrada:
-            tag="vendida" if item.get("vendida",0) else "disponivel"
-            valores = (item["chave"], item.get("categoria","S/C"), "Vendida" if item.get("vendida") else "Disponível", item.get("comprador") or "", item.get("canal_venda") or "", item.get("data_venda") or "")
-            self.tree.insert("",tk.END,iid=item['tree_id'],values=valores,tags=(tag,))
-        try: self.tree.selection_set([i for i in sel_previa if self.tree.exists(i)])
-        except tk.TclError: pass
+        busca = self._busca_aplicada = self.busca_var.get().lower()
+        if self.modo_consulta: self._ordem_sql = None; self._consultar_tabela(); self.atualizar_status_bar(); return
+        ordens = self.estoque.filtrar(self.categoria_var.get(), self.canal_venda_var.get(), self.status_var.get(), self.motor_busca.buscar(busca) if busca else None)
+        self._ordens_exibidas = ordens  # Paralela a self.tabela.linhas (ordem manual), para inserções por bisect.
+        self.tabela.definir_linhas([f"I{id_chave:08X}" for _, id_chave in ordens])  # A seleção (por id) sobrevive ao refiltro.
         self.atualizar_status_bar()
 
+    def _consultar_tabela(self):
+        """Modo consulta: filtros e ordenação viram um SELECT parametrizado; só os ids do resultado ficam em memória."""
+        coluna, decrescente = self._ordem_sql or (None, False)
+        sql, params = montar_consulta_chaves(self._busca_aplicada, self.categoria_var.get(), self.canal_venda_var.get(), self.status_var.get(), coluna, decrescente, usar_fts=self.motor_busca.usar_fts)
+        self.tabela.definir_linhas([f"I{row[0]:08X}" for row in db.consultar(sql, params)])
+
+    def _atualizar_linha_tree(self, item, ordem_antiga=None):
+        """Reposiciona/inclui/exclui a linha do item na tabela virtual; o redesenho fica para quem chamou (renderizar)."""
+        existe = item['tree_id'] in self.tabela
+        if not self._passa_filtro(item):
+            if existe: self._remover_linha_tree(item, ordem_antiga)
+            return
+        ordem = self._chave_ordem(item)
+        if existe:
+            if not self.is_manually_sorted or ordem_antiga in (None, ordem): return
+            self._remover_linha_tree(item, ordem_antiga)
+        if self.is_manually_sorted:
+            pos = bisect.bisect_left(self._ordens_exibidas, ordem); self._ordens_exibidas.insert(pos, ordem)
+        else: pos = len(self.tabela)
+        self.tabela.inserir(pos, item['tree_id'])
+
+    def _remover_linha_tree(self, item, ordem_antiga=None):
+        if item['tree_id'] not in self.tabela: return
+        self.tabela.remover(item['tree_id'], self._descartar_ordem_exibida(ordem_antiga or self._chave_ordem(item)))
+
+    def _descartar_ordem_exibida(self, ordem):
+        """Remove a ordem de _ordens_exibidas e devolve sua posição (que é a mesma da linha na tabela), ou None."""
+        if not self.is_manually_sorted: return None
+        pos = bisect.bisect_left(self._ordens_exibidas, ordem)
+        if pos < len(self._ordens_exibidas) and self._ordens_exibidas[pos] == ordem: del self._ordens_exibidas[pos]; return pos
+        return None
+
     def atualizar_status_bar(self, event=None):
-        texto = f"Total: {len(self.estoque)} | Mostrando: {len(self.tree.get_children())} | Selecionadas: {len(self.tree.selection())}"; self.status_counts_var.set(texto)
+        texto = f"Total: {len(self.estoque)} | Mostrando: {len(self.tabela)} | Selecionadas: {len(self.tabela.selecionados)}"
+        self.status_counts_var.set(texto + (" | Carregando estoque..." if self._carga_pendente else ""))
 
     def ordenar_por(self, col):
         self.is_manually_sorted = False; rev = getattr(self,"ord_rev",False) if getattr(self,"last_col",None)==col else False
-        lista=[(self.tree.item(i,'values'), i) for i in self.tree.get_children()]; col_idx = self.tree["columns"].index(col)
-        lista.sort(key=lambda x:str(x[0][col_idx] or "").lower(), reverse=rev)
-        for i,(v,iid) in enumerate(lista): self.tree.move(iid, '', i)
+        if self.modo_consulta: self._ordem_sql = (col, rev); self._consultar_tabela(); self.last_col=col; self.ord_rev = not rev; return
+        chave = self.estoque.chave_ordenacao(col); self.tabela.ordenar(key=lambda tid: chave(int(tid[1:], 16)), reverse=rev)
         self.last_col=col; self.ord_rev = not rev
 
     def copiar_chave_selecionada(self, event=None):
         if event is not None and isinstance(self.focus_get(), (tk.Text, ttk.Entry, tk.Listbox)): return
-        if not (sel := self.tree.selection()):
+        if not (sel := self.tabela.selecao()):
             if event is None: messagebox.showwarning("Copiar", "Selecione uma ou mais chaves na tabela.")
             return
-        pyperclip.copy("\n".join([self.tree.item(i,"values")[0] for i in sel]))
+        pyperclip.copy("\n".join([self.tree_id_map[i]['chave'] for i in sel]))
         if event is None: messagebox.showinfo("Copiado", f"{len(sel)} chave(s) copiada(s).")
 
     def acao_editar_selecao(self, event=None):
-        sel=self.tree.selection()
+        sel=self.tabela.selecao()
         if len(sel) == 0: messagebox.showwarning("Editar","Selecione uma chave."); return
         elif len(sel)==1: self.janela_editar_chave()
         else: self.janela_editar_varias_chaves()
 
     def janela_editar_varias_chaves(self):
-        sel, num_chaves = self.tree.selection(), len(self.tree.selection())
+        sel = self.tabela.selecao(); num_chaves = len(sel)
         popup = tk.Toplevel(self); popup.title("Edição em Massa"); popup.geometry("450x350"); popup.grab_set(); popup.resizable(False,False); popup.configure(bg=self.bg_color)
         mf = ttk.Frame(popup,padding=15, style="TFrame"); mf.pack(fill=tk.BOTH, expand=True)
         ttk.Label(mf,text=f"Editando {num_chaves} chaves",font=('Segoe UI',12,'bold')).pack(pady=(0,20))
@@ -1157,19 +1268,19 @@ class GerenciadorChaves(tk.Tk):
             ids_editar=[self.tree_id_map[i]['id'] for i in sel if i in self.tree_id_map]; canal_selecionado = canal_var.get().strip() or None
             if not ids_editar: return
             if canal_selecionado: self._garantir_canal_venda_existe(canal_selecionado)
-            self.registrar_undo(); campos_upd, params = [],[]
+            campos_upd, params = [],[]
             if alt_cat.get(): campos_upd.append("categoria=?"); params.append(cat_var.get())
             if alt_canal.get(): campos_upd.append("canal_venda=?"); params.append(canal_selecionado)
             if alt_stat.get():
                 vendida=1 if stat_var.get()=="Vendida" else 0; campos_upd.append("vendida=?"); params.append(vendida)
                 if not vendida: campos_upd.extend(["comprador=NULL","data_venda=NULL","preco_venda_brl=NULL","preco_venda_usd=NULL"])
             placeh = ','.join(['?']*len(ids_editar)); query=f"UPDATE chaves SET {', '.join(campos_upd)} WHERE id IN ({placeh})"; params.extend(ids_editar)
-            conn=sqlite3.connect(DB_NAME); conn.execute(query,params); conn.commit(); conn.close()
-            self.salvar_e_atualizar_tudo(); logar_acao(f"Edição em massa em {num_chaves} chaves."); messagebox.showinfo("Sucesso","Chaves atualizadas.",parent=self); popup.destroy()
+            with passo_undo(): db.executar(query,params)
+            self.aplicar_mudancas(ConjuntoMudancas(atualizados=ids_editar, canais=bool(canal_selecionado))); logar_acao(f"Edição em massa em {num_chaves} chaves.", "edicao", chaves=ids_editar); messagebox.showinfo("Sucesso","Chaves atualizadas.",parent=self); popup.destroy()
         fb=ttk.Frame(popup, style="TFrame"); fb.pack(side=tk.BOTTOM, pady=15); ttk.Button(fb,text="Salvar",command=salvar_massa).pack(side=tk.LEFT,padx=5); ttk.Button(fb,text="Cancelar",command=popup.destroy).pack(side=tk.LEFT,padx=5)
 
     def janela_editar_chave(self, event=None):
-        if not(sel_id:=self.tree.selection()): messagebox.showwarning("Editar","Selecione uma chave."); return
+        if not(sel_id:=self.tabela.selecao()): messagebox.showwarning("Editar","Selecione uma chave."); return
         if not(chave_obj:=self.tree_id_map.get(sel_id[0])): messagebox.showerror("Erro", "Chave não encontrada."); return
         popup=tk.Toplevel(self); popup.title("Editar Chave"); popup.geometry("400x580"); popup.grab_set(); popup.configure(bg=self.bg_color)
         mf=ttk.Frame(popup,padding=10, style="TFrame"); mf.pack(fill=tk.BOTH,expand=True)
@@ -1186,20 +1297,28 @@ class GerenciadorChaves(tk.Tk):
             if not(nova_chave := entry_chave.get("1.0",tk.END).strip()): messagebox.showwarning("Aviso", "Chave não pode ser vazia.", parent=popup); return
             try: preco_brl,preco_usd = float(entry_brl.get().replace(",","")),float(entry_usd.get().replace(",",""))
             except ValueError: messagebox.showerror("Erro", "Preços devem ser numéricos.", parent=popup); return
-            self.registrar_undo(); vendida=1 if status_var.get()=="Vendida" else 0; canal_venda = canal_var.get().strip() or None; comprador=entry_comp.get().strip() if vendida else None; data_venda=entry_data.get().strip() if vendida else None
-            if canal_venda: self._garantir_canal_venda_existe(canal_venda)
+            vendida=1 if status_var.get()=="Vendida" else 0; canal_venda = canal_var.get().strip() or None; comprador=entry_comp.get().strip() if vendida else None; data_venda=entry_data.get().strip() if vendida else None
             if vendida and comprador and not data_venda: data_venda=f"{datetime.now():%Y-%m-%d %H:%M:%S}"
             if not vendida: comprador,data_venda,preco_brl,preco_usd=None,None,None,None
-            conn=sqlite3.connect(DB_NAME); conn.execute("UPDATE chaves SET chave=?,categoria=?,vendida=?,comprador=?,data_venda=?,preco_venda_brl=?,preco_venda_usd=?,canal_venda=? WHERE id=?",(nova_chave,cat_var.get(),vendida,comprador,data_venda,preco_brl,preco_usd,canal_venda,chave_obj['id'])); conn.commit(); conn.close()
-            self.salvar_e_atualizar_tudo(); logar_acao(f"Chave ID {chave_obj['id']} editada."); messagebox.showinfo("Sucesso","Chave atualizada.",parent=self); popup.destroy()
+            with passo_undo():
+                if canal_venda: self._garantir_canal_venda_existe(canal_venda)
+                db.executar("UPDATE chaves SET chave=?,categoria=?,vendida=?,comprador=?,data_venda=?,preco_venda_brl=?,preco_venda_usd=?,canal_venda=? WHERE id=?",(nova_chave,cat_var.get(),vendida,comprador,data_venda,preco_brl,preco_usd,canal_venda,chave_obj['id']))
+            self.aplicar_mudancas(ConjuntoMudancas(atualizados=[chave_obj['id']], canais=bool(canal_venda))); logar_acao(f"Chave ID {chave_obj['id']} editada.", "edicao", chaves=[chave_obj['id']]); messagebox.showinfo("Sucesso","Chave atualizada.",parent=self); popup.destroy()
         fb=ttk.Frame(mf, style="TFrame"); fb.pack(pady=20); ttk.Button(fb,text="Salvar",command=salvar).pack(side=tk.LEFT,padx=5); ttk.Button(fb,text="Cancelar",command=popup.destroy).pack(side=tk.LEFT,padx=5)
     
-    def obter_cotacao_dolar(self, cotacao_var):
-        try:
-            api_url = "https://economia.awesomeapi.com.br/last/USD-BRL"; response = requests.get(api_url, timeout=5)
-            response.raise_for_status(); data = response.json(); cotacao = float(data['USDBRL']['bid']); cotacao_var.set(f"{cotacao:.2f}")
-        except requests.exceptions.RequestException as e: messagebox.showwarning("Erro de Rede", f"Não foi possível buscar a cotação do dólar.\nVerifique sua conexão ou a API.\nErro: {e}", parent=self)
-        except Exception as e: messagebox.showerror("Erro Inesperado", f"Ocorreu um erro ao processar a cotação.\n{e}", parent=self)
+    def atualizar_cotacao(self, cotacao_var, data_ini=None, data_fim=None, forcar=False, ao_concluir=None):
+        """Atualiza a cotação (e as dos dias do período) em segundo plano; cotacao_var e ao_concluir() mudam na thread
+        da interface quando a resposta chegar. Sem rede, só um clique no botão ('forcar') mostra o aviso."""
+        futuro = self.servico_cotacao.atualizar(data_ini, data_fim, forcar)
+        if futuro.done() and not forcar: return
+        def acompanhar():
+            if not futuro.done(): self.after(100, acompanhar); return
+            try: cotacao_var.set(f"{futuro.result():.2f}")
+            except Exception as e:
+                logar_acao(f"Falha ao atualizar a cotação do dólar: {e}", "erro")
+                if forcar: messagebox.showwarning("Erro de Rede", f"Não foi possível buscar a cotação do dólar.\nVerifique sua conexão ou a API.\nErro: {e}", parent=self)
+            if ao_concluir: ao_concluir()
+        acompanhar()
 
     def janela_dashboard_vendas(self):
         popup = tk.Toplevel(self); popup.title("Dashboard de Vendas"); popup.geometry("1000x600"); popup.grab_set(); popup.configure(bg=self.bg_color)
@@ -1223,9 +1342,11 @@ class GerenciadorChaves(tk.Tk):
             e_data_ini.config(state='normal'); e_data_fim.config(state='normal'); e_data_ini.delete(0, tk.END); e_data_ini.insert(0, d_ini.strftime("%Y-%m-%d")); e_data_fim.delete(0, tk.END); e_data_fim.insert(0, d_fim.strftime("%Y-%m-%d")); e_data_ini.config(state='readonly'); e_data_fim.config(state='readonly'); gerar_relatorio()
         combo_periodo.bind("<<ComboboxSelected>>", _set_date_from_preset)
         ttk.Button(content_filtro, text="Gerar Relatório", command=lambda: gerar_relatorio()).pack(side=tk.RIGHT, padx=(10,5), pady=10)
-        ttk.Button(content_filtro, text="Atualizar Cotação", command=lambda: self.obter_cotacao_dolar(cotacao_var), width=18).pack(side=tk.RIGHT, padx=(5,5), pady=10)
-        e_cotacao = ttk.Entry(content_filtro,textvariable=(cotacao_var:=tk.StringVar(value="5.00")), width=8); e_cotacao.pack(side=tk.RIGHT, pady=10)
+        ttk.Button(content_filtro, text="Atualizar Cotação", command=lambda: self.atualizar_cotacao(cotacao_var, e_data_ini.get(), e_data_fim.get(), forcar=True, ao_concluir=recarregar), width=18).pack(side=tk.RIGHT, padx=(5,5), pady=10)
+        e_cotacao = ttk.Entry(content_filtro,textvariable=(cotacao_var:=tk.StringVar(value=f"{self.servico_cotacao.atual() or 5.0:.2f}")), width=8); e_cotacao.pack(side=tk.RIGHT, pady=10)
         ttk.Label(content_filtro, text="Cotação Dólar(R$):").pack(side=tk.RIGHT,padx=(15,2),pady=10)
+        historica_var = tk.BooleanVar(value=True)
+        ttk.Checkbutton(content_filtro, text="Cotação do dia da venda", variable=historica_var, command=lambda: gerar_relatorio()).pack(side=tk.RIGHT, padx=(15,0), pady=10)
         resumo_f = ttk.LabelFrame(mf,text=" Resumo do Período "); resumo_f.grid(row=1,column=0,sticky="ew",pady=10)
         content_resumo = ttk.Frame(resumo_f, style="TFrame"); content_resumo.pack(fill="x", expand=True, padx=5, pady=5)
         for i in range(3): content_resumo.columnconfigure(i, weight=1)
@@ -1235,6 +1356,11 @@ class GerenciadorChaves(tk.Tk):
         ttk.Label(content_resumo,textvariable=lucro_tot,foreground="#90ee90",font=('Segoe UI',12,'bold')).grid(row=1,column=0,columnspan=2,sticky="w",padx=10,pady=5)
         ttk.Label(content_resumo,textvariable=tot_vendas,font=('Segoe UI',11,'bold')).grid(row=0,rowspan=2,column=2,sticky="e",padx=20)
         detalhes_f = ttk.LabelFrame(mf,text=" Detalhes por Categoria (Valores em R$) "); detalhes_f.grid(row=2,column=0,sticky="nsew",pady=10)
+        agrupamentos = {"Categoria": "por_categoria", "Canal": "por_canal", "Dia": "por_dia"}; agrupar_var = tk.StringVar(value="Categoria")
+        agrupar_f = ttk.Frame(detalhes_f, style="TFrame"); agrupar_f.pack(fill="x", padx=5, pady=(5,0))
+        ttk.Label(agrupar_f, text="Agrupar por:").pack(side=tk.LEFT, padx=(5,5))
+        combo_agrupar = ttk.Combobox(agrupar_f, textvariable=agrupar_var, state="readonly", width=12, values=list(agrupamentos)); combo_agrupar.pack(side=tk.LEFT)
+        combo_agrupar.bind("<<ComboboxSelected>>", lambda e: gerar_relatorio())
         content_detalhes = ttk.Frame(detalhes_f, style="TFrame"); content_detalhes.pack(fill="both", expand=True); content_detalhes.rowconfigure(0, weight=1); content_detalhes.columnconfigure(0, weight=1)
         tree = ttk.Treeview(content_detalhes,columns=("cat","qtd","rec","custo","lucro","lucro_medio"),show="headings"); tree.grid(row=0,column=0,sticky="nsew")
         ys = ttk.Scrollbar(content_detalhes, orient='vertical', command=tree.yview); tree.configure(yscrollcommand=ys.set); ys.grid(row=0, column=1, sticky='ns')
@@ -1248,65 +1374,80 @@ class GerenciadorChaves(tk.Tk):
             if not e_data_ini.get() or not e_data_fim.get(): return
             try: cotacao=float(cotacao_var.get().replace(",","."))
             except ValueError: messagebox.showerror("Erro", "Cotação inválida.",parent=popup); return
-            d_ini, d_fim = e_data_ini.get(), e_data_fim.get()
-            try: dt_fim_query=(datetime.strptime(d_fim,"%Y-%m-%d")+timedelta(days=1)).strftime("%Y-%m-%d"); dt_ini_query = datetime.strptime(d_ini,"%Y-%m-%d").strftime("%Y-%m-%d")
+            try: rel = relatorio_vendas(e_data_ini.get(), e_data_fim.get(), cotacao, historica_var.get())
             except ValueError: messagebox.showerror("Erro","Formato de data inválido (Use AAAA-MM-DD).",parent=popup); return
-            conn=sqlite3.connect(DB_NAME); conn.row_factory=sqlite3.Row; c=conn.cursor()
-            c.execute("SELECT c.categoria,c.preco_venda_brl,c.preco_venda_usd,cat.custo_padrao_brl,cat.custo_padrao_usd FROM chaves AS c LEFT JOIN categorias AS cat ON c.categoria=cat.nome WHERE c.vendida=1 AND c.data_venda>=? AND c.data_venda<?", (dt_ini_query, dt_fim_query))
-            vendas = c.fetchall(); conn.close()
-            tot_rec, tot_custo = 0.0, 0.0; stats = defaultdict(lambda:{"qtd":0, "rec":0, "custo":0})
-            for v in vendas:
-                rec_conv = (v["preco_venda_brl"] or 0) + ((v["preco_venda_usd"] or 0) * cotacao); custo_conv = (v["custo_padrao_brl"] or 0) + ((v["custo_padrao_usd"] or 0) * cotacao)
-                tot_rec += rec_conv; tot_custo += custo_conv; cat_nome = v["categoria"] if v["categoria"] else "Sem Categoria"
-                stats[cat_nome]['qtd'] += 1; stats[cat_nome]['rec'] += rec_conv; stats[cat_nome]['custo'] += custo_conv
-            tot_lucro = tot_rec - tot_custo
-            tot_vendas.set(f"Vendas: {len(vendas)}"); rec_tot.set(f"Receita TOTAL: {format_brl(tot_rec)} / {format_usd(tot_rec, cotacao)}"); custo_tot.set(f"Custo TOTAL: {format_brl(tot_custo)} / {format_usd(tot_custo, cotacao)}"); lucro_tot.set(f"LUCRO TOTAL: {format_brl(tot_lucro)} / {format_usd(tot_lucro, cotacao)}")
+            tot_rec, tot_custo, tot_lucro, stats = rel["receita"], rel["custo"], rel["lucro"], rel[agrupamentos[agrupar_var.get()]]
+            detalhes_f.config(text=f" Detalhes por {agrupar_var.get()} (Valores em R$) "); tree.heading("cat", text=agrupar_var.get())
+            tot_vendas.set(f"Vendas: {rel['vendas']}"); rec_tot.set(f"Receita TOTAL: {format_brl(tot_rec)} / {format_usd(tot_rec, cotacao)}"); custo_tot.set(f"Custo TOTAL: {format_brl(tot_custo)} / {format_usd(tot_custo, cotacao)}"); lucro_tot.set(f"LUCRO TOTAL: {format_brl(tot_lucro)} / {format_usd(tot_lucro, cotacao)}")
             tree.delete(*tree.get_children())
             for cat, data in sorted(stats.items()):
                 lucro = data['rec'] - data['custo']; lucro_m = lucro / data['qtd'] if data['qtd'] else 0
                 tree.insert("","end", values=(cat, data['qtd'], format_brl(data['rec']), format_brl(data['custo']), format_brl(lucro), format_brl(lucro_m)))
-        self.obter_cotacao_dolar(cotacao_var); popup.after(150, _set_date_from_preset)
+            # Mostra já com as cotações gravadas; as que faltarem chegam em segundo plano e o relatório é refeito.
+            if historica_var.get(): self.atualizar_cotacao(cotacao_var, e_data_ini.get(), e_data_fim.get(), ao_concluir=recarregar)
+        def recarregar():
+            if popup.winfo_exists(): gerar_relatorio()
+        popup.after(150, _set_date_from_preset)
 
     def janela_configurar_email(self):
-        popup = tk.Toplevel(self); popup.title("Configurações de Email"); popup.geometry("500x300"); popup.grab_set(); popup.resizable(False, False); popup.configure(bg=self.bg_color)
+        popup = tk.Toplevel(self); popup.title("Configurações de Email"); popup.geometry("500x360"); popup.grab_set(); popup.resizable(False, False); popup.configure(bg=self.bg_color)
         mf = ttk.Frame(popup, padding=15, style="TFrame"); mf.pack(fill=tk.BOTH, expand=True); mf.columnconfigure(1, weight=1)
-        config = self.carregar_config_email()
+        config = carregar_config_email()
         email_var = tk.StringVar(value=config.get("email", "")); senha_var = tk.StringVar(value=config.get("senha", "")); servidor_var = tk.StringVar(value=config.get("servidor", "smtp.gmail.com")); porta_var = tk.StringVar(value=config.get("porta", "587"))
+        tls_var = tk.BooleanVar(value=config.get("tls", True)); login_var = tk.BooleanVar(value=config.get("login", True))
         ttk.Label(mf, text="Email do Remetente:").grid(row=0, column=0, sticky="w", pady=5, padx=5); ttk.Entry(mf, textvariable=email_var).grid(row=0, column=1, sticky="ew", pady=5, padx=5)
         ttk.Label(mf, text="Senha/App Password:").grid(row=1, column=0, sticky="w", pady=5, padx=5); ttk.Entry(mf, textvariable=senha_var, show="*").grid(row=1, column=1, sticky="ew", pady=5, padx=5)
         ttk.Label(mf, text="Servidor SMTP:").grid(row=2, column=0, sticky="w", pady=5, padx=5); ttk.Entry(mf, textvariable=servidor_var).grid(row=2, column=1, sticky="ew", pady=5, padx=5)
         ttk.Label(mf, text="Porta SMTP:").grid(row=3, column=0, sticky="w", pady=5, padx=5); ttk.Entry(mf, textvariable=porta_var).grid(row=3, column=1, sticky="ew", pady=5, padx=5)
-        ttk.Label(mf, text="Atenção: Use 'Senhas de App' para Gmail, Outlook, etc.", font=('Segoe UI', 8, 'italic'), foreground="yellow").grid(row=4, column=0, columnspan=2, pady=(10,0))
+        ttk.Checkbutton(mf, text="Usar STARTTLS", variable=tls_var).grid(row=4, column=0, sticky="w", pady=5, padx=5); ttk.Checkbutton(mf, text="Autenticar (login)", variable=login_var).grid(row=4, column=1, sticky="w", pady=5, padx=5)
+        ttk.Label(mf, text="Atenção: Use 'Senhas de App' para Gmail, Outlook, etc.\nDesmarque STARTTLS e login para um servidor SMTP local de testes.", font=('Segoe UI', 8, 'italic'), foreground="yellow", justify=tk.CENTER).grid(row=5, column=0, columnspan=2, pady=(10,0))
         def salvar_config():
-            nova_config = {"email": email_var.get().strip(), "senha": senha_var.get().strip(), "servidor": servidor_var.get().strip(), "porta": porta_var.get().strip()}
+            nova_config = {"email": email_var.get().strip(), "senha": senha_var.get().strip(), "servidor": servidor_var.get().strip(), "porta": porta_var.get().strip(), "tls": tls_var.get(), "login": login_var.get()}
             with open(EMAIL_CONFIG_FILE, "w") as f: json.dump(nova_config, f, indent=4)
             messagebox.showinfo("Sucesso", "Configurações de email salvas!", parent=popup); popup.destroy()
         botoes_f = ttk.Frame(popup, style="TFrame"); botoes_f.pack(pady=10)
         ttk.Button(botoes_f, text="Salvar", command=salvar_config).pack(side=tk.LEFT, padx=5); ttk.Button(botoes_f, text="Cancelar", command=popup.destroy).pack(side=tk.LEFT, padx=5)
 
-    def carregar_config_email(self):
-        try:
-            with open(EMAIL_CONFIG_FILE, "r") as f: return json.load(f)
-        except (FileNotFoundError, json.JSONDecodeError): return {}
-
     def enviar_email_com_chave(self, destinatario, assunto, corpo, caminho_anexo=None):
-        config = self.carregar_config_email()
-        if not all(k in config and config[k] for k in ["email", "senha", "servidor", "porta"]):
-            logar_acao("ERRO: Tentativa de enviar email sem configuração completa."); messagebox.showwarning("Email não Configurado", "As configurações de email estão incompletas.\n\nVá em Ferramentas > Configurar Email... para ajustá-las."); return
+        """Enfileira o email; o envio e as novas tentativas ficam com a fila (ver _processar_eventos_email)."""
+        if not config_email_completa(carregar_config_email()):
+            logar_acao("ERRO: Tentativa de enviar email sem configuração completa.", "erro"); messagebox.showwarning("Email não Configurado", "As configurações de email estão incompletas.\n\nVá em Ferramentas > Configurar Email... para ajustá-las."); return
+        self.fila_email.enfileirar(destinatario, assunto, corpo, caminho_anexo); self._atualizar_status_email()
+
+    def _processar_eventos_email(self):
+        """Lê, no loop do Tk, os eventos publicados pela thread da fila de email."""
         try:
-            msg = MIMEMultipart(); msg['From'] = config['email']; msg['To'] = destinatario; msg['Subject'] = assunto
-            corpo_html = corpo.replace('\n', '<br>'); corpo_html = re.sub(r'\*\*(.*?)\*\*', r'<b>\1</b>', corpo_html); msg.attach(MIMEText(corpo_html, 'html', 'utf-8'))
-            if caminho_anexo and os.path.exists(caminho_anexo):
-                with open(caminho_anexo, "rb") as anexo_file: part = MIMEApplication(anexo_file.read(), Name=os.path.basename(caminho_anexo))
-                part['Content-Disposition'] = f'attachment; filename="{os.path.basename(caminho_anexo)}"'
-                msg.attach(part); logar_acao(f"Anexando PDF: {caminho_anexo}")
-            server = smtplib.SMTP(config['servidor'], int(config['porta'])); server.starttls(); server.login(config['email'], config['senha']); server.sendmail(config['email'], destinatario, msg.as_string()); server.quit()
-            logar_acao(f"Email enviado com sucesso para {destinatario}"); messagebox.showinfo("Email Enviado", f"Email enviado com sucesso para {destinatario}.")
-        except Exception as e: logar_acao(f"FALHA ao enviar email para {destinatario}. Erro: {e}"); messagebox.showerror("Erro de Email", f"Não foi possível enviar o email.\n\nVerifique suas configurações, conexão e senha de app.\n\nErro: {e}")
+            while True:
+                tipo, _, destinatario, erro = self.fila_email.eventos.get_nowait()
+                if tipo == 'enviado': self._atualizar_status_email(f"Email enviado para {destinatario}.")
+                elif tipo == 'reagendado': self._atualizar_status_email(f"Falha temporária para {destinatario}; nova tentativa agendada.")
+                else: self._atualizar_status_email(); messagebox.showerror("Erro de Email", f"Não foi possível enviar o email para {destinatario}.\n\nVerifique suas configurações, conexão e senha de app (Ferramentas > Fila de Emails... para tentar novamente).\n\nErro: {erro}", parent=self)
+        except queue.Empty: pass
+        self.after(500, self._processar_eventos_email)
+
+    def _atualizar_status_email(self, mensagem=None):
+        contagem = self.fila_email.contagem(); pendentes = contagem.get('pendente', 0) + contagem.get('enviando', 0)
+        partes = ([mensagem] if mensagem else []) + ([f"{pendentes} email(s) na fila"] if pendentes else []) + ([f"{contagem['falhou']} com falha"] if contagem.get('falhou') else [])
+        self.status_email_var.set(" | ".join(partes))
+
+    def janela_fila_email(self):
+        popup = tk.Toplevel(self); popup.title("Fila de Emails"); popup.geometry("800x400"); popup.grab_set(); popup.configure(bg=self.bg_color)
+        frame_tree = ttk.Frame(popup, style="TFrame"); frame_tree.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
+        colunas = ("destinatario", "assunto", "status", "tentativas", "erro", "data"); tree = ttk.Treeview(frame_tree, columns=colunas, show="headings")
+        for c, t, w in zip(colunas, ("Destinatário", "Assunto", "Status", "Tent.", "Erro", "Data"), (170, 170, 80, 50, 200, 130)): tree.heading(c, text=t); tree.column(c, width=w, anchor=tk.W)
+        scrollbar = ttk.Scrollbar(frame_tree, orient="vertical", command=tree.yview); tree.configure(yscrollcommand=scrollbar.set); scrollbar.pack(side=tk.RIGHT, fill=tk.Y); tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        def carregar():
+            tree.delete(*tree.get_children())
+            for e in db.consultar("SELECT destinatario, assunto, status, tentativas, erro, COALESCE(enviado_em, proxima_tentativa, criado_em) FROM fila_email ORDER BY id DESC LIMIT 500"): tree.insert("", tk.END, values=tuple(v if v is not None else "" for v in e))
+        def reenviar(): n = self.fila_email.reenfileirar_falhas(); self._atualizar_status_email(); carregar(); messagebox.showinfo("Fila de Emails", f"{n} email(s) com falha voltaram para a fila.", parent=popup)
+        fb = ttk.Frame(popup, style="TFrame"); fb.pack(pady=(0, 10)); ttk.Button(fb, text="Tentar Novamente Falhas", command=reenviar).pack(side=tk.LEFT, padx=5); ttk.Button(fb, text="Atualizar", command=carregar).pack(side=tk.LEFT, padx=5); ttk.Button(fb, text="Fechar", command=popup.destroy).pack(side=tk.LEFT, padx=5)
+        carregar()
 
 if __name__ == "__main__":
+    if len(sys.argv) > 1:  # Com argumentos, roda a linha de comando (o mesmo que python cli.py ...).
+        import cli; sys.exit(cli.main(sys.argv[1:]))
     app = GerenciadorChaves()
     s = ttk.Style()
     s.configure("Accent.TButton", background="#094771", font=('Segoe UI', 9, 'bold'))
     s.map("Accent.TButton", background=[('active', '#0a588a')])
-    app.mainloop()
\ No newline at end of file
+    app.mainloop(); metricas.parar_perfil(); app.servico_pdf.encerrar(); app.servico_cotacao.encerrar(); app.agendador_backup.parar(); app.fila_email.parar()  # Deixa o email em andamento terminar; o restante fica na fila para a próxima execução.
\ No newline at end of file
@@ -0,0 +1,1940 @@
+# Gerenciador de Chaves - núcleo sem interface
+# coding: utf-8
+# Banco de dados, importação, entregas (reserva, PDF, email), relatórios e exportação. Não importa tkinter: é usado
+# pela interface (main.py), pela linha de comando (cli.py) e pode rodar numa máquina sem display.
+import atexit
+import cProfile
+import functools
+import json
+import csv
+import gzip
+import io
+import zlib
+import os
+import pstats
+import sqlite3
+import shutil
+import sys
+import time
+from array import array
+from datetime import date, datetime, timedelta
+from collections import Counter, defaultdict, deque, OrderedDict
+import importlib.util
+import smtplib
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from email.mime.application import MIMEApplication
+import threading
+import queue
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager, nullcontext
+from itertools import compress
+import re
+import html
+
+# --- Bibliotecas opcionais ---
+# reportlab (PDF), openpyxl/xlrd (planilhas) e requests (cotação) pesam no início do app: aqui só se verifica que
+# existem; a importação acontece no primeiro uso.
+PDF_DISPONIVEL = importlib.util.find_spec("reportlab") is not None
+OPENPYXL_DISPONIVEL = importlib.util.find_spec("openpyxl") is not None
+
+def _importar_reportlab():
+    global SimpleDocTemplate, Paragraph, Spacer, PageBreak, Image, Table, TableStyle, getSampleStyleSheet, ParagraphStyle, inch, cm, colors, TA_CENTER, TA_LEFT, TA_RIGHT, TA_JUSTIFY, ImageReader
+    from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, PageBreak, Image, Table, TableStyle
+    from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+    from reportlab.lib.units import inch, cm
+    from reportlab.lib import colors
+    from reportlab.lib.enums import TA_CENTER, TA_LEFT, TA_RIGHT, TA_JUSTIFY
+    from reportlab.lib.utils import ImageReader
+
+# --- Constantes ---
+DB_NAME = "gerenciador.db"
+UNDO_FILE = "gerenciador.db.undo" # Legado: cópias completas do BD usadas antes do journal
+REDO_FILE = "gerenciador.db.redo"
+UNDO_MAX_PASSOS = 50
+UNDO_TABELAS = ("chaves", "categorias", "canais_venda")
+CAMPOS_BUSCA = ("chave", "categoria", "comprador", "canal_venda")
+SCHEMA_VERSAO = 5  # PRAGMA user_version; ver verificar_e_migrar_schema.
+ORDEM_INTERVALO = 1024  # Folga entre valores vizinhos de ordem_manual, para mover uma chave gravar só ela (ver mover_chaves).
+ORDEM_JANELA = 32  # Linhas da primeira janela reespaçada quando a folga acaba num ponto da ordem.
+INGESTAO_LOTE = 50_000  # Chaves por transação na ingestão em massa.
+BUSCA_FTS_LIMITE = 5000  # Acima disso o termo é pouco seletivo e a varredura em memória é mais rápida.
+BACKUP_DIR = "backups"
+PDF_DIR = "pdfs"
+PERFIL_DIR = "perfis"
+EMAIL_CONFIG_FILE = "email_config.json"
+ASSUNTOS_EMAIL = {"pt_br": "Seu Pedido de Chave(s) de Ativação", "en_us": "Your Activation Key(s) Order", "es_es": "Su Pedido de Clave(s) de Activación"}
+APP_VERSION = "9.5" # Versão atualizada com a nova funcionalidade
+
+# --- Utilitários ---
+def _sanitize_filename(filename):
+    return re.sub(r'[<>:"/\\|?*]', '', filename)
+
+def _converter_markdown_para_html(texto):
+    """Converte uma marcação simples (tipo Markdown) para tags HTML que o ReportLab entende."""
+    texto = re.sub(r'\*\*(.*?)\*\*', r'<b>\1</b>', texto)
+    texto = re.sub(r'\*(.*?)\*', r'<i>\1</i>', texto)
+    texto = re.sub(r'__(.*?)__', r'<u>\1</u>', texto)
+    texto = texto.replace('\n', '<br/>')
+    return texto
+
+# --- Métricas ---
+# Latência por ação e contadores, só em memória: alimentam a janela "Desempenho" e exportar(). Os nomes usam
+# "area.etapa" (entrega.db, entrega.clipboard, pdf.gerar, email.enviar, tabela.atualizar...) para uma entrega lenta
+# mostrar em que parte o tempo foi gasto.
+METRICAS_AMOSTRAS = 2000  # Durações mais recentes guardadas por ação (base dos percentis).
+
+class Metricas:
+    """Spans (span/medido), contadores (contar) e captura opcional com cProfile. Seguro entre threads; o perfil cobre
+    só a thread que o iniciou (a da interface, no app)."""
+    def __init__(self, amostras=METRICAS_AMOSTRAS):
+        self.amostras = amostras; self._lock = threading.Lock(); self._perfil = None; self.limpar()
+
+    def limpar(self):
+        with self._lock: self._duracoes, self._totais, self._contadores = defaultdict(lambda: deque(maxlen=self.amostras)), defaultdict(lambda: [0, 0.0]), Counter()
+
+    def registrar(self, nome, ms):
+        with self._lock: self._duracoes[nome].append(ms); total = self._totais[nome]; total[0] += 1; total[1] += ms
+
+    def contar(self, nome, n=1):
+        with self._lock: self._contadores[nome] += n
+
+    def contagens(self):
+        with self._lock: return dict(self._contadores)
+
+    @contextmanager
+    def span(self, nome):
+        inicio = time.perf_counter()
+        try: yield
+        finally: self.registrar(nome, (time.perf_counter() - inicio) * 1000)
+
+    def medido(self, nome):
+        """Decorador: cada chamada vira um span 'nome'."""
+        def decorar(funcao):
+            @functools.wraps(funcao)
+            def medida(*args, **kwargs):
+                with self.span(nome): return funcao(*args, **kwargs)
+            return medida
+        return decorar
+
+    def resumo(self):
+        """[{acao, n, p50, p95, max, media}] em ms, por nome. Percentis das últimas 'amostras' chamadas; n e média de todas."""
+        with self._lock: dados = [(nome, sorted(d), *self._totais[nome]) for nome, d in self._duracoes.items()]
+        percentil = lambda v, q: v[max(0, -(-len(v) * q // 100) - 1)]  # Nearest-rank.
+        return [{"acao": nome, "n": n, "p50": percentil(v, 50), "p95": percentil(v, 95), "max": v[-1], "media": total / n} for nome, v, n, total in sorted(dados)]
+
+    def exportar(self, caminho):
+        """.csv: uma linha por ação (resumo). Outra extensão: JSON com resumo, contadores e as amostras brutas."""
+        resumo, contadores = self.resumo(), self.contagens()
+        with self._lock: amostras = {nome: list(d) for nome, d in self._duracoes.items()}
+        with open(caminho, "w", encoding="utf-8", newline="") as f:
+            if caminho.lower().endswith(".csv"):
+                escritor = csv.writer(f); escritor.writerow(("acao", "n", "p50_ms", "p95_ms", "max_ms", "media_ms"))
+                escritor.writerows((r["acao"], r["n"], *(f"{r[c]:.3f}" for c in ("p50", "p95", "max", "media"))) for r in resumo)
+                escritor.writerows((f"contador:{nome}", valor, "", "", "", "") for nome, valor in sorted(contadores.items()))
+            else: json.dump({"gerado_em": f"{datetime.now():%Y-%m-%d %H:%M:%S}", "versao": APP_VERSION, "acoes": resumo, "contadores": contadores, "amostras_ms": amostras}, f, ensure_ascii=False, indent=1)
+        return caminho
+
+    # --- Perfil (cProfile) ---
+    @property
+    def perfil_ativo(self): return self._perfil is not None
+
+    def iniciar_perfil(self):
+        if self._perfil is None: self._perfil = cProfile.Profile(); self._perfil.enable()
+
+    def parar_perfil(self, pasta=PERFIL_DIR, linhas=40):
+        """Para a captura e grava perfil_<data>.prof (para pstats/snakeviz) e um .txt com as 'linhas' funções de maior
+        tempo acumulado. Devolve o caminho do .prof (None se não havia captura)."""
+        if (perfil := self._perfil) is None: return None
+        perfil.disable(); self._perfil = None; os.makedirs(pasta, exist_ok=True)
+        caminho = os.path.join(pasta, f"perfil_{datetime.now():%Y%m%d_%H%M%S}.prof"); perfil.dump_stats(caminho)
+        with open(caminho[:-5] + ".txt", "w", encoding="utf-8") as f: pstats.Stats(perfil, stream=f).sort_stats("cumulative").print_stats(linhas)
+        return caminho
+
+metricas = Metricas()
+
+# --- Classe Geradora de PDF (integrada para melhor organização) ---
+class GeradorPDF:
+    _estilos_cache = None  # Folha de estilos montada uma vez por processo e compartilhada (os estilos não mudam).
+    _logos_cache = {}  # (caminho, mtime, tamanho) -> (bytes, largura, altura) ou None
+
+    def __init__(self, nome_arquivo):
+        _importar_reportlab(); self.nome_arquivo = nome_arquivo
+        self.story = []
+        self._setup_estilos()
+
+    def _setup_estilos(self):
+        if GeradorPDF._estilos_cache is not None: self.estilos = GeradorPDF._estilos_cache; return
+        self.estilos = getSampleStyleSheet()
+        self.estilos.add(ParagraphStyle(name='HeaderStyle', fontName='Helvetica-Bold', fontSize=16, alignment=TA_CENTER, spaceAfter=15))
+        self.estilos.add(ParagraphStyle(name='InfoLabel', fontName='Helvetica-Bold', fontSize=10, alignment=TA_LEFT, textColor=colors.darkblue))
+        self.estilos.add(ParagraphStyle(name='InfoText', fontName='Helvetica', fontSize=10, alignment=TA_LEFT))
+        self.estilos.add(ParagraphStyle(name='KeyLabel', fontName='Helvetica-Bold', fontSize=12, alignment=TA_CENTER, spaceBefore=10, spaceAfter=5))
+        self.estilos.add(ParagraphStyle(name='KeyStyle', fontName='Courier-Bold', fontSize=16, alignment=TA_CENTER, backColor=colors.HexColor('#f0f0f0'), textColor=colors.black, borderRadius=5, borderWidth=1.5, borderColor=colors.black, padding=12, leading=20))
+        self.estilos.add(ParagraphStyle(name='InstructionTitleStyle', fontName='Helvetica-Bold', fontSize=14, alignment=TA_CENTER, spaceBefore=20, spaceAfter=10, textColor=colors.HexColor("#094771")))
+        self.estilos.add(ParagraphStyle(name='InstructionBody', fontName='Helvetica', fontSize=10, leading=14, leftIndent=20))
+        self.estilos.add(ParagraphStyle(name='FooterStyle', fontName='Helvetica-Oblique', fontSize=9, alignment=TA_CENTER, spaceBefore=30, textColor=colors.grey))
+        GeradorPDF._estilos_cache = self.estilos
+
+    def adicionar_paragrafo(self, texto, estilo='Normal'):
+        texto_seguro = html.escape(texto)
+        texto_formatado = _converter_markdown_para_html(texto_seguro)
+        p = Paragraph(texto_formatado, self.estilos[estilo])
+        self.story.append(p)
+
+    def adicionar_paragrafo_html(self, texto_html, estilo='Normal'):
+        """Como adicionar_paragrafo, para texto já escapado e convertido (fragmentos do cache de templates)."""
+        self.story.append(Paragraph(texto_html, self.estilos[estilo]))
+
+    @classmethod
+    def _carregar_logo(cls, caminho_imagem):
+        """Lê e mede o logo uma vez; a chave inclui mtime/tamanho, então trocar o arquivo invalida a entrada."""
+        try: st = os.stat(caminho_imagem)
+        except OSError: return None
+        chave = (caminho_imagem, st.st_mtime_ns, st.st_size)
+        if chave not in cls._logos_cache:
+            try:
+                with open(caminho_imagem, "rb") as f: dados = f.read()
+                iw, ih = ImageReader(io.BytesIO(dados)).getSize(); cls._logos_cache[chave] = (dados, iw, ih)
+            except Exception as e: print(f"Erro ao carregar logo: {e}"); cls._logos_cache[chave] = None
+        return cls._logos_cache[chave]
+
+    def adicionar_imagem(self, caminho_imagem, largura_cm):
+        if not caminho_imagem or not (logo := self._carregar_logo(caminho_imagem)): return
+        dados, iw, ih = logo
+        aspect = ih / float(iw) if iw > 0 else 0
+        largura = largura_cm * cm
+        altura = (largura * aspect) if aspect > 0 else 0
+        img = Image(io.BytesIO(dados), width=largura, height=altura)
+        img.hAlign = 'CENTER'
+        self.story.append(img)
+        self.adicionar_espaco_cm(0.8)
+
+    def adicionar_tabela_info(self, dados, col_widths_cm):
+        col_widths = [w * cm for w in col_widths_cm]
+        tabela_formatada = []
+        for rotulo, texto in dados:
+            if texto:
+                p_rotulo = Paragraph(f"🔹 <b>{rotulo}</b>", self.estilos['InfoText'])
+                p_texto = Paragraph(texto, self.estilos['InfoText'])
+                tabela_formatada.append([p_rotulo, p_texto])
+        if tabela_formatada:
+            tabela = Table(tabela_formatada, colWidths=col_widths)
+            tabela.setStyle(TableStyle([('VALIGN', (0,0), (-1,-1), 'TOP'), ('LEFTPADDING', (0,0), (-1,-1), 0), ('TOPPADDING', (0,0), (-1,-1), 2)]))
+            self.story.append(tabela)
+
+    def adicionar_espaco_cm(self, altura_cm):
+        self.story.append(Spacer(1, altura_cm * cm))
+    
+    def adicionar_quebra_pagina(self):
+        self.story.append(PageBreak())
+
+    def construir(self):
+        """Grava o PDF. Não mostra nada na tela (pode rodar num processo do ServicoPDF): em caso de falha devolve False
+        e deixa a mensagem em self.erro para quem chamou."""
+        self.erro = None
+        try:
+            doc = SimpleDocTemplate(self.nome_arquivo, topMargin=0.5*inch, bottomMargin=0.5*inch, leftMargin=0.7*inch, rightMargin=0.7*inch)
+            doc.build(self.story)
+            return True
+        except Exception as e:
+            self.erro = str(e)
+            return False
+
+# --- Renderização de PDF em Processos ---
+PDF_TEMPLATES_MAX = 64  # Entradas (categoria, idioma, versão) mantidas por processo.
+_PDF_MARCADORES = {"{chave_entregue}": "\x00C\x00", "{comprador}": "\x00P\x00", "{saudacao}": "\x00S\x00"}  # Sobrevivem ao escape/Markdown intactos.
+_templates_pdf = OrderedDict()
+
+def _template_pdf(cat_nome, idioma, cat_obj):
+    """Partes do PDF que só dependem da categoria e do idioma: rótulos/valores da tabela de informações já escapados e as
+    seções de instrução já convertidas para HTML, com marcadores no lugar de {chave_entregue}/{comprador}/{saudacao}.
+    Os valores dos marcadores entram como texto literal (um '**' no nome do comprador não vira negrito).
+    A versão é uma soma dos campos da categoria, então salvar a categoria (save_cat) gera outra chave e a antiga sai por LRU."""
+    sufixo = 'en' if idioma == 'en_us' else 'es' if idioma == 'es_es' else 'pt'
+    chave = (cat_nome, idioma, zlib.crc32(repr(sorted(cat_obj.items())).encode()))
+    if (template := _templates_pdf.get(chave)) is not None: _templates_pdf.move_to_end(chave); return template
+    rotulos = {"en": ("Buyer", "Email", "Product", "License type", "Language", "Delivery"), "es": ("Comprador", "Email", "Producto", "Tipo de licencia", "Idioma", "Entrega")}.get(sufixo, ("Comprador", "Email", "Produto", "Tipo de licença", "Idioma", "Entrega"))
+    valores = (cat_nome, cat_obj.get(f'info_licenca_{sufixo}', ''), cat_obj.get(f'info_idioma_{sufixo}', ''), cat_obj.get(f'info_entrega_{sufixo}', ''))
+    instrucao = (cat_obj.get(f'layout_pdf_{sufixo}') or '').strip()
+    for marcador, sentinela in _PDF_MARCADORES.items(): instrucao = instrucao.replace(marcador, sentinela)
+    template = {"logo": cat_obj.get("logo_path"), "rotulos": rotulos, "info": tuple(html.escape(v or '') for v in valores),
+                "secoes": [_converter_markdown_para_html(html.escape(secao)) if secao.strip() else None for secao in instrucao.split('[NOVA_PAGINA]')] if instrucao else []}
+    _templates_pdf[chave] = template
+    if len(_templates_pdf) > PDF_TEMPLATES_MAX: _templates_pdf.popitem(last=False)
+    return template
+
+def renderizar_pdf_entrega(trabalho):
+    """Monta e grava o PDF de uma entrega a partir de dados simples (picklable), para rodar num processo do ServicoPDF:
+    trabalho = {caminho, idioma, comprador, email, chaves: [{chave, categoria}], categorias: {nome: dict da categoria}}.
+    Devolve (caminho, None) ou (None, mensagem de erro)."""
+    try:
+        idioma, comprador, email_comprador = trabalho['idioma'], trabalho['comprador'], trabalho.get('email', "")
+        pdf = GeradorPDF(trabalho['caminho'])
+        header_text = "Thank you for your purchase!" if idioma == "en_us" else "¡Gracias por su compra!" if idioma == "es_es" else "Obrigado por sua compra!"
+        footer_text = "If you have any questions, please contact us." if idioma == "en_us" else "Cualquier duda o problema, por favor, entre en contacto."
+        inst_header = "Activation Instructions" if idioma == "en_us" else "Instrucciones de Activación" if idioma == "es_es" else "Instruções de Ativação"
+        saudacao_str = "Bom dia" if 5 <= datetime.now().hour < 12 else "Boa tarde" if 12 <= datetime.now().hour < 18 else "Boa noite"
+        chaves_por_cat = defaultdict(list)
+        for chave in trabalho['chaves']: chaves_por_cat[chave.get("categoria") or "S/C"].append(chave['chave'])
+        for i, (cat_nome, chaves_lista) in enumerate(sorted(chaves_por_cat.items())):
+            if i > 0: pdf.adicionar_quebra_pagina()
+            cat_obj = trabalho['categorias'].get(cat_nome); template = _template_pdf(cat_nome, idioma, cat_obj) if cat_obj else None
+            pdf.adicionar_imagem(template["logo"] if template else None, largura_cm=6.5)
+            pdf.adicionar_paragrafo(header_text, estilo='HeaderStyle')
+            if template:
+                pdf.adicionar_tabela_info(zip(template["rotulos"], (html.escape(comprador), html.escape(email_comprador or '')) + template["info"]), col_widths_cm=[4.5, 11]); pdf.adicionar_espaco_cm(0.8)
+            key_label = 'Your Activation Keys:' if len(chaves_lista) > 1 else 'Your Activation Key:' if idioma == 'en_us' else 'Sus Claves de Activación:' if len(chaves_lista) > 1 else 'Su Clave de Activación:' if idioma == 'es_es' else 'Suas Chaves de Ativação:' if len(chaves_lista) > 1 else 'Sua Chave de Ativação:'
+            pdf.adicionar_paragrafo(key_label, estilo='KeyLabel')
+            for chave_str in chaves_lista: pdf.adicionar_paragrafo(html.escape(chave_str), estilo='KeyStyle'); pdf.adicionar_espaco_cm(0.2)
+            if template and template["secoes"]:
+                valores = {sentinela: html.escape(valor).replace('\n', '<br/>') for sentinela, valor in zip(_PDF_MARCADORES.values(), ("\n".join(chaves_lista), comprador, saudacao_str))}
+                pdf.adicionar_paragrafo(inst_header, estilo='InstructionTitleStyle')
+                for idx, secao in enumerate(template["secoes"]):
+                    if secao:
+                        for sentinela, valor in valores.items(): secao = secao.replace(sentinela, valor)
+                        pdf.adicionar_paragrafo_html(secao, estilo='InstructionBody')
+                    if idx < len(template["secoes"]) - 1: pdf.adicionar_quebra_pagina()
+        pdf.adicionar_espaco_cm(1.5); pdf.adicionar_paragrafo(footer_text, estilo='FooterStyle')
+        return (trabalho['caminho'], None) if pdf.construir() else (None, pdf.erro)
+    except Exception as e: return None, str(e)
+
+class ServicoPDF:
+    """Pool de processos que renderiza PDFs fora do loop do Tk e, nas entregas em lote, em paralelo entre os núcleos.
+    Criado no primeiro uso; usa 'spawn' para os processos não herdarem as threads e conexões SQLite do app."""
+    def __init__(self, max_processos=None):
+        self.max_processos = max_processos or min(4, os.cpu_count() or 1); self._executor = None; self._lock = threading.Lock()
+
+    def _pool(self, recriar=False):
+        with self._lock:
+            if recriar and self._executor: self._executor.shutdown(wait=False); self._executor = None
+            if self._executor is None: self._executor = ProcessPoolExecutor(self.max_processos, mp_context=multiprocessing.get_context("spawn"))
+            return self._executor
+
+    def submeter(self, trabalho):
+        """Agenda um trabalho (ver renderizar_pdf_entrega); o Future resolve para (caminho, erro)."""
+        try: return self._pool().submit(renderizar_pdf_entrega, trabalho)
+        except BrokenProcessPool: return self._pool(recriar=True).submit(renderizar_pdf_entrega, trabalho)  # Um processo morreu: recomeça com um pool novo.
+
+    def renderizar_lote(self, trabalhos):
+        """Renderiza vários trabalhos em paralelo e devolve os (caminho, erro) na mesma ordem."""
+        futuros = [self.submeter(t) for t in trabalhos]; resultados = []
+        for f in futuros:
+            try: resultados.append(f.result())
+            except Exception as e: resultados.append((None, str(e)))
+        return resultados
+
+    def encerrar(self):
+        with self._lock:
+            if self._executor: self._executor.shutdown(wait=True, cancel_futures=True); self._executor = None
+
+# --- Camada de Acesso ao Banco de Dados ---
+class BancoDados:
+    """Conexões SQLite persistentes (uma por thread) com WAL, cache de statements e transações explícitas."""
+    PRAGMAS = ("PRAGMA journal_mode=WAL", "PRAGMA synchronous=NORMAL", "PRAGMA temp_store=MEMORY", "PRAGMA cache_size=-32000", "PRAGMA busy_timeout=30000")
+
+    def __init__(self, caminho, cached_statements=256):
+        self.caminho = caminho; self.cached_statements = cached_statements
+        self._local = threading.local(); self._lock = threading.Lock(); self._conexoes = []
+
+    def conexao(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # isolation_level=None: comandos avulsos fazem autocommit; transações só via transacao().
+            conn = sqlite3.connect(self.caminho, timeout=30, isolation_level=None, check_same_thread=False, cached_statements=self.cached_statements)
+            conn.row_factory = sqlite3.Row
+            for pragma in self.PRAGMAS: conn.execute(pragma)
+            self._local.conn = conn
+            with self._lock: self._conexoes.append(conn)
+        return conn
+
+    def executar(self, sql, params=()): return self.conexao().execute(sql, params)
+    def executar_muitos(self, sql, seq_params): return self.conexao().executemany(sql, seq_params)
+    def consultar(self, sql, params=()): return self.conexao().execute(sql, params).fetchall()
+    def consultar_um(self, sql, params=()): return self.conexao().execute(sql, params).fetchone()
+    def consultar_valor(self, sql, params=()):
+        row = self.consultar_um(sql, params); return row[0] if row else None
+
+    @contextmanager
+    def transacao(self, imediata=False):
+        """Abre uma transação (BEGIN IMMEDIATE se 'imediata'); transações aninhadas juntam-se à externa."""
+        conn = self.conexao()
+        if conn.in_transaction: yield conn; return
+        conn.execute("BEGIN IMMEDIATE" if imediata else "BEGIN"); self._local.ao_confirmar = []
+        try: yield conn
+        except BaseException: conn.rollback(); self._local.ao_confirmar = []; raise
+        else:
+            conn.commit(); pendentes, self._local.ao_confirmar = self._local.ao_confirmar, []
+            for funcao in pendentes: funcao()
+
+    def ao_confirmar(self, funcao):
+        """Roda funcao() depois do COMMIT da transação em curso nesta thread (nunca, se ela for desfeita); fora de
+        transação, na hora. Para efeitos fora do banco (auditoria) que só valem se a escrita valer."""
+        if self.conexao().in_transaction and (pendentes := getattr(self._local, "ao_confirmar", None)) is not None: pendentes.append(funcao)
+        else: funcao()
+
+    def fechar_da_thread(self):
+        """Fecha a conexão da thread atual (fim de threads de trabalho)."""
+        if (conn := getattr(self._local, "conn", None)) is None: return
+        with self._lock: self._conexoes.remove(conn)
+        self._local.conn = None; conn.close()
+
+    def fechar(self):
+        with self._lock: conexoes, self._conexoes = self._conexoes, []
+        for conn in conexoes:
+            try: conn.close()
+            except sqlite3.Error: pass
+        self._local = threading.local()
+
+db = BancoDados(DB_NAME)
+
+class ConjuntoMudancas:
+    """Ids de 'chaves' inseridos/atualizados/removidos por uma escrita, para atualizar o modelo em memória sem recarregar tudo."""
+    __slots__ = ("inseridos", "atualizados", "removidos", "categorias", "canais")
+    def __init__(self, inseridos=(), atualizados=(), removidos=(), categorias=False, canais=False):
+        self.inseridos, self.atualizados, self.removidos = set(inseridos), set(atualizados), set(removidos)
+        self.categorias, self.canais = categorias, canais
+    def juntar(self, outro):
+        self.inseridos |= outro.inseridos; self.atualizados |= outro.atualizados; self.removidos |= outro.removidos
+        self.categorias |= outro.categorias; self.canais |= outro.canais; return self
+
+# --- Funções de Banco de Dados e Utilitárias ---
+def init_db():
+    with db.transacao() as conn:
+        init_tabelas(conn.cursor())
+
+def init_tabelas(cursor):
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS chaves (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        chave TEXT NOT NULL UNIQUE,
+        categoria TEXT NOT NULL,
+        vendida INTEGER NOT NULL DEFAULT 0,
+        comprador TEXT,
+        data_venda TEXT,
+        ordem_manual INTEGER,
+        preco_venda_brl REAL,
+        preco_venda_usd REAL,
+        canal_venda TEXT
+    )
+    ''')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS categorias (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        nome TEXT NOT NULL UNIQUE,
+        instrucao_pt TEXT,
+        instrucao_en TEXT,
+        custo_padrao_brl REAL,
+        custo_padrao_usd REAL,
+        logo_path TEXT,
+        info_licenca_pt TEXT, info_licenca_en TEXT,
+        info_idioma_pt TEXT, info_idioma_en TEXT,
+        info_entrega_pt TEXT, info_entrega_en TEXT,
+        layout_pdf_pt TEXT, layout_pdf_en TEXT,
+        instrucao_es TEXT,
+        info_licenca_es TEXT,
+        info_idioma_es TEXT,
+        info_entrega_es TEXT,
+        layout_pdf_es TEXT
+    )
+    ''')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS canais_venda (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        nome TEXT NOT NULL UNIQUE
+    )
+    ''')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS fila_email (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        destinatario TEXT NOT NULL,
+        assunto TEXT,
+        corpo TEXT,
+        anexo TEXT,
+        status TEXT NOT NULL DEFAULT 'pendente',
+        tentativas INTEGER NOT NULL DEFAULT 0,
+        proxima_tentativa TEXT,
+        erro TEXT,
+        criado_em TEXT,
+        enviado_em TEXT
+    )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_fila_email_status ON fila_email (status, proxima_tentativa)")
+    cursor.execute("CREATE TABLE IF NOT EXISTS cotacoes (dia TEXT PRIMARY KEY, brl_por_usd REAL NOT NULL, fonte TEXT, atualizado_em TEXT) WITHOUT ROWID")
+
+def _adicionar_coluna_se_nao_existir(cursor, tabela, coluna, tipo):
+    cursor.execute(f"PRAGMA table_info({tabela})")
+    colunas = [info[1] for info in cursor.fetchall()]
+    if coluna not in colunas:  # Uma falha aqui (sqlite3.Error) desfaz a migração inteira; quem chamou decide como avisar.
+        cursor.execute(f"ALTER TABLE {tabela} ADD COLUMN {coluna} {tipo}")
+        print(f"Coluna '{coluna}' adicionada à tabela '{tabela}' com sucesso.")
+
+def verificar_e_migrar_schema():
+    """Migrações versionadas por PRAGMA user_version: com o schema em dia, custam uma única leitura."""
+    if (versao := db.consultar_valor("PRAGMA user_version")) >= SCHEMA_VERSAO: return
+    with db.transacao() as conn:
+        cursor = conn.cursor()
+        if versao < 1:
+            _adicionar_coluna_se_nao_existir(cursor, 'chaves', 'ordem_manual', 'INTEGER')
+            _adicionar_coluna_se_nao_existir(cursor, 'chaves', 'preco_venda_brl', 'REAL')
+            _adicionar_coluna_se_nao_existir(cursor, 'chaves', 'preco_venda_usd', 'REAL')
+            _adicionar_coluna_se_nao_existir(cursor, 'chaves', 'canal_venda', 'TEXT')
+            _adicionar_coluna_se_nao_existir(cursor, 'categorias', 'custo_padrao_brl', 'REAL')
+            _adicionar_coluna_se_nao_existir(cursor, 'categorias', 'custo_padrao_usd', 'REAL')
+            _adicionar_coluna_se_nao_existir(cursor, 'categorias', 'logo_path', 'TEXT')
+            _adicionar_coluna_se_nao_existir(cursor, 'categorias', 'info_licenca_pt', 'TEXT')
+            _adicionar_coluna_se_nao_existir(cursor, 'categorias', 'info_licenca_en', 'TEXT')
+            _adicionar_coluna_se_nao_existir(cursor, 'categorias', 'info_idioma_pt', 'TEXT')
+            _adicionar_coluna_se_nao_existir(cursor, 'categorias', 'info_idioma_en', 'TEXT')
+            _adicionar_coluna_se_nao_existir(cursor, 'categorias', 'info_entrega_pt', 'TEXT')
+            _adicionar_coluna_se_nao_existir(cursor, 'categorias', 'info_entrega_en', 'TEXT')
+            _adicionar_coluna_se_nao_existir(cursor, 'categorias', 'layout_pdf_pt', 'TEXT')
+            _adicionar_coluna_se_nao_existir(cursor, 'categorias', 'layout_pdf_en', 'TEXT')
+            _adicionar_coluna_se_nao_existir(cursor, 'categorias', 'instrucao_es', 'TEXT')
+            _adicionar_coluna_se_nao_existir(cursor, 'categorias', 'info_licenca_es', 'TEXT')
+            _adicionar_coluna_se_nao_existir(cursor, 'categorias', 'info_idioma_es', 'TEXT')
+            _adicionar_coluna_se_nao_existir(cursor, 'categorias', 'info_entrega_es', 'TEXT')
+            _adicionar_coluna_se_nao_existir(cursor, 'categorias', 'layout_pdf_es', 'TEXT')
+            cursor.execute("SELECT COUNT(*) FROM chaves WHERE ordem_manual IS NULL")
+            if cursor.fetchone()[0] > 0: cursor.execute("UPDATE chaves SET ordem_manual = id WHERE ordem_manual IS NULL")
+        if versao < 2:
+            # Índices para os filtros e ordenações da tabela (modo consulta) e canais usados antes de existir canais_venda.
+            for nome, colunas in (("categoria_vendida", "categoria, vendida"), ("canal_venda", "canal_venda"), ("data_venda", "data_venda"), ("ordem_manual", "ordem_manual")):
+                cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_chaves_{nome} ON chaves ({colunas})")
+            cursor.execute("INSERT OR IGNORE INTO canais_venda (nome) SELECT DISTINCT canal_venda FROM chaves WHERE canal_venda IS NOT NULL AND canal_venda != ''")
+        if versao < 3:
+            # Reservas (reservar_chaves) pegam as primeiras disponíveis da categoria na ordem manual: com ordem_manual no
+            # índice, é uma busca direta em vez de ordenar todo o estoque da categoria. Substitui (categoria, vendida).
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_chaves_disponiveis ON chaves (categoria, vendida, ordem_manual)")
+            cursor.execute("DROP INDEX IF EXISTS idx_chaves_categoria_vendida")
+        if versao < 4:
+            _instalar_vendas_diarias(cursor); cursor.execute("DELETE FROM vendas_diarias"); cursor.execute(_SQL_PREENCHER_VENDAS_DIARIAS)
+        if versao < 5:
+            cursor.execute(_SQL_REESPACAR_ORDEM)  # Ordem manual contígua (0, 1, 2...) passa a ter folga de ORDEM_INTERVALO.
+        cursor.execute(f"PRAGMA user_version = {SCHEMA_VERSAO}")
+
+def migrar_de_json_para_sqlite(confirmar=lambda: True):
+    """Importa estoque.json/categorias.json de versões antigas, se existirem e confirmar() aceitar. Devolve se migrou."""
+    if not os.path.exists("estoque.json") and not os.path.exists("categorias.json"): return False
+    if db.consultar_valor("SELECT COUNT(id) FROM chaves") > 0 and not (os.path.exists("estoque.json") or os.path.exists("categorias.json")): return False
+    if not confirmar(): return False
+    with db.transacao() as conn: _migrar_json(conn.cursor())
+    return True
+
+def _migrar_json(cursor):
+    if os.path.exists("estoque.json"):
+        try:
+            with open("estoque.json", "r", encoding="utf-8") as f: estoque_json = json.load(f)
+            chaves = [(item['chave'], item.get('categoria', 'S/C'), 1 if item.get('vendida') else 0, item.get('comprador'), item.get('data_venda')) for item in estoque_json]
+            cursor.executemany("INSERT OR IGNORE INTO chaves (chave, categoria, vendida, comprador, data_venda) VALUES (?, ?, ?, ?, ?)", chaves)
+            cursor.execute(f"UPDATE chaves SET ordem_manual = (SELECT COALESCE(MAX(ordem_manual), 0) FROM chaves) + id * {ORDEM_INTERVALO} WHERE ordem_manual IS NULL")
+            os.rename("estoque.json", "estoque.json.bak")
+        except Exception as e: print(f"Erro ao migrar estoque.json: {e}")
+    if os.path.exists("categorias.json"):
+        try:
+            with open("categorias.json", "r", encoding="utf-8") as f: categorias_json = json.load(f)
+            cats = [(cat, "", "") for cat in categorias_json] if categorias_json and isinstance(categorias_json[0], str) else [(c['nome'], c.get('inst_pt',''), c.get('inst_en','')) for c in categorias_json]
+            cursor.executemany("INSERT OR IGNORE INTO categorias (nome, instrucao_pt, instrucao_en) VALUES (?, ?, ?)", cats)
+            os.rename("categorias.json", "categorias.json.bak")
+        except Exception as e: print(f"Erro ao migrar categorias.json: {e}")
+    cursor.execute("INSERT OR IGNORE INTO categorias (nome) VALUES ('Sem Categoria')")
+
+# --- Journal de Desfazer/Refazer ---
+# Cada ação registra, por triggers, apenas os comandos SQL inversos das linhas que tocou. O passo que está gravando é
+# da conexão (temp.undo_gravando, lida por triggers TEMP criados nela): escritas de outras conexões e processos (CLI,
+# API, outra instância do app) nunca caem num passo alheio. Cada passo leva a origem de quem o gravou (auditoria.origem:
+# app ou cli) e Desfazer/Refazer só tocam os da própria origem. O log guarda também como o passo deixou cada linha
+# ('depois'): se ela mudou desde então, reverter apagaria essa mudança, e o passo é recusado.
+def instalar_journal_undo():
+    with db.transacao() as conn: _instalar_journal(conn.cursor())
+    for arquivo in (UNDO_FILE, REDO_FILE):
+        if os.path.exists(arquivo): os.remove(arquivo)
+
+def _instalar_journal(cursor):
+    cursor.execute("CREATE TABLE IF NOT EXISTS undo_passos (id INTEGER PRIMARY KEY AUTOINCREMENT, pilha TEXT NOT NULL, criado_em TEXT, origem TEXT)")
+    cursor.execute("CREATE TABLE IF NOT EXISTS undo_log (seq INTEGER PRIMARY KEY AUTOINCREMENT, passo INTEGER NOT NULL, sql TEXT NOT NULL, tabela TEXT, linha INTEGER, depois TEXT)")
+    _adicionar_coluna_se_nao_existir(cursor, 'undo_log', 'tabela', 'TEXT'); _adicionar_coluna_se_nao_existir(cursor, 'undo_log', 'linha', 'INTEGER')
+    _adicionar_coluna_se_nao_existir(cursor, 'undo_log', 'depois', 'TEXT'); _adicionar_coluna_se_nao_existir(cursor, 'undo_passos', 'origem', 'TEXT')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_undo_log_passo ON undo_log(passo)")
+    for tabela in UNDO_TABELAS:  # Triggers permanentes e passo gravando global de versões anteriores.
+        for op in ("insert", "update", "delete"): cursor.execute(f"DROP TRIGGER IF EXISTS main.undo_{tabela}_{op}")
+    cursor.execute("DROP TABLE IF EXISTS undo_estado")
+    # Passos de versões anteriores não têm origem nem 'depois': não há como saber de quem são nem se ainda podem ser revertidos.
+    cursor.execute("DELETE FROM undo_log WHERE passo IN (SELECT id FROM undo_passos WHERE origem IS NULL)"); cursor.execute("DELETE FROM undo_passos WHERE origem IS NULL")
+
+def _colunas_journal(conn, tabela):
+    return [info[1] for info in conn.execute(f"PRAGMA main.table_info({tabela})").fetchall() if info[1] != "id"]
+
+def _imagem_linha(r, colunas):
+    """Expressão SQL com todos os valores da linha 'r' (new, old ou um alias) num texto, para comparar estados."""
+    return " || ',' || ".join(f"quote({r}.{c})" for c in colunas)
+
+def _preparar_gravacao(conn):
+    """Cria, uma vez por conexão, temp.undo_gravando e os triggers TEMP que gravam no passo dela. Os triggers são
+    montados com as colunas atuais das tabelas (depois das migrações)."""
+    if conn.execute("SELECT 1 FROM temp.sqlite_master WHERE name = 'undo_gravando'").fetchone(): return
+    conn.execute("CREATE TEMP TABLE undo_gravando (passo INTEGER)"); conn.execute("INSERT INTO temp.undo_gravando (passo) VALUES (NULL)")
+    gravando, passo_atual = "(SELECT passo FROM temp.undo_gravando) IS NOT NULL", "(SELECT passo FROM temp.undo_gravando)"
+    for tabela in UNDO_TABELAS:
+        colunas = _colunas_journal(conn, tabela)
+        set_antigo = " || ',' || ".join(f"'{c}=' || quote(old.{c})" for c in colunas)
+        valores_antigos, valores_novos = _imagem_linha("old", colunas), _imagem_linha("new", colunas)
+        conn.execute(f"CREATE TEMP TRIGGER undo_{tabela}_insert AFTER INSERT ON main.{tabela} WHEN {gravando} BEGIN "
+                     f"INSERT INTO undo_log (passo, tabela, linha, sql, depois) VALUES ({passo_atual}, '{tabela}', new.rowid, 'DELETE FROM {tabela} WHERE rowid=' || new.rowid, {valores_novos}); END")
+        conn.execute(f"CREATE TEMP TRIGGER undo_{tabela}_update AFTER UPDATE ON main.{tabela} WHEN {gravando} BEGIN "
+                     f"INSERT INTO undo_log (passo, tabela, linha, sql, depois) VALUES ({passo_atual}, '{tabela}', old.rowid, 'UPDATE {tabela} SET ' || {set_antigo} || ' WHERE rowid=' || old.rowid, {valores_novos}); END")
+        conn.execute(f"CREATE TEMP TRIGGER undo_{tabela}_delete AFTER DELETE ON main.{tabela} WHEN {gravando} BEGIN "
+                     f"INSERT INTO undo_log (passo, tabela, linha, sql) VALUES ({passo_atual}, '{tabela}', old.rowid, 'INSERT INTO {tabela} (rowid,{','.join(colunas)}) VALUES (' || old.rowid || ',' || {valores_antigos} || ')'); END")
+
+def _gravar_no_passo(conn, passo):
+    """Liga (passo) ou desliga (None) a gravação do journal nesta conexão. Devolve o passo que estava gravando."""
+    _preparar_gravacao(conn); anterior = conn.execute("SELECT passo FROM temp.undo_gravando").fetchone()[0]
+    conn.execute("UPDATE temp.undo_gravando SET passo = ?", (passo,)); return anterior
+
+@contextmanager
+def passo_undo(passo=None):
+    """Transação (BEGIN IMMEDIATE) cujas escritas nesta conexão formam um passo de desfazer de auditoria.origem: um
+    novo ou, com 'passo', a continuação dele (ações gravadas em várias transações, como a ingestão em lotes). O passo
+    nasce na mesma transação das escritas, sem janela para outra ação entre os dois. Devolve o id do passo."""
+    origem = auditoria.origem
+    with db.transacao(imediata=True) as conn:
+        agora = f"{datetime.now():%Y-%m-%d %H:%M:%S}"
+        if passo is None: passo = conn.execute("INSERT INTO undo_passos (pilha, criado_em, origem) VALUES ('undo', ?, ?)", (agora, origem)).lastrowid
+        else: conn.execute("INSERT OR IGNORE INTO undo_passos (id, pilha, criado_em, origem) VALUES (?, 'undo', ?, ?)", (passo, agora, origem))  # Vazio no lote anterior: foi descartado.
+        anterior = _gravar_no_passo(conn, passo)
+        try: yield passo
+        finally: _gravar_no_passo(conn, anterior); _fechar_passo(conn.cursor(), passo, origem)
+
+def _fechar_passo(cursor, passo, origem):
+    """Descarta o passo se nada foi gravado nele; senão descarta a pilha de refazer da origem e o que passar de UNDO_MAX_PASSOS."""
+    if not cursor.execute("SELECT 1 FROM undo_log WHERE passo = ? LIMIT 1", (passo,)).fetchone(): cursor.execute("DELETE FROM undo_passos WHERE id = ?", (passo,)); return
+    cursor.execute("DELETE FROM undo_log WHERE passo IN (SELECT id FROM undo_passos WHERE pilha = 'redo' AND origem = ?)", (origem,))
+    cursor.execute("DELETE FROM undo_passos WHERE pilha = 'redo' AND origem = ?", (origem,))
+    cursor.execute("SELECT id FROM undo_passos WHERE pilha = 'undo' AND origem = ? ORDER BY id DESC LIMIT 1 OFFSET ?", (origem, UNDO_MAX_PASSOS))
+    if excedente := cursor.fetchone():
+        cursor.execute("DELETE FROM undo_log WHERE passo IN (SELECT id FROM undo_passos WHERE pilha = 'undo' AND origem = ? AND id <= ?)", (origem, excedente[0]))
+        cursor.execute("DELETE FROM undo_passos WHERE pilha = 'undo' AND origem = ? AND id <= ?", (origem, excedente[0]))
+
+def _linhas_alteradas(conn, passo):
+    """[(tabela, linha)] das linhas que não estão mais como o passo as deixou (o último 'depois' de cada uma; NULL =
+    o passo a apagou)."""
+    alteradas = []
+    for (tabela,) in conn.execute("SELECT DISTINCT tabela FROM undo_log WHERE passo = ?", (passo,)).fetchall():
+        imagem = _imagem_linha("t", _colunas_journal(conn, tabela))
+        alteradas += [(tabela, row[0]) for row in conn.execute(f"""SELECT u.linha FROM (SELECT linha, depois, MAX(seq) FROM undo_log WHERE passo = ? AND tabela = ? GROUP BY linha) AS u
+                                                                  LEFT JOIN {tabela} AS t ON t.rowid = u.linha WHERE u.depois IS NOT (CASE WHEN t.rowid IS NULL THEN NULL ELSE {imagem} END)""", (passo, tabela))]
+    return alteradas
+
+def _reverter_passo(pilha, destino):
+    """Executa os inversos do passo mais recente de auditoria.origem na 'pilha', gravando os novos inversos em 'destino'.
+    Retorna as mudanças aplicadas em 'chaves', ou None se a pilha estiver vazia. Se alguma linha do passo mudou depois
+    dele, não reverte nada (uma chave vendida nesse meio-tempo voltaria ao estoque): descarta o passo e levanta ValueError."""
+    origem = auditoria.origem
+    with db.transacao(imediata=True) as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT id FROM undo_passos WHERE pilha = ? AND origem = ? ORDER BY id DESC LIMIT 1", (pilha, origem))
+        if not (row := cursor.fetchone()): return None
+        passo = row[0]; mud = ConjuntoMudancas()
+        if alteradas := _linhas_alteradas(conn, passo):
+            ids = [linha for tabela, linha in alteradas if tabela == 'chaves'][:5]
+            textos = dict(conn.execute("SELECT id, chave FROM chaves WHERE id IN (SELECT value FROM json_each(?))", (json.dumps(ids),)).fetchall())
+            exemplos = [textos.get(i, f"id {i}") for i in ids] or sorted({tabela for tabela, _ in alteradas})
+        else:
+            cursor.execute("INSERT INTO undo_passos (pilha, criado_em, origem) VALUES (?, ?, ?)", (destino, f"{datetime.now():%Y-%m-%d %H:%M:%S}", origem))
+            _gravar_no_passo(conn, cursor.lastrowid)
+            for sql, tabela, linha in conn.execute("SELECT sql, tabela, linha FROM undo_log WHERE passo = ? ORDER BY seq DESC", (passo,)).fetchall():
+                cursor.execute(sql)
+                if tabela == 'categorias': mud.categorias = True
+                elif tabela == 'canais_venda': mud.canais = True
+                elif sql.startswith('DELETE'): mud.removidos.add(linha); mud.inseridos.discard(linha); mud.atualizados.discard(linha)
+                elif sql.startswith('INSERT'): mud.inseridos.add(linha); mud.removidos.discard(linha)
+                else: mud.atualizados.add(linha)
+            _gravar_no_passo(conn, None)
+        cursor.execute("DELETE FROM undo_log WHERE passo = ?", (passo,)); cursor.execute("DELETE FROM undo_passos WHERE id = ?", (passo,))
+    if alteradas:
+        raise ValueError(f"{len(alteradas)} linha(s) dessa ação mudaram depois dela, por outra ação, outro processo ou a API ({', '.join(exemplos)}{'...' if len(alteradas) > len(exemplos) else ''}). "
+                         "Revertê-la apagaria essas mudanças, então ela foi descartada do histórico.")
+    return mud
+
+def desfazer_passo(): return _reverter_passo('undo', 'redo')
+def refazer_passo(): return _reverter_passo('redo', 'undo')
+
+def contar_passos_undo():
+    contagem = {row[0]: row[1] for row in db.consultar("SELECT pilha, COUNT(*) FROM undo_passos WHERE origem = ? GROUP BY pilha", (auditoria.origem,))}
+    return contagem.get('undo', 0), contagem.get('redo', 0)
+
+# --- Vendas Diárias ---
+# Resumo das vendas por dia × categoria × canal (receita em R$ e em US$ em colunas próprias), mantido por triggers em
+# 'chaves': toda venda, edição, exclusão, desfazer ou importação já cai aqui, e os relatórios somam alguns milhares de
+# linhas em vez de varrer todas as vendas do período. Chaves vendidas sem data ficam no dia '' (fora de qualquer período).
+_CHAVE_VENDAS_DIARIAS = "COALESCE(substr({r}.data_venda, 1, 10), ''), COALESCE({r}.categoria, ''), COALESCE({r}.canal_venda, '')"
+_SQL_PREENCHER_VENDAS_DIARIAS = f"""INSERT INTO vendas_diarias (dia, categoria, canal, qtd, receita_brl, receita_usd)
+    SELECT {_CHAVE_VENDAS_DIARIAS.format(r='chaves')}, COUNT(*), SUM(COALESCE(preco_venda_brl, 0)), SUM(COALESCE(preco_venda_usd, 0)) FROM chaves WHERE vendida = 1 GROUP BY 1, 2, 3"""
+
+def _sql_somar_venda(r, sinal):
+    """Soma (sinal=1) ou subtrai (sinal=-1) a linha 'r' (new/old) do resumo, se ela for uma venda."""
+    chave = _CHAVE_VENDAS_DIARIAS.format(r=r)
+    sql = (f"INSERT INTO vendas_diarias (dia, categoria, canal, qtd, receita_brl, receita_usd) SELECT {chave}, {sinal}, {sinal} * COALESCE({r}.preco_venda_brl, 0), {sinal} * COALESCE({r}.preco_venda_usd, 0) "
+           f"WHERE {r}.vendida = 1 ON CONFLICT (dia, categoria, canal) DO UPDATE SET qtd = qtd + excluded.qtd, receita_brl = receita_brl + excluded.receita_brl, receita_usd = receita_usd + excluded.receita_usd;")
+    if sinal < 0: sql += f" DELETE FROM vendas_diarias WHERE {r}.vendida = 1 AND (dia, categoria, canal) = ({chave}) AND qtd <= 0;"
+    return sql
+
+def _instalar_vendas_diarias(cursor):
+    cursor.execute("CREATE TABLE IF NOT EXISTS vendas_diarias (dia TEXT NOT NULL, categoria TEXT NOT NULL, canal TEXT NOT NULL, qtd INTEGER NOT NULL, receita_brl REAL NOT NULL, receita_usd REAL NOT NULL, PRIMARY KEY (dia, categoria, canal)) WITHOUT ROWID")
+    for op in ("insert", "update", "delete"): cursor.execute(f"DROP TRIGGER IF EXISTS vendas_diarias_{op}")
+    cursor.execute(f"CREATE TRIGGER vendas_diarias_insert AFTER INSERT ON chaves WHEN new.vendida = 1 BEGIN {_sql_somar_venda('new', 1)} END")
+    cursor.execute(f"CREATE TRIGGER vendas_diarias_delete AFTER DELETE ON chaves WHEN old.vendida = 1 BEGIN {_sql_somar_venda('old', -1)} END")
+    cursor.execute("CREATE TRIGGER vendas_diarias_update AFTER UPDATE OF vendida, data_venda, categoria, canal_venda, preco_venda_brl, preco_venda_usd ON chaves "
+                   f"WHEN old.vendida = 1 OR new.vendida = 1 BEGIN {_sql_somar_venda('old', -1)} {_sql_somar_venda('new', 1)} END")
+
+def reconstruir_vendas_diarias():
+    """Refaz o resumo a partir de 'chaves' (depois de restaurar um banco antigo ou editar o arquivo por fora)."""
+    with db.transacao(imediata=True) as conn: conn.execute("DELETE FROM vendas_diarias"); conn.execute(_SQL_PREENCHER_VENDAS_DIARIAS)
+
+# --- Busca ---
+# Índice FTS5 (tokenizer trigram) com conteúdo externo em chaves, mantido por triggers: todo caminho de escrita,
+# inclusive o replay do journal de desfazer, o mantém em dia.
+def instalar_indice_busca():
+    """Cria o índice de busca se preciso. Retorna False se o SQLite não tiver FTS5/trigram (a busca usa só a memória)."""
+    campos = ", ".join(CAMPOS_BUSCA); valores = lambda p: ", ".join(f"{p}.{c}" for c in CAMPOS_BUSCA)
+    try:
+        with db.transacao() as conn:
+            existia = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'chaves_busca'").fetchone()
+            conn.execute(f"CREATE VIRTUAL TABLE IF NOT EXISTS chaves_busca USING fts5({campos}, content='chaves', content_rowid='id', tokenize='trigram')")
+            conn.execute(f"CREATE TRIGGER IF NOT EXISTS chaves_busca_insert AFTER INSERT ON chaves BEGIN "
+                         f"INSERT INTO chaves_busca (rowid, {campos}) VALUES (new.id, {valores('new')}); END")
+            conn.execute(f"CREATE TRIGGER IF NOT EXISTS chaves_busca_delete AFTER DELETE ON chaves BEGIN "
+                         f"INSERT INTO chaves_busca (chaves_busca, rowid, {campos}) VALUES ('delete', old.id, {valores('old')}); END")
+            conn.execute(f"CREATE TRIGGER IF NOT EXISTS chaves_busca_update AFTER UPDATE OF id, {campos} ON chaves BEGIN "
+                         f"INSERT INTO chaves_busca (chaves_busca, rowid, {campos}) VALUES ('delete', old.id, {valores('old')}); "
+                         f"INSERT INTO chaves_busca (rowid, {campos}) VALUES (new.id, {valores('new')}); END")
+            if not existia: conn.execute("INSERT INTO chaves_busca (chaves_busca) VALUES ('rebuild')")
+        return True
+    except sqlite3.OperationalError as e: print(f"Índice de busca indisponível ({e}); usando busca em memória."); return False
+
+class MotorBusca:
+    """Busca por substring, sem diferenciar maiúsculas, em chave/categoria/comprador/canal de venda.
+    Guarda o texto em minúsculas de cada item; uma consulta nova com 3+ caracteres parte do índice FTS5 e uma
+    consulta que só estende a anterior (digitação) é estreitada a partir do resultado anterior."""
+
+    def __init__(self, usar_fts):
+        self.usar_fts, self.textos = usar_fts, {}
+        self._ultima, self._resultado = None, None
+
+    @staticmethod
+    def _texto(item): return "\x00".join(item.get(c) or "" for c in CAMPOS_BUSCA).lower()  # \x00 impede casar entre campos.
+
+    def carregar(self, itens): self.carregar_textos((i['id'], self._texto(i)) for i in itens)
+
+    def carregar_textos(self, textos):
+        """Como carregar, a partir de pares (id, texto) já montados (ver EstoqueCompacto.textos_busca)."""
+        self.textos = dict(textos); self._ultima = self._resultado = None
+
+    def atualizar(self, item):
+        texto = self.textos[item['id']] = self._texto(item)
+        if self._ultima is not None: (self._resultado.add if self._ultima in texto else self._resultado.discard)(item['id'])
+
+    def remover(self, id_item):
+        self.textos.pop(id_item, None)
+        if self._resultado is not None: self._resultado.discard(id_item)
+
+    def corresponde(self, id_item, termo): return termo in self.textos.get(id_item, "")
+
+    def buscar(self, termo):
+        """Ids cujo texto contém termo (já em minúsculas)."""
+        textos = self.textos
+        if self._ultima is not None and self._ultima in termo: resultado = {i for i in self._resultado if termo in textos[i]}
+        elif (resultado := self._buscar_fts(termo)) is None: resultado = {i for i, t in textos.items() if termo in t}
+        self._ultima, self._resultado = termo, resultado
+        return resultado
+
+    def _buscar_fts(self, termo):
+        """Resultado via FTS5, ou None se o termo for curto/pouco seletivo (aí varrer a memória é mais barato)."""
+        if not self.usar_fts or len(termo) < 3: return None
+        try: ids = [r[0] for r in db.consultar("SELECT rowid FROM chaves_busca WHERE chaves_busca MATCH ? LIMIT ?", ('"' + termo.replace('"', '""') + '"', BUSCA_FTS_LIMITE))]
+        except sqlite3.Error: return None
+        if len(ids) >= BUSCA_FTS_LIMITE: return None
+        textos = self.textos  # O FTS só reduz candidatos; conferir o texto em memória mantém a semântica exata.
+        return {i for i in ids if termo in textos.get(i, "")}
+
+# --- Modo Consulta ---
+# Para inventários grandes: filtros/ordenação viram SQL e as linhas são lidas do BD por página, sob demanda.
+COLUNAS_ORDENACAO = {"chave": "chave COLLATE NOCASE", "categoria": "categoria COLLATE NOCASE", "status": "vendida", "comprador": "comprador COLLATE NOCASE", "canal_venda": "canal_venda COLLATE NOCASE", "data_venda": "data_venda"}
+
+def montar_consulta_chaves(busca="", categoria="Todos", canal="Todos", status="Todos", ordenar_por=None, decrescente=False, colunas="id", usar_fts=True):
+    """SELECT parametrizado equivalente aos filtros da barra principal; sem ordenar_por, segue a ordem manual."""
+    where, params = [], []
+    if busca:
+        if usar_fts and len(busca) >= 3: where.append("id IN (SELECT rowid FROM chaves_busca WHERE chaves_busca MATCH ?)"); params.append('"' + busca.replace('"', '""') + '"')
+        else: where.append("(" + " OR ".join(f"instr(lower(coalesce({c}, '')), ?)" for c in CAMPOS_BUSCA) + ")"); params.extend([busca.lower()] * len(CAMPOS_BUSCA))
+    if categoria != "Todos": where.append("categoria = ?"); params.append(categoria)
+    if canal == "Nenhum": where.append("(canal_venda IS NULL OR canal_venda = '')")
+    elif canal != "Todos": where.append("canal_venda = ?"); params.append(canal)
+    if status != "Todos": where.append("vendida = ?"); params.append(1 if status == "Vendida" else 0)
+    direcao = " DESC" if decrescente else ""
+    ordem = f"{COLUNAS_ORDENACAO[ordenar_por]}{direcao}, id{direcao}" if ordenar_por else "ordem_manual, id"
+    return f"SELECT {colunas} FROM chaves{' WHERE ' + ' AND '.join(where) if where else ''} ORDER BY {ordem}", params
+
+def filtro_chaves(busca="", categoria="Todos", canal="Todos", status="Todos", corresponde=None):
+    """Predicado em memória com a semântica de montar_consulta_chaves (a busca usa corresponde(id, termo), ver
+    MotorBusca). Os filtros são resolvidos uma vez aqui, não a cada item testado."""
+    testes = []
+    if busca: testes.append(lambda i: corresponde(i['id'], busca))
+    if categoria != "Todos": testes.append(lambda i: i.get("categoria") == categoria)
+    if canal == "Nenhum": testes.append(lambda i: not i.get("canal_venda"))
+    elif canal != "Todos": testes.append(lambda i: i.get("canal_venda") == canal)
+    if status != "Todos": vendida = 1 if status == "Vendida" else 0; testes.append(lambda i: i.get("vendida", 0) == vendida)
+    return lambda i: all(teste(i) for teste in testes)
+
+def chave_ordem(item):
+    """Posição do item na ordem manual da tabela."""
+    return (item.get('ordem_manual', item.get('id')) or 0, item['id'])
+
+class _IndiceSobDemanda:
+    """Visão somente leitura (get/[]/in) que resolve cada chave pela função dada."""
+    def __init__(self, resolver): self._resolver = resolver
+    def get(self, k, padrao=None): return padrao if (item := self._resolver(k)) is None else item
+    def __contains__(self, k): return self._resolver(k) is not None
+    def __getitem__(self, k):
+        if (item := self._resolver(k)) is None: raise KeyError(k)
+        return item
+
+class EstoquePaginado:
+    """Estoque do modo consulta: só as linhas pedidas (janela visível, seleção) são lidas do BD, em páginas, e ficam
+    num cache LRU limitado. Oferece a interface de dicionário usada pelo estoque em memória (por id, tree_id e chave)."""
+    PAGINA, CAPACIDADE = 200, 5000
+
+    def __init__(self):
+        self._cache, self._total = OrderedDict(), None
+        self.por_tree_id = _IndiceSobDemanda(lambda tid: self.get(int(tid[1:], 16)))
+        self.por_chave = _IndiceSobDemanda(self._buscar_chave)
+
+    def __len__(self):
+        if self._total is None: self._total = db.consultar_valor("SELECT COUNT(*) FROM chaves")
+        return self._total
+
+    def __contains__(self, id_chave): return self.get(id_chave) is not None
+
+    def __getitem__(self, id_chave):
+        if (item := self.get(id_chave)) is None: raise KeyError(id_chave)
+        return item
+
+    def get(self, id_chave, padrao=None):
+        if id_chave not in self._cache: self.carregar([id_chave])
+        if (item := self._cache.get(id_chave)) is None: return padrao
+        self._cache.move_to_end(id_chave); return item
+
+    def carregar(self, ids):
+        """Lê do BD, em lotes, os ids que ainda não estão no cache."""
+        faltando = [i for i in ids if i not in self._cache]
+        for k in range(0, len(faltando), 500):
+            lote = faltando[k:k + 500]
+            for row in db.consultar(f"SELECT * FROM chaves WHERE id IN ({','.join('?' * len(lote))})", lote): self._guardar(dict(row))
+        while len(self._cache) > self.CAPACIDADE: self._cache.popitem(last=False)
+
+    def _guardar(self, item):
+        item['tree_id'] = f"I{item['id']:08X}"; self._cache[item['id']] = item; return item
+
+    def _buscar_chave(self, chave):
+        row = db.consultar_um("SELECT * FROM chaves WHERE chave = ?", (chave,))
+        return self._guardar(dict(row)) if row else None
+
+    def invalidar(self, ids=None):
+        self._total = None
+        if ids is None: self._cache.clear(); return
+        for i in ids: self._cache.pop(i, None)
+
+# --- Estoque em Memória ---
+# Modo normal: o estoque inteiro fica em colunas (array) em vez de um dict por linha mais três dicts de índice.
+# Textos repetidos (categoria, canal, comprador) viram códigos inteiros, a data da venda vira um inteiro AAAAMMDDhhmmss
+# e vendida/presente são mapas de bits; cada linha é lida por um ItemEstoque, visão leve com a interface de dict.
+COLUNAS_ESTOQUE = ("id", "chave", "categoria", "vendida", "comprador", "data_venda", "ordem_manual", "preco_venda_brl", "preco_venda_usd", "canal_venda")
+ESTOQUE_LOTE = 50_000  # Linhas por fetchmany na carga: o resultado inteiro da consulta nunca fica em memória.
+_BIT_PARA_ASCII, _ASCII_PARA_BIT = bytes.maketrans(b"\x00\x01", b"01"), bytes.maketrans(b"01", b"\x00\x01")
+_DATA_PADRAO = re.compile(r"\d{4}-\d\d-\d\d \d\d:\d\d:\d\d")
+
+class _Codigos(dict):
+    """Internação: texto -> código pequeno, criado no primeiro uso (0 = NULL); 'valores' faz o caminho inverso."""
+    def __init__(self): super().__init__({None: 0}); self.valores = [None]
+
+    def __missing__(self, valor):
+        codigo = self[valor] = len(self.valores); self.valores.append(valor); return codigo
+
+def _acrescentar_bits(mapa, inicio, valores):
+    """Grava no bytearray 'mapa' os bits (0/1 por linha) a partir da posição 'inicio', ainda zerada."""
+    por_linha = bytes(map(bool, valores)); fim = inicio + len(por_linha)
+    mapa.extend(bytes(max(0, (fim + 7) // 8 - len(mapa))))
+    if len(por_linha) <= 64:
+        for p in compress(range(inicio, fim), por_linha): mapa[p >> 3] |= 1 << (p & 7)
+    elif por_linha:  # Em massa: os bits montados como um inteiro (bit p = linha p) e somados ao mapa de uma vez.
+        mapa[:] = (int.from_bytes(mapa, "little") | int(por_linha.translate(_BIT_PARA_ASCII)[::-1], 2) << inicio).to_bytes(len(mapa), "little")
+
+def _gravar_bit(mapa, p, valor):
+    if valor: mapa[p >> 3] |= 1 << (p & 7)
+    else: mapa[p >> 3] &= ~(1 << (p & 7)) & 0xFF
+
+def _codificar_data(datas, valor):
+    """data_venda -> int64: 0 = NULL; AAAAMMDDhhmmss para o formato do app; -código (em 'datas') para qualquer outro texto."""
+    if valor is None: return 0
+    if _DATA_PADRAO.fullmatch(valor): return int(valor[:4] + valor[5:7] + valor[8:10] + valor[11:13] + valor[14:16] + valor[17:])
+    return -datas[valor]
+
+def _decodificar_data(datas, codigo):
+    if codigo > 0: d = f"{codigo:014d}"; return f"{d[:4]}-{d[4:6]}-{d[6:8]} {d[8:10]}:{d[10:12]}:{d[12:]}"
+    return datas.valores[-codigo] if codigo else None
+
+def _posicoes_do_mapa(mapa, n):
+    """Posições (0..n-1) cujos bits estão ligados no inteiro 'mapa'."""
+    return list(compress(range(n), format(mapa, f"0{n}b")[::-1].encode().translate(_ASCII_PARA_BIT))) if n else []
+
+class ItemEstoque:
+    """Uma linha do EstoqueCompacto com a interface de dict de uma linha de 'chaves' (mais 'tree_id'). Não copia
+    valores: cada leitura vai às colunas, então reflete gravações feitas depois de o item ser entregue."""
+    __slots__ = ("_estoque", "_pos")
+    CAMPOS = COLUNAS_ESTOQUE + ("tree_id",)
+
+    def __init__(self, estoque, pos): self._estoque, self._pos = estoque, pos
+    def __getitem__(self, campo): return self._estoque._ler(self._pos, campo)
+    def __setitem__(self, campo, valor): self._estoque._escrever(self._pos, campo, valor)
+    def __contains__(self, campo): return campo in self.CAMPOS
+    def __iter__(self): return iter(self.CAMPOS)
+    def __eq__(self, outro): return isinstance(outro, ItemEstoque) and outro._estoque is self._estoque and outro._pos == self._pos
+    def __hash__(self): return hash((id(self._estoque), self._pos))
+    def __repr__(self): return f"ItemEstoque({dict(self)!r})"
+    def keys(self): return self.CAMPOS
+
+    def get(self, campo, padrao=None):
+        return self._estoque._ler(self._pos, campo) if campo in self.CAMPOS else padrao
+
+    def update(self, dados):
+        for campo, valor in dados.items(): self[campo] = valor
+
+class EstoqueCompacto:
+    """Estoque do modo normal, em colunas. Busca por id e por texto da chave em O(1): um array indexado pelo id e um
+    dict texto -> posição montado no primeiro uso. As posições só crescem (uma linha excluída só apaga seu bit em
+    'presente'), então a posição de um ItemEstoque nunca passa a outra linha; carregar de novo compacta."""
+    def __init__(self):
+        self._ids, self._chaves, self._ordem = array("q"), [], array("q")
+        self._categoria, self._canal, self._comprador, self._data = array("I"), array("I"), array("I"), array("q")
+        self._preco_brl, self._preco_usd = array("d"), array("d")
+        self._vendida, self._presente = bytearray(), bytearray()
+        self.categorias, self.canais, self.compradores, self.datas = _Codigos(), _Codigos(), _Codigos(), _Codigos()  # datas: só as fora do formato do app.
+        self._pos_por_id, self._pos_por_chave, self._total = array("i"), None, 0
+        self.por_tree_id = _IndiceSobDemanda(lambda tid: self.get(int(tid[1:], 16)))
+        self.por_chave = _IndiceSobDemanda(self._buscar_chave)
+
+    def __len__(self): return self._total
+    def __contains__(self, id_chave): return self._posicao(id_chave) >= 0
+
+    def __getitem__(self, id_chave):
+        if (p := self._posicao(id_chave)) < 0: raise KeyError(id_chave)
+        return ItemEstoque(self, p)
+
+    def get(self, id_chave, padrao=None):
+        return ItemEstoque(self, p) if (p := self._posicao(id_chave)) >= 0 else padrao
+
+    def values(self): return (ItemEstoque(self, p) for p in self._posicoes())
+
+    def carregar(self, cursor, lote=ESTOQUE_LOTE):
+        """Acrescenta tudo o que o cursor (SELECT das COLUNAS_ESTOQUE) devolver, 'lote' linhas por vez."""
+        while linhas := cursor.fetchmany(lote): self.acrescentar(linhas)
+        return self
+
+    def acrescentar(self, linhas):
+        """Inclui as linhas (tuplas na ordem de COLUNAS_ESTOQUE) cujo id ainda não está no estoque; devolve os ids incluídos.
+        ordem_manual NULL vira 0, como em chave_ordem; preços NULL viram NaN."""
+        linhas = list(linhas)
+        if self._total and not (linhas and isinstance(self._pos_por_id, array) and min(r[0] for r in linhas) >= len(self._pos_por_id)):
+            linhas = [r for r in linhas if self._posicao(r[0]) < 0]  # Ids acima de todos os já indexados dispensam a checagem.
+        if not linhas: return ()
+        inicio = len(self._ids); ids, chaves, categorias, vendidas, compradores, datas, ordens, brl, usd, canais = zip(*linhas)
+        self._ids.extend(ids); self._chaves.extend(chaves); self._ordem.extend(o or 0 for o in ordens)
+        for coluna, codigos, valores in ((self._categoria, self.categorias, categorias), (self._canal, self.canais, canais), (self._comprador, self.compradores, compradores)):
+            coluna.extend(map(codigos.__getitem__, valores))
+        self._data.extend(_codificar_data(self.datas, d) for d in datas)
+        self._preco_brl.extend(float("nan") if v is None else v for v in brl); self._preco_usd.extend(float("nan") if v is None else v for v in usd)
+        _acrescentar_bits(self._vendida, inicio, vendidas); _acrescentar_bits(self._presente, inicio, b"\x01" * len(ids))
+        self._indexar(ids, inicio); self._total += len(ids)
+        if self._pos_por_chave is not None: self._pos_por_chave.update(zip(chaves, range(inicio, inicio + len(ids))))
+        return ids
+
+    def gravar(self, dados):
+        """Insere ou atualiza no lugar a linha dados['id'] (um dict com as COLUNAS_ESTOQUE); devolve o ItemEstoque."""
+        if (p := self._posicao(dados['id'])) < 0: self.acrescentar([tuple(dados[c] for c in COLUNAS_ESTOQUE)]); p = self._posicao(dados['id'])
+        else:
+            for campo in COLUNAS_ESTOQUE[1:]: self._escrever(p, campo, dados[campo])
+        return ItemEstoque(self, p)
+
+    def remover(self, id_chave):
+        if (p := self._posicao(id_chave)) < 0: return False
+        _gravar_bit(self._presente, p, 0); self._pos_por_id[id_chave] = -1; self._total -= 1
+        if self._pos_por_chave is not None and self._pos_por_chave.get(self._chaves[p]) == p: del self._pos_por_chave[self._chaves[p]]
+        return True
+
+    def filtrar(self, categoria="Todos", canal="Todos", status="Todos", ids=None):
+        """chave_ordem das linhas que passam nos filtros da barra, já ordenadas; 'ids' (resultado da busca) restringe as
+        candidatas. Mesma semântica de filtro_chaves, comparando códigos e bits em vez de textos."""
+        if ids is None:
+            mapa = int.from_bytes(self._presente, "little")
+            if status != "Todos": vendidas = int.from_bytes(self._vendida, "little"); mapa &= vendidas if status == "Vendida" else ~vendidas
+            posicoes = _posicoes_do_mapa(mapa, len(self._ids))
+        else:
+            posicoes = [p for p in map(self._posicao, ids) if p >= 0]
+            if status != "Todos":
+                alvo, vendidas = int(status == "Vendida"), self._vendida; posicoes = [p for p in posicoes if vendidas[p >> 3] >> (p & 7) & 1 == alvo]
+        testes = []
+        if categoria != "Todos": testes.append((self._categoria, {self.categorias.get(categoria)}))
+        if canal == "Nenhum": testes.append((self._canal, {0, self.canais.get("")}))
+        elif canal != "Todos": testes.append((self._canal, {self.canais.get(canal)}))
+        for coluna, codigos in testes: posicoes = list(compress(posicoes, map(codigos.__contains__, map(coluna.__getitem__, posicoes))))
+        return sorted(zip(map(self._ordem.__getitem__, posicoes), map(self._ids.__getitem__, posicoes)))
+
+    def chave_ordenacao(self, coluna):
+        """Função id -> texto em minúsculas do que a coluna da tabela mostra, para ordenar sem montar as linhas."""
+        if coluna == "chave": chaves = self._chaves; return lambda i: chaves[self._posicao(i)].lower()
+        if coluna == "status": vendidas = self._vendida; return lambda i: "vendida" if vendidas[(p := self._posicao(i)) >> 3] >> (p & 7) & 1 else "disponível"
+        if coluna == "data_venda": return lambda i: (self._ler(self._posicao(i), "data_venda") or "").lower()
+        codigos, valores = {"categoria": (self._categoria, self.categorias), "comprador": (self._comprador, self.compradores), "canal_venda": (self._canal, self.canais)}[coluna]
+        textos = [(v or "").lower() for v in valores.valores]; return lambda i: textos[codigos[self._posicao(i)]]
+
+    def textos_busca(self):
+        """Pares (id, texto) no formato de MotorBusca._texto, montados direto das colunas."""
+        categorias, compradores, canais = ([v or "" for v in c.valores] for c in (self.categorias, self.compradores, self.canais))
+        return ((self._ids[p], f"{self._chaves[p]}\x00{categorias[self._categoria[p]]}\x00{compradores[self._comprador[p]]}\x00{canais[self._canal[p]]}".lower()) for p in self._posicoes())
+
+    # --- Internos ---
+    def _posicoes(self): return _posicoes_do_mapa(int.from_bytes(self._presente, "little"), len(self._ids))
+
+    def _posicao(self, id_chave):
+        """Posição da linha presente com esse id, ou -1."""
+        try: return self._pos_por_id[id_chave] if id_chave >= 0 else -1
+        except (IndexError, KeyError): return -1
+
+    def _indexar(self, ids, inicio):
+        """Array id -> posição (4 bytes por id até o maior); ids muito esparsos passam a um dict, para não alocar os buracos."""
+        maior = max(ids)
+        if isinstance(self._pos_por_id, array) and maior >= 8 * (self._total + len(ids)) + 65536:
+            self._pos_por_id = {i: p for i, p in enumerate(self._pos_por_id) if p >= 0}
+        if isinstance(self._pos_por_id, dict): self._pos_por_id.update(zip(ids, range(inicio, inicio + len(ids)))); return
+        if maior >= len(self._pos_por_id): self._pos_por_id.extend(array("i", [-1]) * (maior + 1 - len(self._pos_por_id)))
+        indice = self._pos_por_id
+        for p, i in enumerate(ids, inicio): indice[i] = p
+
+    def _buscar_chave(self, chave):
+        if self._pos_por_chave is None:
+            self._pos_por_chave = dict(zip(self._chaves, range(len(self._chaves))))
+            if self._total < len(self._chaves):  # Tira as excluídas (sem apagar uma linha nova que reusou o texto).
+                presentes = set(self._posicoes())
+                for p, c in enumerate(self._chaves):
+                    if p not in presentes and self._pos_por_chave.get(c) == p: del self._pos_por_chave[c]
+        return ItemEstoque(self, p) if (p := self._pos_por_chave.get(chave, -1)) >= 0 else None
+
+    def _ler(self, p, campo):
+        if campo == "id": return self._ids[p]
+        if campo == "chave": return self._chaves[p]
+        if campo == "tree_id": return f"I{self._ids[p]:08X}"
+        if campo == "vendida": return self._vendida[p >> 3] >> (p & 7) & 1
+        if campo == "ordem_manual": return self._ordem[p]
+        if campo == "data_venda": return _decodificar_data(self.datas, self._data[p])
+        if campo in _COLUNAS_CODIGO: coluna, codigos = _COLUNAS_CODIGO[campo]; return getattr(self, codigos).valores[getattr(self, coluna)[p]]
+        if campo in _COLUNAS_PRECO: valor = getattr(self, _COLUNAS_PRECO[campo])[p]; return None if valor != valor else valor
+        raise KeyError(campo)
+
+    def _escrever(self, p, campo, valor):
+        if campo == "chave":
+            if self._pos_por_chave is not None:
+                if self._pos_por_chave.get(self._chaves[p]) == p: del self._pos_por_chave[self._chaves[p]]
+                self._pos_por_chave[valor] = p
+            self._chaves[p] = valor
+        elif campo == "vendida": _gravar_bit(self._vendida, p, valor)
+        elif campo == "ordem_manual": self._ordem[p] = valor or 0
+        elif campo == "data_venda": self._data[p] = _codificar_data(self.datas, valor)
+        elif campo in _COLUNAS_CODIGO: coluna, codigos = _COLUNAS_CODIGO[campo]; getattr(self, coluna)[p] = getattr(self, codigos)[valor]
+        elif campo in _COLUNAS_PRECO: getattr(self, _COLUNAS_PRECO[campo])[p] = float("nan") if valor is None else valor
+        elif campo != "tree_id": raise KeyError(campo)  # id não muda; tree_id é derivado dele.
+
+_COLUNAS_CODIGO = {"categoria": ("_categoria", "categorias"), "canal_venda": ("_canal", "canais"), "comprador": ("_comprador", "compradores")}
+_COLUNAS_PRECO = {"preco_venda_brl": "_preco_brl", "preco_venda_usd": "_preco_usd"}
+
+# --- Importação de Chaves ---
+def _coluna_para_indice(coluna):
+    """Converte uma coluna do Excel (ex: 'A', 'B', 'AA') para um índice 0."""
+    indice = 0
+    for char in coluna.strip().upper(): indice = indice * 26 + (ord(char) - ord('A') + 1)
+    return indice - 1
+
+class LeitorChaves:
+    """Lê chaves de XLSX/XLSM (openpyxl somente leitura), XLS (xlrd), CSV ou TXT linha a linha, sem montar a planilha
+    inteira em memória. Itera sobre as chaves (sem espaços nas pontas; células vazias são ignoradas) das colunas e
+    planilhas pedidas (padrão: a primeira); 'progresso' (0 a 1) acompanha a leitura. TXT: uma chave por linha."""
+
+    def __init__(self, caminho, colunas=("A",), linha_inicio=1, planilhas=None):
+        self.caminho, self.linha_inicio, self.planilhas = caminho, max(1, linha_inicio), list(planilhas or [])
+        self.colunas = [_coluna_para_indice(c) for c in colunas]; self.progresso = 0.0
+        self.extensao = os.path.splitext(caminho)[1].lower()
+
+    def __iter__(self):
+        leitor = {".xlsx": self._ler_xlsx, ".xlsm": self._ler_xlsx, ".xls": self._ler_xls, ".csv": self._ler_csv}.get(self.extensao, self._ler_txt)
+        for linha in leitor():
+            for i in self.colunas:
+                if i < len(linha) and (valor := linha[i]) is not None and (chave := str(valor).strip()): yield chave
+        self.progresso = 1.0
+
+    def nomes_planilhas(self):
+        if self.extensao in (".xlsx", ".xlsm"):
+            from openpyxl import load_workbook
+            wb = load_workbook(self.caminho, read_only=True); nomes = wb.sheetnames; wb.close(); return nomes
+        if self.extensao == ".xls":
+            import xlrd
+            wb = xlrd.open_workbook(self.caminho, on_demand=True); nomes = wb.sheet_names(); wb.release_resources(); return nomes
+        return []
+
+    def _ler_xlsx(self):
+        from openpyxl import load_workbook
+        wb = load_workbook(self.caminho, read_only=True, data_only=True)
+        try:
+            folhas = [wb[n] for n in self.planilhas] if self.planilhas else wb.worksheets[:1]
+            for k, ws in enumerate(folhas):
+                total = ws.max_row or 0
+                for n, linha in enumerate(ws.iter_rows(min_row=self.linha_inicio, values_only=True)):
+                    if total and n % 500 == 0: self.progresso = (k + min(1.0, (self.linha_inicio + n) / total)) / len(folhas)
+                    yield linha
+        finally: wb.close()
+
+    def _ler_xls(self):
+        import xlrd
+        wb = xlrd.open_workbook(self.caminho, on_demand=True)
+        try:
+            nomes = self.planilhas or wb.sheet_names()[:1]
+            for k, nome in enumerate(nomes):
+                ws = wb.sheet_by_name(nome)
+                for n in range(self.linha_inicio - 1, ws.nrows):
+                    if n % 500 == 0: self.progresso = (k + n / ws.nrows) / len(nomes)
+                    yield ws.row_values(n)
+                wb.unload_sheet(nome)
+        finally: wb.release_resources()
+
+    def _ler_csv(self):
+        with open(self.caminho, "r", encoding="utf-8-sig", errors="replace", newline="") as f:
+            amostra = f.read(64 * 1024); f.seek(0)
+            try: dialeto = csv.Sniffer().sniff(amostra, delimiters=",;\t|")
+            except csv.Error: dialeto = csv.excel
+            yield from self._linhas_de_texto(f, csv.reader(f, dialeto))
+
+    def _ler_txt(self):
+        with open(self.caminho, "r", encoding="utf-8-sig", errors="replace", newline="") as f:
+            yield from self._linhas_de_texto(f, ([linha.rstrip("\r\n")] for linha in f))
+
+    def _linhas_de_texto(self, arquivo, linhas):
+        total = os.path.getsize(self.caminho) or 1
+        for n, linha in enumerate(linhas, 1):
+            if n % 500 == 0: self.progresso = min(1.0, arquivo.buffer.tell() / total)
+            if n >= self.linha_inicio: yield linha
+
+def ingerir_chaves(chaves, categoria, canal=None, tamanho_lote=INGESTAO_LOTE, cancelar=None, ao_lote=None, desfazer=False):
+    """Ingestão em massa, independente do Tk (pode rodar numa thread de trabalho). Cada lote vai para uma tabela
+    temporária e entra em 'chaves' por um único INSERT ... SELECT que descarta repetidas no lote e já cadastradas, e
+    numera ordem_manual na ordem do arquivo, com folga de ORDEM_INTERVALO. 'cancelar' é um threading.Event; ao_lote(adicionadas,
+    duplicadas) é chamado após cada transação. 'desfazer' grava a ingestão num passo de desfazer: True abre um novo na
+    transação do primeiro lote, um id (de passo_undo) continua esse passo. Retorna (ids_novos, adicionadas, duplicadas, interrompida)."""
+    adicionadas = duplicadas = 0; interrompida = False; lote = []; ids = []; passo = desfazer if desfazer is not True else None
+    db.conexao().execute("CREATE TEMP TABLE IF NOT EXISTS ingestao_chaves (seq INTEGER PRIMARY KEY, chave TEXT NOT NULL)")
+    def gravar():
+        nonlocal adicionadas, duplicadas, passo
+        with passo_undo(passo) if desfazer else nullcontext() as passo, db.transacao(imediata=True) as conn:
+            conn.execute("DELETE FROM temp.ingestao_chaves"); conn.executemany("INSERT INTO temp.ingestao_chaves (chave) VALUES (?)", ((c,) for c in lote))
+            ordem = conn.execute("SELECT COALESCE(MAX(ordem_manual), 0) FROM chaves").fetchone()[0]
+            novos = conn.execute(f"""INSERT INTO chaves (chave, categoria, ordem_manual, canal_venda)
+                                  SELECT chave, ?, ? + ROW_NUMBER() OVER (ORDER BY primeira) * {ORDEM_INTERVALO}, ? FROM (SELECT chave, MIN(seq) AS primeira FROM temp.ingestao_chaves GROUP BY chave) AS candidatas
+                                  WHERE NOT EXISTS (SELECT 1 FROM chaves WHERE chaves.chave = candidatas.chave) ORDER BY primeira RETURNING id""", (categoria, ordem, canal)).fetchall()
+            conn.execute("DELETE FROM temp.ingestao_chaves")
+        ids.extend(sorted(row[0] for row in novos))  # Só os desta ingestão, mesmo com outras conexões inserindo no meio.
+        adicionadas += len(novos); duplicadas += len(lote) - len(novos); lote.clear()
+        if ao_lote: ao_lote(adicionadas, duplicadas)
+    inicio = time.perf_counter()
+    for chave in chaves:
+        if cancelar is not None and cancelar.is_set(): interrompida = True; break
+        lote.append(chave)
+        if len(lote) >= tamanho_lote: gravar()
+    if lote and not interrompida: gravar()
+    auditoria.registrar("importacao", f"{adicionadas} chave(s) adicionada(s) em '{categoria}', {duplicadas} repetida(s).", categoria=categoria, canal=canal, arquivo=os.path.basename(c) if (c := getattr(chaves, 'caminho', None)) else None,
+                        adicionadas=adicionadas, duplicadas=duplicadas, faixa_ids=[ids[0], ids[-1]] if ids else None, interrompida=interrompida or None, duracao_ms=round((time.perf_counter() - inicio) * 1000, 2))
+    return ids, adicionadas, duplicadas, interrompida
+
+# --- Ordem Manual ---
+# ordem_manual tem folga (ORDEM_INTERVALO) entre chaves vizinhas: arrastar uma chave grava só ela, com um valor entre
+# as duas novas vizinhas. Quando um ponto da ordem fica sem folga, mover_chaves reespaça só uma janela de linhas em
+# volta dele, dobrando a janela até haver folga de sobra; reespacar_ordem renumera tudo (manutenção).
+_SQL_REESPACAR_ORDEM = f"""UPDATE chaves SET ordem_manual = nova.ordem FROM
+    (SELECT id, ROW_NUMBER() OVER (ORDER BY ordem_manual, id) * {ORDEM_INTERVALO} AS ordem FROM chaves) AS nova
+    WHERE chaves.id = nova.id AND chaves.ordem_manual IS NOT nova.ordem"""
+
+def reespacar_ordem():
+    """Renumera a ordem manual inteira com folga ORDEM_INTERVALO, mantendo a ordem. Devolve quantas linhas mudaram."""
+    with db.transacao(imediata=True) as conn: return conn.execute(_SQL_REESPACAR_ORDEM).rowcount
+
+def _espalhar(ids, inferior, superior):
+    """{id: ordem} com os ids igualmente espaçados estritamente entre inferior e superior (None = sem limite)."""
+    if superior is None: return {i: inferior + ORDEM_INTERVALO * (n + 1) for n, i in enumerate(ids)}
+    if inferior is None: return {i: superior - ORDEM_INTERVALO * (len(ids) - n) for n, i in enumerate(ids)}
+    return {i: inferior + (superior - inferior) * (n + 1) // (len(ids) + 1) for n, i in enumerate(ids)}
+
+def mover_chaves(ids, depois_de=None):
+    """Põe as chaves 'ids' (nesta ordem) logo depois da chave 'depois_de' na ordem manual (None = no começo de tudo).
+    Grava só as movidas enquanto houver folga até a próxima chave; sem folga, reespaça também uma janela das chaves
+    seguintes. Devolve {id: ordem_manual nova} de todas as linhas alteradas."""
+    ids = list(dict.fromkeys(ids))
+    if not ids: return {}
+    if depois_de in ids: raise ValueError("A chave de referência não pode estar entre as movidas.")
+    movidas = json.dumps(ids); fora = "id NOT IN (SELECT value FROM json_each(?))"
+    with db.transacao(imediata=True) as conn:
+        if depois_de is None:
+            novas = _espalhar(ids, None, conn.execute(f"SELECT COALESCE(MIN(ordem_manual), 0) FROM chaves WHERE {fora}", (movidas,)).fetchone()[0])
+        else:
+            if (ancora := conn.execute("SELECT ordem_manual FROM chaves WHERE id = ?", (depois_de,)).fetchone()) is None: raise ValueError(f"Chave {depois_de} não encontrada.")
+            inferior, janela = ancora[0] or 0, 0
+            while True:
+                # janela = 0: só a próxima chave limita; depois, as 'janela' seguintes entram na redistribuição junto com as movidas.
+                seguintes = conn.execute(f"SELECT id, ordem_manual FROM chaves WHERE (ordem_manual, id) > (?, ?) AND {fora} ORDER BY ordem_manual, id LIMIT ?",
+                                         (inferior, depois_de, movidas, janela + 1)).fetchall()
+                reespacadas = [r[0] for r in seguintes[:janela]]; superior = seguintes[janela][1] if len(seguintes) > janela else None
+                if superior is None or superior - inferior > (len(ids) + len(reespacadas)) * (2 if janela else 1): break
+                janela = max(ORDEM_JANELA, janela * 2)
+            novas = _espalhar(ids + reespacadas, inferior, superior)
+        conn.executemany("UPDATE chaves SET ordem_manual = ? WHERE id = ?", [(ordem, i) for i, ordem in novas.items()])
+    return novas
+
+# --- Fila de Email ---
+def carregar_config_email():
+    try:
+        with open(EMAIL_CONFIG_FILE, "r") as f: return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError): return {}
+
+def config_email_completa(config):
+    """email/servidor/porta são obrigatórios; a senha só quando há login (servidores locais de teste dispensam)."""
+    return all(config.get(k) for k in ("email", "servidor", "porta")) and (not config.get("login", True) or bool(config.get("senha")))
+
+def montar_email(remetente, destinatario, assunto, corpo, caminho_anexo=None):
+    msg = MIMEMultipart(); msg['From'] = remetente; msg['To'] = destinatario; msg['Subject'] = assunto
+    corpo_html = corpo.replace('\n', '<br>'); corpo_html = re.sub(r'\*\*(.*?)\*\*', r'<b>\1</b>', corpo_html); msg.attach(MIMEText(corpo_html, 'html', 'utf-8'))
+    if caminho_anexo and os.path.exists(caminho_anexo):
+        with open(caminho_anexo, "rb") as anexo_file: part = MIMEApplication(anexo_file.read(), Name=os.path.basename(caminho_anexo))
+        part['Content-Disposition'] = f'attachment; filename="{os.path.basename(caminho_anexo)}"'
+        msg.attach(part)
+    return msg
+
+class FilaEmail:
+    """Fila persistente de emails de saída (tabela fila_email) consumida por uma única thread de trabalho, que mantém a
+    sessão SMTP aberta entre mensagens, envia em lotes e reagenda falhas transitórias com backoff exponencial.
+    Não toca no Tk: cada mudança de estado vira um evento (tipo, id, destinatario, detalhe) em 'eventos' (queue.Queue),
+    lido pela interface no seu próprio loop. Config: email, senha, servidor, porta e, opcionais, tls/login (padrão
+    True; com ambos False serve um SMTP local de testes, como o aiosmtpd)."""
+    LOTE, MAX_TENTATIVAS, BACKOFF_BASE, BACKOFF_MAX, OCIOSO = 20, 5, 30, 3600, 60  # segundos
+
+    def __init__(self, carregar_config=carregar_config_email):
+        self.carregar_config, self.eventos = carregar_config, queue.Queue()
+        self._acordar, self._parar, self._thread = threading.Event(), threading.Event(), None
+        self._smtp, self._chave_sessao, self._ultimo_uso = None, None, 0.0
+
+    def iniciar(self):
+        db.executar("UPDATE fila_email SET status = 'pendente' WHERE status = 'enviando'")  # Envios interrompidos pelo fechamento do app.
+        self._parar.clear(); self._thread = threading.Thread(target=self._executar, name="fila-email", daemon=True); self._thread.start()
+
+    def parar(self, timeout=10):
+        self._parar.set(); self._acordar.set()
+        if self._thread: self._thread.join(timeout)
+
+    def enfileirar(self, destinatario, assunto, corpo, caminho_anexo=None):
+        agora = f"{datetime.now():%Y-%m-%d %H:%M:%S}"
+        id_email = db.executar("INSERT INTO fila_email (destinatario, assunto, corpo, anexo, proxima_tentativa, criado_em) VALUES (?, ?, ?, ?, ?, ?)",
+                               (destinatario, assunto, corpo, caminho_anexo, agora, agora)).lastrowid
+        self._acordar.set(); return id_email
+
+    def reenfileirar_falhas(self):
+        n = db.executar("UPDATE fila_email SET status = 'pendente', tentativas = 0, erro = NULL, proxima_tentativa = ? WHERE status = 'falhou'", (f"{datetime.now():%Y-%m-%d %H:%M:%S}",)).rowcount
+        self._acordar.set(); return n
+
+    def contagem(self):
+        return {row[0]: row[1] for row in db.consultar("SELECT status, COUNT(*) FROM fila_email GROUP BY status")}
+
+    def aguardar(self, timeout=None):
+        """Bloqueia até não restar email vencido pendente nem em envio (os reagendados para mais tarde continuam na fila)."""
+        limite = time.monotonic() + timeout if timeout else None
+        while db.consultar_valor("SELECT EXISTS (SELECT 1 FROM fila_email WHERE status = 'enviando' OR (status = 'pendente' AND proxima_tentativa <= ?))", (f"{datetime.now():%Y-%m-%d %H:%M:%S}",)):
+            if limite and time.monotonic() > limite: return False
+            time.sleep(0.2)
+        return True
+
+    # --- Thread de trabalho ---
+    def _executar(self):
+        try:
+            while not self._parar.is_set():
+                if lote := self._proximo_lote():
+                    config = self.carregar_config()  # Uma leitura por lote, não por mensagem.
+                    for email in lote: self._enviar(email, config)
+                    continue
+                if self._smtp and time.monotonic() - self._ultimo_uso > self.OCIOSO: self._fechar_sessao()
+                self._acordar.wait(self._espera()); self._acordar.clear()
+        finally: self._fechar_sessao(); db.fechar_da_thread()
+
+    def _proximo_lote(self):
+        with db.transacao(imediata=True) as conn:
+            lote = conn.execute("SELECT * FROM fila_email WHERE status = 'pendente' AND proxima_tentativa <= ? ORDER BY id LIMIT ?", (f"{datetime.now():%Y-%m-%d %H:%M:%S}", self.LOTE)).fetchall()
+            conn.executemany("UPDATE fila_email SET status = 'enviando' WHERE id = ?", [(e['id'],) for e in lote])
+        return lote
+
+    def _espera(self):
+        proxima = db.consultar_valor("SELECT MIN(proxima_tentativa) FROM fila_email WHERE status = 'pendente'")
+        if not proxima: return self.OCIOSO
+        return max(0.5, min(self.OCIOSO, (datetime.strptime(proxima, "%Y-%m-%d %H:%M:%S") - datetime.now()).total_seconds()))
+
+    def _sessao(self, config):
+        chave = (config['servidor'], int(config['porta']), config['email'], config.get('senha'), config.get('tls', True), config.get('login', True))
+        if self._smtp is not None and chave != self._chave_sessao: self._fechar_sessao()  # Configuração mudou.
+        if self._smtp is None:
+            smtp = smtplib.SMTP(config['servidor'], int(config['porta']), timeout=30)
+            if config.get('tls', True): smtp.starttls()
+            if config.get('login', True): smtp.login(config['email'], config['senha'])
+            self._smtp, self._chave_sessao = smtp, chave
+        return self._smtp
+
+    def _fechar_sessao(self):
+        if self._smtp is None: return
+        try: self._smtp.quit()
+        except (smtplib.SMTPException, OSError): pass
+        self._smtp = None
+
+    @metricas.medido("email.enviar")
+    def _enviar(self, email, config):
+        if not config_email_completa(config):
+            self._finalizar(email, 'falhou', "Configuração de email incompleta."); return
+        msg = montar_email(config['email'], email['destinatario'], email['assunto'], email['corpo'], email['anexo'])
+        try:
+            try: self._sessao(config).send_message(msg, config['email'], [email['destinatario']])
+            except smtplib.SMTPServerDisconnected: self._fechar_sessao(); self._sessao(config).send_message(msg, config['email'], [email['destinatario']])  # Sessão caiu enquanto ociosa.
+        except Exception as e:
+            if not isinstance(e, (smtplib.SMTPRecipientsRefused, smtplib.SMTPResponseException)) or isinstance(e, smtplib.SMTPAuthenticationError): self._fechar_sessao()  # Recusas do servidor mantêm a sessão válida.
+            codigos = [c for c, _ in e.recipients.values()] if isinstance(e, smtplib.SMTPRecipientsRefused) else [e.smtp_code] if isinstance(e, smtplib.SMTPResponseException) else []
+            permanente = isinstance(e, smtplib.SMTPAuthenticationError) or any(500 <= c < 600 for c in codigos)  # 4xx e erros de rede são transitórios.
+            if permanente or email['tentativas'] + 1 >= self.MAX_TENTATIVAS: self._finalizar(email, 'falhou', str(e), tentativas=email['tentativas'] + 1); return
+            atraso = min(self.BACKOFF_MAX, self.BACKOFF_BASE * 2 ** email['tentativas'])
+            db.executar("UPDATE fila_email SET status = 'pendente', tentativas = tentativas + 1, erro = ?, proxima_tentativa = ? WHERE id = ?",
+                        (str(e), f"{datetime.now() + timedelta(seconds=atraso):%Y-%m-%d %H:%M:%S}", email['id']))
+            logar_acao(f"Falha temporária ao enviar email para {email['destinatario']} (nova tentativa em {atraso}s). Erro: {e}", "email", destinatario=email['destinatario'], status='reagendado')
+            self.eventos.put(('reagendado', email['id'], email['destinatario'], str(e))); return
+        self._ultimo_uso = time.monotonic(); self._finalizar(email, 'enviado')
+
+    def _finalizar(self, email, status, erro=None, tentativas=None):
+        db.executar("UPDATE fila_email SET status = ?, erro = ?, tentativas = ?, enviado_em = ? WHERE id = ?",
+                    (status, erro, email['tentativas'] if tentativas is None else tentativas, f"{datetime.now():%Y-%m-%d %H:%M:%S}" if status == 'enviado' else None, email['id']))
+        if status == 'enviado': logar_acao(f"Email enviado com sucesso para {email['destinatario']}", "email", destinatario=email['destinatario'], status=status)
+        else: logar_acao(f"FALHA ao enviar email para {email['destinatario']}. Erro: {erro}", "email", destinatario=email['destinatario'], status=status)
+        self.eventos.put((status, email['id'], email['destinatario'], erro))
+
+# --- Entregas ---
+def construir_mensagem_entrega(chaves_entregues, categoria_dict, idioma='pt_br'):
+    """Texto da entrega (clipboard/email): chaves agrupadas por categoria e as instruções de cada uma no idioma."""
+    if idioma == 'en_us':
+        header = "Thank you for your purchase! Here are your order details:"
+        footer = "If you have any questions or issues with activation, please contact us."
+    elif idioma == 'es_es':
+        header = "¡Gracias por su compra! Siguen los detalles de su pedido:"
+        footer = "Cualquier duda o problema con la activación, por favor, póngase en contacto."
+    else: # pt_br
+        header = "Obrigado por sua compra! Seguem os detalhes do seu pedido:"
+        footer = "Qualquer dúvida ou problema com a ativação, por favor, entre em contato."
+    partes_chaves, partes_instrucoes = [], []; chaves_por_cat = defaultdict(list)
+    for chave in chaves_entregues: chaves_por_cat[chave.get("categoria", "S/C")].append(chave['chave'])
+    for cat_nome, chaves in sorted(chaves_por_cat.items()):
+        partes_chaves.append(f"**{cat_nome}:**"); partes_chaves.extend(chaves); partes_chaves.append("")
+        if cat_obj := categoria_dict.get(cat_nome):
+            inst_key, inst_header_tpl = ('instrucao_en', "**Instructions for {cat_nome} (EN-US):**") if idioma == 'en_us' else ('instrucao_es', "**Instrucciones para {cat_nome} (ES):**") if idioma == 'es_es' else ('instrucao_pt', "**Instruções para {cat_nome} (PT-BR):**")
+            if inst_text := (cat_obj.get(inst_key) or "").strip():
+                partes_instrucoes.extend(["----------", inst_header_tpl.format(cat_nome=cat_nome), inst_text, ""])
+    mensagem_final = [header, "", *partes_chaves]
+    if partes_instrucoes: mensagem_final.extend(partes_instrucoes)
+    mensagem_final.extend([footer]); return "\n".join(mensagem_final)
+
+def caminho_pdf_entrega(comprador, sufixo=""):
+    """pdfs/AAAA-MM-DD/Entrega_<comprador>_<timestamp><sufixo>.pdf (o sufixo separa pedidos do mesmo segundo num lote)."""
+    pasta_data = os.path.join(PDF_DIR, datetime.now().strftime("%Y-%m-%d")); os.makedirs(pasta_data, exist_ok=True)
+    return os.path.join(pasta_data, f"Entrega_{_sanitize_filename(comprador).replace(' ','_')}_{datetime.now():%Y%m%d%H%M%S}{sufixo}.pdf")
+
+def trabalho_pdf_entrega(caminho, chaves_entregues, categoria_dict, idioma, comprador, email_comprador=""):
+    """Dados simples para renderizar_pdf_entrega (só as categorias usadas, copiadas para poderem ir a outro processo)."""
+    cats = {c.get("categoria", "S/C") for c in chaves_entregues}
+    return {"caminho": caminho, "idioma": idioma, "comprador": comprador, "email": email_comprador,
+            "chaves": [{"chave": c['chave'], "categoria": c.get("categoria", "S/C")} for c in chaves_entregues],
+            "categorias": {nome: dict(categoria_dict[nome]) for nome in cats if nome in categoria_dict}}
+
+# --- Reserva de Chaves ---
+# Toda venda passa por aqui: o UPDATE só pega linhas com vendida = 0 e devolve (RETURNING) o que de fato vendeu, dentro
+# de BEGIN IMMEDIATE. Assim duas instâncias do app (ou o app e um processo em lote) no mesmo gerenciador.db nunca
+# vendem a mesma chave: quem chega depois recebe o conflito em vez de sobrescrever a venda.
+_SQL_VENDER = "UPDATE chaves SET vendida=1, comprador=?, data_venda=?, preco_venda_brl=?, preco_venda_usd=?, canal_venda=? WHERE vendida = 0 AND "
+
+def _executar_venda(conn, filtro, params, comprador, preco_brl, preco_usd, canal, data_venda, esperado, parcial):
+    """Roda o UPDATE num SAVEPOINT (funciona sozinho ou dentro de uma transação maior, como a do lote) e o desfaz se
+    vendeu menos que 'esperado' sem 'parcial'. Devolve as linhas vendidas, na ordem manual."""
+    conn.execute("SAVEPOINT venda")
+    try: vendidas = [dict(r) for r in conn.execute(_SQL_VENDER + filtro + " RETURNING *", (comprador, data_venda or f"{datetime.now():%Y-%m-%d %H:%M:%S}", preco_brl, preco_usd, canal, *params)).fetchall()]
+    except BaseException: conn.execute("ROLLBACK TO venda"); conn.execute("RELEASE venda"); raise
+    if len(vendidas) < esperado and not parcial: conn.execute("ROLLBACK TO venda"); vendidas = []
+    elif vendidas and canal: conn.execute("INSERT OR IGNORE INTO canais_venda (nome) VALUES (?)", (canal,))
+    conn.execute("RELEASE venda")
+    return sorted(vendidas, key=lambda r: (r['ordem_manual'] if r['ordem_manual'] is not None else 0, r['id']))
+
+def _auditar_venda(vendidas, comprador, canal, inicio, **campos):
+    """Evento 'venda' (um por chamada, com todas as chaves), gravado só se a transação externa confirmar."""
+    if vendidas: db.ao_confirmar(lambda: auditoria.registrar("venda", chaves=vendidas, comprador=comprador, canal=canal, duracao_ms=round((time.perf_counter() - inicio) * 1000, 2), **campos))
+
+def vender_chaves(ids, comprador, preco_brl=0.0, preco_usd=0.0, canal=None, data_venda=None, parcial=False):
+    """Vende exatamente as chaves 'ids' que ainda estiverem disponíveis. Devolve (vendidas, conflitos): as linhas
+    vendidas (dicts) e os ids que já não estavam disponíveis. Sem 'parcial', um conflito cancela a venda inteira."""
+    ids = list(dict.fromkeys(ids)); inicio = time.perf_counter()
+    with db.transacao(imediata=True) as conn:
+        vendidas = _executar_venda(conn, "id IN (SELECT value FROM json_each(?))", (json.dumps(ids),), comprador, preco_brl, preco_usd, canal, data_venda, len(ids), parcial)
+        _auditar_venda(vendidas, comprador, canal, inicio)
+        if len(vendidas) == len(ids): return vendidas, []
+        livres = {r['id'] for r in vendidas} | {r[0] for r in conn.execute("SELECT id FROM chaves WHERE vendida = 0 AND id IN (SELECT value FROM json_each(?))", (json.dumps(ids),))}
+        conflitos = [i for i in ids if i not in livres]
+        db.ao_confirmar(lambda: auditoria.registrar("conflito", f"{len(conflitos)} chave(s) já vendida(s) por outra instância.", chaves=conflitos, comprador=comprador))
+        return vendidas, conflitos
+
+def reservar_chaves(categoria, quantidade, comprador, preco_brl=0.0, preco_usd=0.0, canal=None, data_venda=None, parcial=False):
+    """Vende as 'quantidade' primeiras chaves disponíveis da categoria (ordem manual). Devolve (vendidas, faltando);
+    sem 'parcial', se não houver o suficiente nada é vendido e 'faltando' diz quantas faltaram."""
+    inicio = time.perf_counter()
+    with db.transacao(imediata=True) as conn:
+        vendidas = _executar_venda(conn, "id IN (SELECT id FROM chaves WHERE categoria = ? AND vendida = 0 ORDER BY ordem_manual, id LIMIT ?)", (categoria, quantidade), comprador, preco_brl, preco_usd, canal, data_venda, quantidade, parcial)
+        _auditar_venda(vendidas, comprador, canal, inicio, categoria=categoria)
+        if vendidas or parcial: return vendidas, quantidade - len(vendidas)
+        return [], quantidade - conn.execute("SELECT COUNT(*) FROM chaves WHERE categoria = ? AND vendida = 0", (categoria,)).fetchone()[0]
+
+# --- Entrega em Lote ---
+COLUNAS_PEDIDO = {"comprador": ("comprador", "buyer", "nome", "name"), "email": ("email", "e-mail"), "categoria": ("categoria", "category", "produto", "product"),
+                  "quantidade": ("quantidade", "quantity", "qtd", "qty"), "preco_brl": ("preco_brl", "preco", "preço", "price", "price_brl"), "preco_usd": ("preco_usd", "price_usd"),
+                  "canal": ("canal", "channel", "canal_venda"), "idioma": ("idioma", "language", "lang")}
+STATUS_LOTE = {"entregue": "Entregue", "sem_estoque": "Sem estoque", "invalido": "Pedido inválido", "erro_pdf": "Entregue (falha no PDF)"}
+
+def ler_pedidos(caminho):
+    """Lê o arquivo de pedidos (CSV com cabeçalho; delimitador detectado). Cabeçalhos em português ou inglês, ver
+    COLUNAS_PEDIDO. Devolve dicts com 'linha' (número no arquivo) e os campos ainda como texto; ver validar_pedido."""
+    with open(caminho, newline="", encoding="utf-8-sig") as f:
+        amostra = f.read(8192); f.seek(0)
+        try: dialeto = csv.Sniffer().sniff(amostra, delimiters=",;\t|")
+        except csv.Error: dialeto = csv.excel
+        leitor = csv.reader(f, dialeto); cabecalho = [c.strip().lower() for c in next(leitor, [])]
+        indices = {campo: next((cabecalho.index(n) for n in nomes if n in cabecalho), None) for campo, nomes in COLUNAS_PEDIDO.items()}
+        if indices["comprador"] is None or indices["categoria"] is None: raise ValueError("O arquivo de pedidos precisa das colunas 'comprador' e 'categoria'.")
+        pedidos = []
+        for n, linha in enumerate(leitor, start=2):
+            if not any(c.strip() for c in linha): continue
+            pedidos.append({"linha": n, **{campo: (linha[i].strip() if i is not None and i < len(linha) else "") for campo, i in indices.items()}})
+    return pedidos
+
+def validar_pedido(pedido, idioma_padrao="pt_br"):
+    """Normaliza os campos do pedido; devolve a mensagem de erro ou None."""
+    def numero(texto): return float(texto.replace("R$", "").replace("$", "").replace(",", ".").strip() or 0)
+    if not pedido["comprador"] or not pedido["categoria"]: return "Comprador e categoria são obrigatórios."
+    try: pedido["quantidade"] = int(pedido["quantidade"] or 1)
+    except ValueError: return f"Quantidade inválida: {pedido['quantidade']!r}."
+    if pedido["quantidade"] <= 0: return "Quantidade deve ser maior que zero."
+    try: pedido["preco_brl"], pedido["preco_usd"] = numero(pedido["preco_brl"]), numero(pedido["preco_usd"])
+    except ValueError: return "Preço inválido."
+    idioma = (pedido.get("idioma") or "").lower().replace("-", "_")
+    pedido["idioma"] = "en_us" if idioma.startswith("en") else "es_es" if idioma.startswith("es") else "pt_br" if idioma.startswith("pt") else idioma_padrao
+    pedido["canal"] = pedido["canal"] or None; return None
+
+def reservar_pedidos(pedidos, desfazer=False):
+    """Reserva as chaves de todos os pedidos numa única transação BEGIN IMMEDIATE: cada pedido leva as primeiras chaves
+    disponíveis da categoria (ordem manual) ou nenhuma, se não houver o suficiente. Preenche pedido['chaves'].
+    Com 'desfazer', a reserva inteira é um passo de desfazer, aberto na mesma transação."""
+    data_venda = f"{datetime.now():%Y-%m-%d %H:%M:%S}"
+    with passo_undo() if desfazer else db.transacao(imediata=True):
+        for pedido in pedidos:
+            vendidas, faltando = reservar_chaves(pedido["categoria"], pedido["quantidade"], pedido["comprador"], pedido["preco_brl"], pedido["preco_usd"], pedido["canal"], data_venda)
+            if faltando: pedido.update(status="sem_estoque", erro=f"{pedido['quantidade'] - faltando} disponível(is) de {pedido['quantidade']}."); continue
+            pedido.update(status="entregue", chaves=vendidas)
+
+@metricas.medido("entrega_lote")
+def entregar_lote(pedidos, idioma="pt_br", gerar_pdf=True, enviar_email=True, anexar_pdf=True, servico_pdf=None, fila_email=None, ao_progresso=None, desfazer=False):
+    """Atende uma lista de pedidos (ver ler_pedidos) sem interface: reserva tudo numa transação, renderiza os PDFs em
+    paralelo no ServicoPDF e enfileira os emails na fila_email. ao_progresso(etapa, feitos, total) é chamado da
+    thread que executa o lote; 'desfazer' faz da reserva um passo de desfazer (ver reservar_pedidos). Devolve os
+    pedidos com status, chaves, pdf, mensagem, email e erro preenchidos."""
+    progresso = ao_progresso or (lambda *a: None); inicio = time.perf_counter()
+    for pedido in pedidos:
+        pedido.update(status=None, chaves=[], pdf="", mensagem="", email_status="", erro="")
+        if erro := validar_pedido(pedido, idioma): pedido.update(status="invalido", erro=erro)
+    progresso("Reservando chaves", 0, len(pedidos))
+    with metricas.span("entrega_lote.db"): reservar_pedidos([p for p in pedidos if p["status"] is None], desfazer)
+    entregues = [p for p in pedidos if p["status"] == "entregue"]
+    categoria_dict = {row["nome"]: dict(row) for row in db.consultar("SELECT * FROM categorias")}
+    for pedido in entregues: pedido["mensagem"] = construir_mensagem_entrega(pedido["chaves"], categoria_dict, pedido["idioma"])
+    if gerar_pdf and PDF_DISPONIVEL and entregues:
+        servico = servico_pdf or ServicoPDF(); inicio_pdf = time.perf_counter()
+        try:
+            futuros = [servico.submeter(trabalho_pdf_entrega(caminho_pdf_entrega(p["comprador"], f"_{p['linha']}"), p["chaves"], categoria_dict, p["idioma"], p["comprador"], p["email"])) for p in entregues]
+            for n, (pedido, futuro) in enumerate(zip(entregues, futuros), start=1):
+                try: caminho, erro = futuro.result()
+                except Exception as e: caminho, erro = None, str(e)
+                if erro: pedido.update(status="erro_pdf", erro=erro)
+                else: pedido["pdf"] = caminho
+                progresso("Gerando PDFs", n, len(entregues))
+        finally:
+            metricas.registrar("entrega_lote.pdf", (time.perf_counter() - inicio_pdf) * 1000)
+            if servico_pdf is None: servico.encerrar()
+    if enviar_email:
+        fila = fila_email or FilaEmail()
+        for pedido in entregues:
+            if not pedido["email"]: pedido["email_status"] = "sem email"; continue
+            fila.enfileirar(pedido["email"], ASSUNTOS_EMAIL[pedido["idioma"]], pedido["mensagem"], pedido["pdf"] if anexar_pdf else None); pedido["email_status"] = "na fila"
+    logar_acao(f"Entrega em lote: {len(entregues)} de {len(pedidos)} pedido(s) atendidos, {sum(len(p['chaves']) for p in entregues)} chave(s).", "entrega_lote",
+               pedidos=len(pedidos), atendidos=len(entregues), duracao_ms=round((time.perf_counter() - inicio) * 1000, 2))
+    return pedidos
+
+def salvar_relatorio_lote(pedidos, caminho):
+    """Relatório CSV do lote: uma linha por pedido, com as chaves entregues, o PDF e a situação do email."""
+    with open(caminho, "w", newline="", encoding="utf-8-sig") as f:
+        escritor = csv.writer(f, delimiter=";")
+        escritor.writerow(["Linha", "Comprador", "Email", "Categoria", "Quantidade", "Canal", "Status", "Chaves", "PDF", "Email (envio)", "Erro"])
+        for p in pedidos: escritor.writerow([p["linha"], p["comprador"], p["email"], p["categoria"], p["quantidade"], p["canal"] or "", STATUS_LOTE.get(p["status"], p["status"]), " ".join(c["chave"] for c in p["chaves"]), p["pdf"], p["email_status"], p["erro"]])
+    return caminho
+
+# --- Auditoria ---
+# Cada ação vira um evento JSON (uma linha em auditoria.jsonl, com rotação por tamanho) e uma linha num índice SQLite
+# à parte (auditoria.db), para perguntas como "todas as entregas para X" ou "quem vendeu a chave Y" não varrerem os
+# arquivos. registrar() só enfileira: arquivo e índice são gravados em lotes por uma thread própria.
+AUDITORIA_ARQUIVO = "auditoria.jsonl"
+AUDITORIA_INDICE = "auditoria.db"
+AUDITORIA_MAX_BYTES = 10 * 2**20  # tamanho de cada arquivo antes de rotacionar
+AUDITORIA_ARQUIVOS = 10  # arquivos rotacionados mantidos (auditoria.jsonl.1 ... .10); o índice guarda tudo
+AUDITORIA_LOTE = 1000  # eventos por gravação, no máximo
+
+class Auditoria:
+    """Eventos de auditoria: {ts, operacao, origem, mensagem?, ids?, chaves?, comprador?, canal?, categoria?, duracao_ms?, ...}.
+    'origem' diz quem gravou (app, cli, api). Os eventos chegam ao arquivo/índice logo depois de registrar(), na
+    thread de gravação; descarregar() espera isso acontecer (consultar() já chama) e o que estiver na fila é gravado
+    no fim do processo."""
+    def __init__(self, arquivo=AUDITORIA_ARQUIVO, indice=AUDITORIA_INDICE, max_bytes=AUDITORIA_MAX_BYTES, arquivos=AUDITORIA_ARQUIVOS):
+        self.arquivo, self.max_bytes, self.arquivos, self.origem = arquivo, max_bytes, arquivos, "app"
+        self.indice = BancoDados(indice); self._fila = queue.SimpleQueue(); self._thread = None; self._lock = threading.Lock()
+
+    def registrar(self, operacao, mensagem=None, chaves=(), **campos):
+        """Enfileira um evento. 'chaves' aceita ids ou linhas/dicts com id e chave; campos None são omitidos."""
+        evento = {"ts": datetime.now().isoformat(sep=" ", timespec="milliseconds"), "operacao": operacao, "origem": self.origem}
+        if mensagem: evento["mensagem"] = mensagem
+        if chaves:
+            evento["ids"] = [c if isinstance(c, int) else c["id"] for c in chaves]
+            if textos := [c["chave"] for c in chaves if not isinstance(c, int)]: evento["chaves"] = textos
+        evento.update((campo, valor) for campo, valor in campos.items() if valor is not None)
+        self._iniciar(); self._fila.put(evento)
+
+    def descarregar(self, timeout=10):
+        """Espera os eventos já registrados chegarem ao arquivo e ao índice."""
+        if self._thread is None: return True
+        gravado = threading.Event(); self._fila.put(gravado); return gravado.wait(timeout)
+
+    def encerrar(self):
+        with self._lock: thread, self._thread = self._thread, None
+        if thread: self._fila.put(None); thread.join(30)
+
+    def consultar(self, comprador=None, chave=None, operacao=None, categoria=None, desde=None, ate=None, limite=100):
+        """Eventos mais recentes primeiro. 'chave' é o id (int) ou o texto da chave; 'comprador' ignora maiúsculas;
+        desde/ate comparam com o início de 'ts' (AAAA-MM-DD ou AAAA-MM-DD HH:MM:SS)."""
+        self.descarregar(); self._criar_indice(); where, params = [], []
+        if comprador: where.append("comprador = ? COLLATE NOCASE"); params.append(comprador)
+        if operacao: where.append("operacao = ?"); params.append(operacao)
+        if categoria: where.append("categoria = ?"); params.append(categoria)
+        if desde: where.append("ts >= ?"); params.append(desde)
+        if ate: where.append("ts < ?"); params.append(ate + "\uffff")
+        if chave is not None:
+            where.append(f"id IN (SELECT evento FROM eventos_chaves WHERE {'chave_id' if isinstance(chave, int) else 'chave'} = ?)"); params.append(chave)
+        sql = f"SELECT registro FROM eventos{' WHERE ' + ' AND '.join(where) if where else ''} ORDER BY id DESC LIMIT ?"
+        return [json.loads(r[0]) for r in self.indice.consultar(sql, (*params, limite))]
+
+    # --- Thread de gravação ---
+    def _iniciar(self):
+        if self._thread is not None: return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._executar, name="auditoria", daemon=True); self._thread.start(); atexit.register(self.encerrar)
+
+    def _criar_indice(self):
+        with self.indice.transacao() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS eventos (id INTEGER PRIMARY KEY, ts TEXT NOT NULL, operacao TEXT NOT NULL, origem TEXT, comprador TEXT, canal TEXT, categoria TEXT, registro TEXT NOT NULL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS eventos_chaves (chave_id INTEGER NOT NULL, evento INTEGER NOT NULL, chave TEXT, PRIMARY KEY (chave_id, evento)) WITHOUT ROWID")
+            for nome, colunas in (("comprador", "comprador COLLATE NOCASE, id"), ("operacao", "operacao, id"), ("categoria", "categoria, id"), ("ts", "ts")):
+                conn.execute(f"CREATE INDEX IF NOT EXISTS idx_eventos_{nome} ON eventos ({colunas})")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_eventos_chaves_chave ON eventos_chaves (chave) WHERE chave IS NOT NULL")
+
+    def _executar(self):
+        arquivo = None
+        try:
+            self._criar_indice()
+            while True:
+                item, lote, avisos, fim = self._fila.get(), [], [], False
+                while True:  # Junta o que já estiver na fila num lote só.
+                    if item is None: fim = True
+                    elif isinstance(item, threading.Event): avisos.append(item)
+                    else: lote.append(item)
+                    if len(lote) >= AUDITORIA_LOTE: break
+                    try: item = self._fila.get_nowait()
+                    except queue.Empty: break
+                if lote:
+                    try: arquivo = self._gravar(lote, arquivo)
+                    except (OSError, sqlite3.Error) as e: print(f"Auditoria: falha ao gravar {len(lote)} evento(s): {e}", file=sys.stderr)
+                for aviso in avisos: aviso.set()
+                if fim: break
+        finally:
+            if arquivo: arquivo.close()
+            self.indice.fechar_da_thread()
+
+    def _gravar(self, lote, arquivo):
+        linhas = [json.dumps(e, ensure_ascii=False, separators=(",", ":")) for e in lote]
+        dados = ("\n".join(linhas) + "\n").encode("utf-8")
+        arquivo = self._arquivo_atual(arquivo, len(dados)); arquivo.write(dados)  # Sem buffer: o lote vai num único write (O_APPEND).
+        with self.indice.transacao() as conn:
+            for evento, linha in zip(lote, linhas):
+                id_evento = conn.execute("INSERT INTO eventos (ts, operacao, origem, comprador, canal, categoria, registro) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                         (evento["ts"], evento["operacao"], evento["origem"], evento.get("comprador"), evento.get("canal"), evento.get("categoria"), linha)).lastrowid
+                if ids := evento.get("ids"):
+                    textos = evento.get("chaves") or ()
+                    conn.executemany("INSERT OR IGNORE INTO eventos_chaves (chave_id, evento, chave) VALUES (?, ?, ?)", ((i, id_evento, textos[n] if n < len(textos) else None) for n, i in enumerate(ids)))
+        return arquivo
+
+    def _arquivo_atual(self, arquivo, a_gravar):
+        """Arquivo aberto para o próximo lote, rotacionando antes de passar de max_bytes. Reabre se outro processo já rotacionou."""
+        try: atual = os.stat(self.arquivo)
+        except FileNotFoundError: atual = None
+        if arquivo and (atual is None or os.fstat(arquivo.fileno()).st_ino != atual.st_ino): arquivo.close(); arquivo = None
+        if atual and atual.st_size and atual.st_size + a_gravar > self.max_bytes:
+            if arquivo: arquivo.close(); arquivo = None
+            for n in range(self.arquivos - 1, 0, -1):
+                if os.path.exists(f"{self.arquivo}.{n}"): os.replace(f"{self.arquivo}.{n}", f"{self.arquivo}.{n + 1}")
+            os.replace(self.arquivo, f"{self.arquivo}.1")
+        return arquivo or open(self.arquivo, "ab", buffering=0)
+
+auditoria = Auditoria()
+
+def logar_acao(acao, operacao="acao", **campos):
+    """Atalho para auditoria.registrar com a mensagem legível (não espera a gravação)."""
+    auditoria.registrar(operacao, acao, **campos)
+
+# --- Exportação ---
+EXPORTACAO_LOTE = 5000  # Linhas por fetchmany: a memória usada não depende do tamanho do estoque.
+COLUNAS_EXPORTACAO = (("chave", "Chave"), ("categoria", "Categoria"), ("vendida", "Status"), ("comprador", "Comprador"), ("canal_venda", "Canal de Venda"),
+                      ("data_venda", "Data"), ("preco_venda_brl", "PrecoBRL"), ("preco_venda_usd", "PrecoUSD"))
+XLSX_MAX_LINHAS = 1_048_576  # Limite de linhas de uma planilha do Excel (com o cabeçalho).
+
+def formato_exportacao(caminho):
+    """(formato, gzip) pela extensão: .csv, .xlsx, .jsonl, com .gz opcional no fim (menos no .xlsx, que já é compactado)."""
+    base, ext = os.path.splitext(caminho.lower()); compactar = ext == ".gz"
+    if compactar: ext = os.path.splitext(base)[1]
+    formato = {".csv": "csv", ".xlsx": "xlsx", ".jsonl": "jsonl", ".json": "jsonl"}.get(ext)
+    if formato is None or (compactar and formato == "xlsx"): raise ValueError(f"Formato de exportação não suportado: {os.path.basename(caminho)} (use .csv, .xlsx ou .jsonl, com .gz opcional exceto no .xlsx).")
+    return formato, compactar
+
+def exportar_chaves(caminho, filtros=None, formato=None, compactar=None, cancelar=None, ao_progresso=None):
+    """Exporta as chaves que passam em 'filtros' (argumentos de montar_consulta_chaves: busca, categoria, canal, status,
+    ordenar_por, decrescente) lendo o cursor em lotes, sem carregar o estoque na memória. Formato e gzip vêm da extensão
+    se não forem dados (no XLSX o openpyxl ainda guarda na memória a tabela de textos da planilha). Grava num arquivo temporário renomeado no fim, então um erro ou 'cancelar' (threading.Event)
+    não deixa arquivo pela metade. ao_progresso(feitos, total) é chamado a cada lote, da thread que exporta.
+    Devolve o número de linhas exportadas, ou None se cancelado."""
+    if formato is None: formato, compactar_ext = formato_exportacao(caminho); compactar = compactar_ext if compactar is None else compactar
+    if formato == "xlsx" and compactar: raise ValueError("O XLSX já é compactado; use gzip só com CSV ou JSON Lines.")
+    if formato == "xlsx" and not OPENPYXL_DISPONIVEL: raise ImportError("A exportação para XLSX precisa do openpyxl (pip install openpyxl).")
+    filtros = {"usar_fts": db.consultar_valor("SELECT 1 FROM sqlite_master WHERE name = 'chaves_busca'") is not None, **(filtros or {})}
+    campos = [c for c, _ in COLUNAS_EXPORTACAO]; cabecalho = [r for _, r in COLUNAS_EXPORTACAO]; status = campos.index("vendida")
+    sql, params = montar_consulta_chaves(colunas=", ".join(campos), **filtros)
+    total = db.consultar_valor(*montar_consulta_chaves(colunas="COUNT(*)", **filtros)); feitos = 0
+    if formato == "xlsx" and total >= XLSX_MAX_LINHAS: raise ValueError(f"O Excel aceita até {XLSX_MAX_LINHAS - 1:,} linhas por planilha e a exportação tem {total:,}; use CSV ou JSON Lines.")
+    temporario, arquivo = f"{caminho}.parcial", None
+    try:
+        if formato == "xlsx":
+            from openpyxl import Workbook
+            livro = Workbook(write_only=True); planilha = livro.create_sheet("Estoque"); escrever = planilha.append; escrever(cabecalho)
+        else:
+            arquivo = gzip.open(temporario, "wt", encoding="utf-8", newline="") if compactar else open(temporario, "w", encoding="utf-8", newline="")
+            if formato == "csv": escritor = csv.writer(arquivo); escrever = escritor.writerow; escrever(cabecalho)
+            else: codificar = json.JSONEncoder(ensure_ascii=False).encode; escrever = lambda linha: arquivo.write(codificar(dict(zip(campos, linha))) + "\n")  # Um encoder só: json.dumps com opções cria um por linha.
+        cursor = db.executar(sql, params)
+        while lote := cursor.fetchmany(EXPORTACAO_LOTE):
+            if cancelar is not None and cancelar.is_set(): cursor.close(); break
+            for row in lote:
+                linha = list(row)
+                if formato == "jsonl": linha[status] = bool(linha[status])
+                else: linha[status] = "Vendida" if linha[status] == 1 else "Disponível"
+                escrever(linha)
+            feitos += len(lote)
+            if ao_progresso: ao_progresso(feitos, total)
+        cancelado = cancelar is not None and cancelar.is_set()
+        if arquivo is not None: arquivo.close()
+        elif not cancelado: livro.save(temporario)
+        if cancelado:
+            if os.path.exists(temporario): os.remove(temporario)
+            return None
+        os.replace(temporario, caminho); return feitos
+    except BaseException:
+        if arquivo is not None: arquivo.close()
+        if os.path.exists(temporario): os.remove(temporario)
+        raise
+
+# --- Cotação do Dólar ---
+COTACAO_TTL = 15 * 60  # segundos que a taxa atual vale sem nova consulta
+COTACAO_HISTORICO_LOTE = 300  # dias por requisição de histórico
+
+class FonteAwesomeAPI:
+    """Cotações USD-BRL da awesomeapi (usa requests; erros de rede/formato sobem como exceções)."""
+    URL = "https://economia.awesomeapi.com.br"
+    def __init__(self, timeout=5): self.timeout = timeout
+
+    def atual(self):
+        import requests
+        response = requests.get(f"{self.URL}/last/USD-BRL", timeout=self.timeout); response.raise_for_status()
+        return float(response.json()['USDBRL']['bid'])
+
+    def historico(self, dia_ini, dia_fim):
+        """{'AAAA-MM-DD': R$ por US$} dos dias com cotação entre dia_ini e dia_fim (date); fica o fechamento do dia."""
+        import requests
+        response = requests.get(f"{self.URL}/json/daily/USD-BRL/{(dia_fim - dia_ini).days + 1}", params={"start_date": f"{dia_ini:%Y%m%d}", "end_date": f"{dia_fim:%Y%m%d}"}, timeout=self.timeout)
+        response.raise_for_status(); taxas = {}
+        for item in response.json(): taxas.setdefault(f"{datetime.fromtimestamp(int(item['timestamp'])):%Y-%m-%d}", float(item['bid']))  # Mais recentes primeiro.
+        return taxas
+
+class FonteFixa:
+    """Fonte local, sem rede (testes, uso offline): 'taxa' hoje e, sem 'historico' ({'AAAA-MM-DD': taxa}), em qualquer dia."""
+    def __init__(self, taxa, historico=None): self.taxa, self._historico = taxa, historico
+    def atual(self): return self.taxa
+    def historico(self, dia_ini, dia_fim):
+        if self._historico is not None: return {dia: taxa for dia, taxa in self._historico.items() if f"{dia_ini}" <= dia <= f"{dia_fim}"}
+        return {f"{dia_ini + timedelta(days=i)}": self.taxa for i in range((dia_fim - dia_ini).days + 1)}
+
+class ServicoCotacao:
+    """Cotação USD-BRL sem esperar a rede: a taxa atual fica em memória por 'ttl' segundos e cada dia obtido é gravado
+    na tabela cotacoes (os relatórios convertem cada venda pela taxa do seu dia). atual() responde na hora com o que
+    houver; atualizar() consulta a fonte (qualquer objeto com atual() e historico(dia_ini, dia_fim)) numa thread
+    própria e devolve um Future com a taxa atual."""
+    def __init__(self, fonte=None, ttl=COTACAO_TTL):
+        self.fonte, self.ttl = fonte or FonteAwesomeAPI(), ttl
+        self._taxa, self._consultada_em, self._buscados = None, None, set()
+        self._executor = ThreadPoolExecutor(1, thread_name_prefix="cotacao")
+
+    def atual(self):
+        """Última taxa conhecida (memória ou último dia gravado), ou None se nunca houve cotação. Não vai à rede."""
+        if self._taxa is None: self._taxa = db.consultar_valor("SELECT brl_por_usd FROM cotacoes ORDER BY dia DESC LIMIT 1")
+        return self._taxa
+
+    def expirada(self): return self._consultada_em is None or time.monotonic() - self._consultada_em > self.ttl
+
+    def dias_pendentes(self, data_ini, data_fim):
+        """(primeiro, último) dia útil sem cotação gravada no período (até hoje), ou None. Cada dia só é pedido à fonte
+        uma vez por execução, para feriados sem cotação não gerarem consultas repetidas."""
+        ini, fim = date.fromisoformat(data_ini), min(date.fromisoformat(data_fim), date.today())
+        if ini > fim: return None
+        gravados = {r[0] for r in db.consultar("SELECT dia FROM cotacoes WHERE dia BETWEEN ? AND ?", (f"{ini}", f"{fim}"))}
+        faltando = [d for d in (ini + timedelta(days=i) for i in range((fim - ini).days + 1)) if d.weekday() < 5 and f"{d}" not in gravados and d not in self._buscados]
+        return (faltando[0], faltando[-1]) if faltando else None
+
+    def atualizar(self, data_ini=None, data_fim=None, forcar=False):
+        """Busca a taxa atual (se expirou ou 'forcar') e os dias pendentes do período. Sem nada a buscar, devolve um
+        Future já resolvido; o Future falha com o erro da fonte (a taxa anterior continua valendo)."""
+        pendentes = self.dias_pendentes(data_ini, data_fim) if data_ini and data_fim else None
+        if not ((buscar_atual := forcar or self.expirada()) or pendentes): futuro = Future(); futuro.set_result(self.atual()); return futuro
+        # Marcado antes de buscar: chamadas seguidas não repetem a consulta e, sem rede, só se tenta de novo depois do TTL.
+        if buscar_atual: self._consultada_em = time.monotonic()
+        if pendentes: self._buscados.update(pendentes[0] + timedelta(days=i) for i in range((pendentes[1] - pendentes[0]).days + 1))
+        return self._executor.submit(self._buscar, pendentes, buscar_atual)
+
+    def _buscar(self, pendentes, buscar_atual):
+        agora = f"{datetime.now():%Y-%m-%d %H:%M:%S}"; fonte = type(self.fonte).__name__
+        if buscar_atual:
+            taxa = self.fonte.atual()
+            db.executar("INSERT INTO cotacoes (dia, brl_por_usd, fonte, atualizado_em) VALUES (?, ?, ?, ?) ON CONFLICT (dia) DO UPDATE SET brl_por_usd = excluded.brl_por_usd, fonte = excluded.fonte, atualizado_em = excluded.atualizado_em",
+                        (f"{date.today()}", taxa, fonte, agora))
+            self._taxa = taxa
+        if pendentes:
+            ini, fim = pendentes
+            while ini <= fim:
+                parte_fim = min(fim, ini + timedelta(days=COTACAO_HISTORICO_LOTE - 1))
+                taxas = self.fonte.historico(ini, parte_fim)
+                with db.transacao(): db.executar_muitos("INSERT OR IGNORE INTO cotacoes (dia, brl_por_usd, fonte, atualizado_em) VALUES (?, ?, ?, ?)", [(dia, taxa, fonte, agora) for dia, taxa in taxas.items()])
+                ini = parte_fim + timedelta(days=1)
+        return self.atual()
+
+    def encerrar(self): self._executor.shutdown(wait=False, cancel_futures=True)
+
+# --- Backup ---
+# Cópias online pela API de backup do SQLite: a leitura fica presa a um snapshot (transação de leitura aberta na conexão
+# de origem), então os passos de BACKUP_PAGINAS páginas nunca recomeçam por causa de escritas do app e, com WAL, o
+# app continua lendo e gravando durante a cópia. Cada cópia é conferida com integrity_check antes de entrar na rotação.
+BACKUP_PAGINAS = 1024  # páginas por passo (4 MiB com páginas de 4 KiB)
+BACKUP_PAUSA = 0.005  # segundos entre passos, para a cópia não disputar o disco com o app
+BACKUP_INTERVALO = 3600  # segundos entre backups agendados
+BACKUP_RETENCAO = {"horario": 24, "diario": 7, "semanal": 8}  # quantas cópias manter em cada faixa
+_BACKUP_NOME = re.compile(r"^backup_db_(\d{8}_\d{6})\.db(\.gz)?$")
+
+def _conferir_banco(caminho):
+    """Resultado de PRAGMA integrity_check ('ok' se íntegro) ou o motivo de não ser um banco válido."""
+    with open(caminho, "rb") as f:
+        if f.read(16) != b"SQLite format 3\x00": return "não é um banco SQLite"  # Inclui arquivo vazio, que o SQLite abriria como banco novo.
+    try:
+        conn = sqlite3.connect(f"file:{caminho}?mode=ro", uri=True)
+        try: return "; ".join(r[0] for r in conn.execute("PRAGMA integrity_check").fetchall())
+        finally: conn.close()
+    except sqlite3.DatabaseError as e: return str(e)
+
+def verificar_backup(caminho):
+    """integrity_check de um arquivo de backup (.db ou .db.gz, descompactado num temporário ao lado)."""
+    if not caminho.endswith(".gz"): return _conferir_banco(caminho)
+    temporario = caminho[:-3] + ".verificando"
+    try:
+        with gzip.open(caminho, "rb") as origem, open(temporario, "wb") as destino: shutil.copyfileobj(origem, destino, 1 << 20)
+        return _conferir_banco(temporario)
+    finally:
+        if os.path.exists(temporario): os.remove(temporario)
+
+def fazer_backup(pasta=BACKUP_DIR, compactar=True, paginas=BACKUP_PAGINAS, pausa=BACKUP_PAUSA, cancelar=None, ao_progresso=None):
+    """Copia o banco para pasta/backup_db_<data>.db[.gz] e confere a cópia. Devolve {caminho, bytes, segundos, integridade};
+    ao_progresso(copiadas, total) é chamado a cada passo e cancelar() (se der True) interrompe com InterruptedError.
+    Falta de espaço, cancelamento ou cópia corrompida sobem como exceção e não deixam arquivo para trás."""
+    os.makedirs(pasta, exist_ok=True); inicio = time.monotonic()
+    origem = sqlite3.connect(db.caminho, timeout=30, isolation_level=None)
+    try:
+        tamanho = origem.execute("PRAGMA page_count").fetchone()[0] * origem.execute("PRAGMA page_size").fetchone()[0]
+        if shutil.disk_usage(pasta).free < tamanho * (1.5 if compactar else 1.1):  # A cópia crua existe até ser compactada.
+            raise OSError(f"Espaço insuficiente em '{pasta}' para um backup de {tamanho / 2**20:.0f} MiB.")
+        base = os.path.join(pasta, f"backup_db_{datetime.now():%Y%m%d_%H%M%S}.db"); parcial = base + ".parcial"
+        def passo(_status, restantes, total):
+            if cancelar and cancelar(): raise InterruptedError("Backup cancelado.")
+            if ao_progresso: ao_progresso(total - restantes, total)
+            if pausa: time.sleep(pausa)
+        try:
+            destino = sqlite3.connect(parcial)
+            try:
+                origem.execute("BEGIN"); origem.execute("SELECT 1 FROM sqlite_master LIMIT 1").fetchall()  # Fixa o snapshot.
+                try: origem.backup(destino, pages=paginas, progress=passo)
+                finally: origem.execute("COMMIT")
+                destino.execute("PRAGMA journal_mode=DELETE")  # Arquivo único, sem -wal, para poder ser copiado/restaurado direto.
+            finally: destino.close()
+            if (integridade := _conferir_banco(parcial)) != "ok": raise sqlite3.DatabaseError(f"Backup corrompido: {integridade}")
+            if compactar:
+                with open(parcial, "rb") as crua, gzip.open(base + ".gz.parcial", "wb", compresslevel=6) as gz: shutil.copyfileobj(crua, gz, 1 << 20)
+                os.remove(parcial); parcial, base = base + ".gz.parcial", base + ".gz"
+            os.replace(parcial, base)
+        except BaseException:
+            for resto in (parcial, base + ".gz.parcial"):
+                if os.path.exists(resto): os.remove(resto)
+            raise
+    finally: origem.close()
+    return {"caminho": base, "bytes": os.path.getsize(base), "segundos": time.monotonic() - inicio, "integridade": integridade}
+
+def listar_backups(pasta=BACKUP_DIR):
+    """[(data, caminho)] dos arquivos backup_db_*.db[.gz] da pasta, do mais novo ao mais velho."""
+    if not os.path.isdir(pasta): return []
+    return sorted(((datetime.strptime(m.group(1), "%Y%m%d_%H%M%S"), os.path.join(pasta, nome)) for nome in os.listdir(pasta) if (m := _BACKUP_NOME.match(nome))), reverse=True)
+
+def podar_backups(pasta=BACKUP_DIR, retencao=BACKUP_RETENCAO, agora=None):
+    """Rotação: mantém o backup mais recente de cada uma das últimas N horas/dias/semanas (ver BACKUP_RETENCAO) e
+    apaga o resto. Só toca nos arquivos de listar_backups; devolve os caminhos apagados."""
+    if not (backups := listar_backups(pasta)): return []
+    agora = agora or datetime.now(); manter = {backups[0][1]}
+    faixas = {"horario": (timedelta(hours=1), lambda d: (d.date(), d.hour)), "diario": (timedelta(days=1), lambda d: d.date()), "semanal": (timedelta(weeks=1), lambda d: d.isocalendar()[:2])}
+    for faixa, quantidade in retencao.items():
+        duracao, periodo = faixas[faixa]; vistos = set()
+        for quando, caminho in backups:  # Do mais novo ao mais velho: o primeiro de cada período é o que fica.
+            if agora - quando >= duracao * quantidade: break
+            if (chave := periodo(quando)) not in vistos: vistos.add(chave); manter.add(caminho)
+    apagados = []
+    for _, caminho in backups:
+        if caminho not in manter:
+            try: os.remove(caminho); apagados.append(caminho)
+            except OSError: pass
+    return apagados
+
+class AgendadorBackup:
+    """Thread que faz um backup (fazer_backup + podar_backups) a cada 'intervalo' segundos, pulando os intervalos em
+    que nada mudou no banco (PRAGMA data_version da conexão da própria thread). Como a FilaEmail, não toca no Tk: cada
+    resultado vira um evento ('backup', info) ou ('falhou', mensagem) em 'eventos'. agora() pede um backup imediato."""
+    def __init__(self, intervalo=BACKUP_INTERVALO, pasta=BACKUP_DIR, compactar=True, retencao=BACKUP_RETENCAO):
+        self.intervalo, self.pasta, self.compactar, self.retencao = intervalo, pasta, compactar, retencao
+        self.eventos, self.ultimo = queue.Queue(), None
+        self._acordar, self._parar, self._forcar, self._thread = threading.Event(), threading.Event(), False, None
+
+    def iniciar(self):
+        self._parar.clear(); self._thread = threading.Thread(target=self._executar, name="backup", daemon=True); self._thread.start()
+
+    def parar(self, timeout=30):
+        self._parar.set(); self._acordar.set()
+        if self._thread: self._thread.join(timeout)
+
+    def agora(self): self._forcar = True; self._acordar.set()
+
+    def _executar(self):
+        versao = None  # A primeira rodada sempre copia; ela só espera o intervalo contado a partir do último backup existente.
+        if backups := listar_backups(self.pasta): self._acordar.wait(max(0, self.intervalo - (datetime.now() - backups[0][0]).total_seconds())); self._acordar.clear()
+        try:
+            while not self._parar.is_set():
+                atual = db.consultar_valor("PRAGMA data_version")
+                if self._forcar or atual != versao:
+                    self._forcar = False
+                    try:
+                        info = fazer_backup(self.pasta, self.compactar, cancelar=self._parar.is_set); info["apagados"] = podar_backups(self.pasta, self.retencao)
+                        self.ultimo, versao = info, atual; self.eventos.put(('backup', info))
+                        logar_acao(f"Backup criado: {info['caminho']} ({info['bytes'] / 2**20:.1f} MiB em {info['segundos']:.1f} s, {len(info['apagados'])} antigo(s) removido(s)).", "backup", duracao_ms=round(info['segundos'] * 1000))
+                    except InterruptedError: break  # parar() no meio da cópia.
+                    except (OSError, sqlite3.Error) as e: self.eventos.put(('falhou', str(e))); logar_acao(f"FALHA no backup: {e}", "backup", erro=str(e))
+                self._acordar.wait(self.intervalo); self._acordar.clear()
+        finally: db.fechar_da_thread()
+
+# --- Serviços ---
+# Operações completas que a interface, a linha de comando (cli.py) e automações usam: nenhuma delas mostra nada na
+# tela; erros viram exceções e resultados voltam como dados.
+def preparar_banco():
+    """Cria/migra o banco e instala journal de desfazer e índice de busca. Devolve se o FTS5 está disponível."""
+    init_db(); verificar_e_migrar_schema(); instalar_journal_undo(); return instalar_indice_busca()
+
+def garantir_categoria(nome):
+    if nome and nome != "S/C": db.executar("INSERT OR IGNORE INTO categorias (nome, custo_padrao_brl, custo_padrao_usd) VALUES (?, 0.0, 0.0)", (nome,))
+
+def estoque_por_categoria():
+    """[(categoria, disponíveis, vendidas)] de todas as categorias, inclusive as sem chaves."""
+    return [tuple(r) for r in db.consultar("""SELECT nome, COALESCE(SUM(vendida = 0), 0), COALESCE(SUM(vendida = 1), 0) FROM
+        (SELECT nome, NULL AS vendida FROM categorias UNION ALL SELECT COALESCE(categoria, 'S/C'), vendida FROM chaves) GROUP BY nome ORDER BY nome""")]
+
+def importar_arquivo(caminho, categoria, colunas=("A",), linha_inicio=1, planilhas=None, canal=None, cancelar=None, ao_lote=None, desfazer=False):
+    """Lê o arquivo com LeitorChaves e grava com ingerir_chaves; mesmo retorno de ingerir_chaves. Com 'desfazer', a
+    categoria criada aqui entra no mesmo passo de desfazer da ingestão."""
+    with passo_undo() if desfazer else nullcontext() as passo: garantir_categoria(categoria)
+    return ingerir_chaves(LeitorChaves(caminho, colunas, linha_inicio, planilhas), categoria, canal, cancelar=cancelar, ao_lote=ao_lote, desfazer=passo or False)
+
+def excluir_chaves(ids):
+    """Exclui as chaves 'ids'. Devolve os ids que de fato existiam e foram excluídos."""
+    ids = list(ids); excluidas = []
+    with db.transacao() as conn:
+        for i in range(0, len(ids), 500): excluidas += conn.execute(f"DELETE FROM chaves WHERE id IN ({','.join('?' * len(ids[i:i + 500]))}) RETURNING id, chave", ids[i:i + 500]).fetchall()
+        if excluidas: db.ao_confirmar(lambda: auditoria.registrar("exclusao", f"{len(excluidas)} chave(s) excluída(s).", chaves=excluidas))
+    return [r[0] for r in excluidas]
+
+def relatorio_vendas(data_ini, data_fim, cotacao, historica=True):
+    """Vendas entre data_ini e data_fim (AAAA-MM-DD, inclusivas), com receita e custo convertidos para R$. Com 'historica',
+    os valores em US$ de cada dia usam a cotação gravada daquele dia (ou do último dia anterior com cotação) e 'cotacao'
+    só vale para dias sem nenhuma; sem 'historica', 'cotacao' vale para tudo. Somado em SQL sobre vendas_diarias; o
+    custo é o custo padrão atual da categoria × quantidade.
+    Devolve {vendas, receita, custo, lucro, por_categoria, por_canal, por_dia}, os três últimos {nome: {qtd, rec, custo}}."""
+    dia_ini = datetime.strptime(data_ini, "%Y-%m-%d").strftime("%Y-%m-%d"); dia_fim = datetime.strptime(data_fim, "%Y-%m-%d").strftime("%Y-%m-%d")
+    # A taxa é resolvida uma vez por dia do período (não por linha do resumo).
+    taxa = "COALESCE((SELECT c.brl_por_usd FROM cotacoes AS c WHERE c.dia <= d.dia ORDER BY c.dia DESC LIMIT 1), :cotacao)" if historica else ":cotacao"
+    def agrupar(coluna):
+        linhas = db.consultar(f"""WITH taxas AS MATERIALIZED (SELECT d.dia, {taxa} AS taxa FROM (SELECT DISTINCT dia FROM vendas_diarias WHERE dia BETWEEN :ini AND :fim) AS d)
+            SELECT {coluna}, SUM(qtd), SUM(receita_brl + receita_usd * taxa), SUM(qtd * (custo_brl + custo_usd * taxa)) FROM
+            (SELECT v.*, COALESCE(cat.custo_padrao_brl, 0) AS custo_brl, COALESCE(cat.custo_padrao_usd, 0) AS custo_usd, t.taxa
+             FROM vendas_diarias AS v JOIN taxas AS t ON t.dia = v.dia LEFT JOIN categorias AS cat ON cat.nome = v.categoria WHERE v.dia BETWEEN :ini AND :fim) GROUP BY 1""", {"ini": dia_ini, "fim": dia_fim, "cotacao": cotacao})
+        return {nome: {"qtd": qtd, "rec": rec, "custo": custo} for nome, qtd, rec, custo in linhas}
+    por_categoria = agrupar("CASE WHEN categoria = '' THEN 'Sem Categoria' ELSE categoria END")
+    tot_rec, tot_custo = sum(d["rec"] for d in por_categoria.values()), sum(d["custo"] for d in por_categoria.values())
+    return {"vendas": sum(d["qtd"] for d in por_categoria.values()), "receita": tot_rec, "custo": tot_custo, "lucro": tot_rec - tot_custo, "por_categoria": por_categoria,
+            "por_canal": agrupar("CASE WHEN canal = '' THEN 'Sem Canal' ELSE canal END"), "por_dia": agrupar("dia")}
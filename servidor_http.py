@@ -0,0 +1,220 @@
+# Gerenciador de Chaves - API HTTP local
+# coding: utf-8
+# Uso: python cli.py servidor [--porta 8765] [--trabalhadores 4]
+# Serviço opcional para automações do marketplace (webhooks) sobre o mesmo gerenciador.db do aplicativo. Só aceita
+# conexões da própria máquina: o webhook público deve chegar por um proxy/agente local que chame esta API.
+#
+#   GET  /saude                 -> {"status": "ok", "versao"}
+#   GET  /estoque               -> {"categorias": [{categoria, disponiveis, vendidas}]}
+#   GET  /estoque/<categoria>   -> {categoria, disponiveis, vendidas}
+#   POST /reservas              {categoria, comprador, quantidade?, preco_brl?, preco_usd?, canal?, parcial?}
+#                               -> 201 {chaves: [{id, chave, categoria}], faltando}  |  409 sem estoque
+#   POST /entregas              reserva + mensagem + PDF + email: campos de /reservas e {email?, idioma?, pdf?, anexar_pdf?}
+#                               -> 201 {chaves, mensagem, pdf, email_id, erro_pdf}
+#   POST /mensagem              {ids, idioma?} -> {mensagem}     (texto da entrega de chaves já vendidas)
+#   POST /pdf                   {ids, idioma?, comprador?, email?} -> application/pdf
+#
+# Todas as respostas de erro são {"erro": "..."}. Reservas/entregas não entram no Desfazer do aplicativo: a chave já
+# foi entregue ao comprador e não pode voltar ao estoque.
+import asyncio
+import ipaddress
+import json
+import re
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote, urlsplit
+
+from nucleo import (APP_VERSION, ASSUNTOS_EMAIL, PDF_DISPONIVEL, FilaEmail, ServicoPDF, caminho_pdf_entrega, construir_mensagem_entrega,
+                    db, estoque_por_categoria, logar_acao, reservar_chaves, trabalho_pdf_entrega,
+                    validar_pedido)
+
+PORTA_PADRAO = 8765
+CORPO_MAX = 1 << 20  # bytes
+OCIOSO_MAX = 15  # segundos de keep-alive sem nova requisição
+MOTIVOS = {200: "OK", 201: "Created", 400: "Bad Request", 403: "Forbidden", 404: "Not Found", 405: "Method Not Allowed", 409: "Conflict",
+           413: "Payload Too Large", 500: "Internal Server Error", 503: "Service Unavailable"}
+
+class ErroHTTP(Exception):
+    def __init__(self, status, mensagem): super().__init__(mensagem); self.status = status
+
+def _corpo_pedido(corpo):
+    """Corpo JSON de /reservas e /entregas no formato de ler_pedidos (campos como texto), validado por validar_pedido."""
+    if not isinstance(corpo, dict): raise ErroHTTP(400, "O corpo deve ser um objeto JSON.")
+    pedido = {"linha": 0, **{campo: "" if corpo.get(campo) is None else str(corpo[campo]) for campo in ("comprador", "email", "categoria", "quantidade", "preco_brl", "preco_usd", "canal", "idioma")}}
+    if erro := validar_pedido(pedido): raise ErroHTTP(400, erro)
+    return pedido
+
+def _ids(corpo):
+    ids = corpo.get("ids") if isinstance(corpo, dict) else None
+    if not ids or not isinstance(ids, list) or not all(isinstance(i, int) for i in ids): raise ErroHTTP(400, "Informe 'ids': lista de ids de chaves.")
+    return ids
+
+def _corpo_booleano(corpo, campo, padrao):
+    """Campo opcional que precisa ser booleano JSON: o texto "false" (ou 0) não pode valer como verdadeiro."""
+    if (valor := corpo.get(campo, padrao)) is None: return padrao
+    if not isinstance(valor, bool): raise ErroHTTP(400, f"'{campo}' deve ser true ou false.")
+    return valor
+
+def _corpo_idioma(corpo):
+    idioma = str(corpo.get("idioma") or "").lower().replace("-", "_")
+    return "en_us" if idioma.startswith("en") else "es_es" if idioma.startswith("es") else "pt_br"
+
+def _ler_arquivo(caminho):
+    with open(caminho, "rb") as f: return f.read()
+
+def _ler_cabecalho(bruto):
+    """(método, alvo, cabeçalhos em minúsculas, manter a conexão aberta)."""
+    linhas = bruto.decode("latin-1").split("\r\n"); metodo, alvo, versao = (linhas[0].split(" ") + ["", "", ""])[:3]
+    cabecalhos = {k.strip().lower(): v.strip() for k, _, v in (linha.partition(":") for linha in linhas[1:] if linha)}
+    conexao = cabecalhos.get("connection", "").lower()
+    return metodo.upper(), alvo, cabecalhos, conexao != "close" if versao == "HTTP/1.1" else conexao == "keep-alive"
+
+def _categorias():
+    return {row["nome"]: dict(row) for row in db.consultar("SELECT * FROM categorias")}
+
+def _chaves_por_ids(ids):
+    linhas = {r["id"]: dict(r) for r in db.consultar("SELECT * FROM chaves WHERE id IN (SELECT value FROM json_each(?))", (json.dumps(ids),))}
+    if faltando := [i for i in ids if i not in linhas]: raise ErroHTTP(404, f"Chaves não encontradas: {faltando}.")
+    return [linhas[i] for i in ids]
+
+def _reservar(pedido, parcial):
+    return reservar_chaves(pedido["categoria"], pedido["quantidade"], pedido["comprador"], pedido["preco_brl"], pedido["preco_usd"], pedido["canal"], parcial=parcial)
+
+class ServidorAPI:
+    """Servidor HTTP/1.1 (keep-alive) em asyncio. O loop só faz E/S: leituras do banco rodam num pool limitado de
+    threads, escritas numa thread única (as vendas se enfileiram nela em vez de disputar o lock do SQLite com espera
+    ativa) e PDFs no ServicoPDF. Acima de 'fila_max' requisições em andamento responde 503 na hora, para a latência
+    não crescer sem limite sob carga."""
+    def __init__(self, host="127.0.0.1", porta=PORTA_PADRAO, trabalhadores=4, fila_max=256, servico_pdf=None, fila_email=None):
+        if not ipaddress.ip_address(host).is_loopback: raise ValueError(f"A API só pode escutar em endereços locais (127.0.0.1/::1), não em {host}.")
+        self.host, self.porta, self.trabalhadores, self.fila_max = host, porta, trabalhadores, fila_max
+        self._servico_pdf, self._fila_email = servico_pdf, fila_email
+        self._leitura = self._escrita = self._servidor = None; self._em_andamento = 0
+        self._rotas = [("GET", re.compile(r"/saude"), self._saude), ("GET", re.compile(r"/estoque"), self._estoque),
+                       ("GET", re.compile(r"/estoque/(?P<categoria>[^/]+)"), self._estoque_categoria), ("POST", re.compile(r"/reservas"), self._reservas),
+                       ("POST", re.compile(r"/entregas"), self._entregas), ("POST", re.compile(r"/mensagem"), self._mensagem), ("POST", re.compile(r"/pdf"), self._pdf)]
+
+    # --- Ciclo de vida ---
+    async def iniciar(self):
+        self._leitura = ThreadPoolExecutor(self.trabalhadores, thread_name_prefix="api-leitura")
+        self._escrita = ThreadPoolExecutor(1, thread_name_prefix="api-escrita")
+        self._servico_pdf_proprio = self._servico_pdf is None
+        if self._servico_pdf_proprio: self._servico_pdf = ServicoPDF()  # O pool de processos só sobe no primeiro PDF.
+        self._fila_email_propria = self._fila_email is None
+        if self._fila_email_propria: self._fila_email = FilaEmail(); self._fila_email.iniciar()
+        self._servidor = await asyncio.start_server(self._conexao, self.host, self.porta, limit=64 * 1024, backlog=512)
+        self.porta = self._servidor.sockets[0].getsockname()[1]  # porta=0 escolhe uma livre (testes).
+        return self
+
+    async def parar(self):
+        if self._servidor: self._servidor.close(); await self._servidor.wait_closed()
+        for executor in (self._leitura, self._escrita):
+            if executor: executor.shutdown(wait=True)
+        if self._fila_email_propria and self._fila_email: self._fila_email.parar()
+        if self._servico_pdf_proprio and self._servico_pdf: self._servico_pdf.encerrar()
+
+    async def servir_para_sempre(self):
+        await self.iniciar()
+        try: await self._servidor.serve_forever()
+        finally: await self.parar()
+
+    def servir(self):
+        """Bloqueia até Ctrl+C."""
+        try: asyncio.run(self.servir_para_sempre())
+        except KeyboardInterrupt: pass
+
+    # --- Protocolo ---
+    async def _conexao(self, reader, writer):
+        peer = writer.get_extra_info("peername")
+        if not peer or not ipaddress.ip_address(peer[0]).is_loopback: writer.close(); return
+        try:
+            while True:
+                try: cabecalho = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), OCIOSO_MAX)
+                except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError): break
+                except asyncio.LimitOverrunError: await self._responder(writer, 413, {"erro": "Cabeçalho grande demais."}, False); break
+                metodo, alvo, cabecalhos, manter = _ler_cabecalho(cabecalho)
+                try: tamanho = int(cabecalhos.get("content-length") or 0)
+                except ValueError: await self._responder(writer, 400, {"erro": "Content-Length inválido."}, False); break
+                if tamanho > CORPO_MAX: await self._responder(writer, 413, {"erro": "Corpo grande demais."}, False); break
+                corpo = await reader.readexactly(tamanho) if tamanho else b""
+                status, resposta = await self._despachar(metodo, alvo, corpo)
+                await self._responder(writer, status, resposta, manter)
+                if not manter: break
+        except (ConnectionError, asyncio.IncompleteReadError): pass
+        finally:
+            writer.close()
+            try: await writer.wait_closed()
+            except ConnectionError: pass
+
+    async def _responder(self, writer, status, resposta, manter):
+        if isinstance(resposta, bytes): tipo, dados = "application/pdf", resposta
+        else: tipo, dados = "application/json; charset=utf-8", json.dumps(resposta, ensure_ascii=False).encode("utf-8")
+        extra = "Retry-After: 1\r\n" if status == 503 else ""
+        writer.write(f"HTTP/1.1 {status} {MOTIVOS.get(status, '')}\r\nContent-Type: {tipo}\r\nContent-Length: {len(dados)}\r\n{extra}"
+                     f"Connection: {'keep-alive' if manter else 'close'}\r\n\r\n".encode("latin-1") + dados)
+        await writer.drain()
+
+    async def _despachar(self, metodo, alvo, corpo):
+        caminho = urlsplit(alvo).path.rstrip("/") or "/"; permitidos = []
+        for metodo_rota, padrao, tratador in self._rotas:
+            if not (m := padrao.fullmatch(caminho)): continue
+            if metodo_rota != metodo: permitidos.append(metodo_rota); continue
+            if self._em_andamento >= self.fila_max: return 503, {"erro": "Servidor ocupado, tente novamente."}
+            self._em_andamento += 1
+            try:
+                dados = json.loads(corpo) if corpo else {}
+                return await tratador(dados, **{k: unquote(v) for k, v in m.groupdict().items()})
+            except json.JSONDecodeError: return 400, {"erro": "JSON inválido."}
+            except ErroHTTP as e: return e.status, {"erro": str(e)}
+            except Exception as e:
+                logar_acao(f"API: erro em {metodo} {caminho}: {e!r}", "erro"); return 500, {"erro": str(e)}
+            finally: self._em_andamento -= 1
+        return (405, {"erro": f"Use {', '.join(permitidos)}."}) if permitidos else (404, {"erro": "Rota inexistente."})
+
+    def _ler(self, funcao, *args): return asyncio.get_running_loop().run_in_executor(self._leitura, funcao, *args)
+    def _escrever(self, funcao, *args): return asyncio.get_running_loop().run_in_executor(self._escrita, funcao, *args)
+
+    # --- Rotas ---
+    async def _saude(self, corpo): return 200, {"status": "ok", "versao": APP_VERSION}
+
+    async def _estoque(self, corpo):
+        return 200, {"categorias": [{"categoria": c, "disponiveis": d, "vendidas": v} for c, d, v in await self._ler(estoque_por_categoria)]}
+
+    async def _estoque_categoria(self, corpo, categoria):
+        # Duas contagens por faixa do índice (categoria, vendida, ...) em vez de somar sobre todas as linhas da categoria.
+        linha = await self._ler(db.consultar_um, "SELECT (SELECT COUNT(*) FROM chaves WHERE categoria = ?1 AND vendida = 0), (SELECT COUNT(*) FROM chaves WHERE categoria = ?1 AND vendida = 1), EXISTS (SELECT 1 FROM categorias WHERE nome = ?1)", (categoria,))
+        if not linha[2] and not (linha[0] or linha[1]): raise ErroHTTP(404, f"Categoria '{categoria}' não existe.")
+        return 200, {"categoria": categoria, "disponiveis": linha[0], "vendidas": linha[1]}
+
+    async def _reservas(self, corpo):
+        pedido = _corpo_pedido(corpo); vendidas, faltando = await self._escrever(_reservar, pedido, _corpo_booleano(corpo, "parcial", False))
+        if not vendidas: raise ErroHTTP(409, f"Sem estoque: {pedido['quantidade'] - faltando} disponível(is) de {pedido['quantidade']}.")
+        return 201, {"chaves": [{"id": c["id"], "chave": c["chave"], "categoria": c["categoria"]} for c in vendidas], "faltando": faltando}
+
+    async def _entregas(self, corpo):
+        pedido = _corpo_pedido(corpo); pdf, anexar_pdf = _corpo_booleano(corpo, "pdf", True), _corpo_booleano(corpo, "anexar_pdf", True)
+        vendidas, faltando = await self._escrever(_reservar, pedido, False)
+        if not vendidas: raise ErroHTTP(409, f"Sem estoque: {pedido['quantidade'] - faltando} disponível(is) de {pedido['quantidade']}.")
+        categorias = await self._ler(_categorias); mensagem = construir_mensagem_entrega(vendidas, categorias, pedido["idioma"])
+        caminho, erro_pdf, email_id = None, None, None
+        if pdf and PDF_DISPONIVEL:
+            trabalho = trabalho_pdf_entrega(caminho_pdf_entrega(pedido["comprador"], f"_api{vendidas[0]['id']}"), vendidas, categorias, pedido["idioma"], pedido["comprador"], pedido["email"])
+            caminho, erro_pdf = await self._renderizar(trabalho)
+        if pedido["email"]:
+            email_id = await self._escrever(self._fila_email.enfileirar, pedido["email"], ASSUNTOS_EMAIL[pedido["idioma"]], mensagem, caminho if anexar_pdf else None)
+        return 201, {"chaves": [{"id": c["id"], "chave": c["chave"], "categoria": c["categoria"]} for c in vendidas], "mensagem": mensagem, "pdf": caminho, "email_id": email_id, "erro_pdf": erro_pdf}
+
+    async def _mensagem(self, corpo):
+        ids = _ids(corpo); chaves, categorias = await self._ler(lambda: (_chaves_por_ids(ids), _categorias()))
+        return 200, {"mensagem": construir_mensagem_entrega(chaves, categorias, _corpo_idioma(corpo))}
+
+    async def _pdf(self, corpo):
+        if not PDF_DISPONIVEL: raise ErroHTTP(503, "Geração de PDF indisponível: instale o reportlab.")
+        ids = _ids(corpo); chaves, categorias = await self._ler(lambda: (_chaves_por_ids(ids), _categorias()))
+        comprador = corpo.get("comprador") or chaves[0]["comprador"] or "Cliente"
+        caminho, erro = await self._renderizar(trabalho_pdf_entrega(caminho_pdf_entrega(comprador, f"_api{ids[0]}"), chaves, categorias, _corpo_idioma(corpo), comprador, corpo.get("email") or ""))
+        if erro: raise ErroHTTP(500, f"Falha no PDF: {erro}")
+        return 200, await self._ler(_ler_arquivo, caminho)
+
+    async def _renderizar(self, trabalho):
+        try: return await asyncio.wrap_future(self._servico_pdf.submeter(trabalho))
+        except Exception as e: return None, str(e)
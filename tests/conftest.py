@@ -0,0 +1,16 @@
+# coding: utf-8
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import nucleo
+
+@pytest.fixture
+def banco(tmp_path, monkeypatch):
+    """Banco novo num diretório temporário (nucleo.DB_NAME e a auditoria usam caminhos relativos)."""
+    monkeypatch.chdir(tmp_path); monkeypatch.setattr(nucleo.auditoria, "origem", "app")
+    nucleo.preparar_banco()
+    yield nucleo.db
+    nucleo.auditoria.encerrar(); nucleo.auditoria.indice.fechar(); nucleo.db.fechar()
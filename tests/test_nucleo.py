@@ -0,0 +1,88 @@
+# coding: utf-8
+"""Journal de desfazer, reserva atômica e ordem manual do nucleo, contra um banco temporário."""
+import pytest
+
+import nucleo
+
+def _chaves(db):
+    return {r["chave"]: dict(r) for r in db.consultar("SELECT * FROM chaves")}
+
+def _ordem(db):
+    return [r[0] for r in db.consultar("SELECT chave FROM chaves ORDER BY ordem_manual, id")]
+
+# --- Desfazer/Refazer ---
+def test_desfazer_e_refazer_ingestao(banco):
+    nucleo.ingerir_chaves(["K1", "K2"], "A")
+    ids, adicionadas, duplicadas, _ = nucleo.ingerir_chaves(["K3", "K4", "K3", "K1", "K5"], "A", tamanho_lote=2, desfazer=True)
+    assert (adicionadas, duplicadas) == (3, 2) and nucleo.contar_passos_undo() == (1, 0)
+    mud = nucleo.desfazer_passo()
+    assert mud.removidos == set(ids) and set(_chaves(banco)) == {"K1", "K2"} and nucleo.contar_passos_undo() == (0, 1)
+    mud = nucleo.refazer_passo()
+    assert mud.inseridos == set(ids) and nucleo.contar_passos_undo() == (1, 0)
+    assert {c["id"] for nome, c in _chaves(banco).items() if nome in ("K3", "K4", "K5")} == set(ids)
+    assert _ordem(banco) == ["K1", "K2", "K3", "K4", "K5"]
+
+def test_passos_de_outra_origem_nao_sao_desfeitos(banco, monkeypatch):
+    monkeypatch.setattr(nucleo.auditoria, "origem", "cli")
+    nucleo.ingerir_chaves(["K1"], "A", desfazer=True)
+    monkeypatch.setattr(nucleo.auditoria, "origem", "app")
+    assert nucleo.contar_passos_undo() == (0, 0) and nucleo.desfazer_passo() is None and "K1" in _chaves(banco)
+
+def test_desfazer_recusado_se_outra_origem_mudou_a_linha(banco, monkeypatch):
+    ids, *_ = nucleo.ingerir_chaves(["K1", "K2", "K3"], "A")
+    with nucleo.passo_undo(): banco.executar("UPDATE chaves SET ordem_manual = -1 WHERE id = ?", (ids[2],))
+    monkeypatch.setattr(nucleo.auditoria, "origem", "cli")
+    with nucleo.passo_undo(): vendidas, faltando = nucleo.reservar_chaves("A", 1, "Bob")
+    assert [c["chave"] for c in vendidas] == ["K3"] and faltando == 0
+    monkeypatch.setattr(nucleo.auditoria, "origem", "app")
+    with pytest.raises(ValueError, match="K3"): nucleo.desfazer_passo()
+    k3 = _chaves(banco)["K3"]
+    assert (k3["vendida"], k3["comprador"], k3["ordem_manual"]) == (1, "Bob", -1)
+    assert nucleo.contar_passos_undo() == (0, 0)  # O passo recusado sai do histórico.
+
+# --- Reserva ---
+def test_reserva_sem_estoque_suficiente_nao_vende_nada(banco):
+    nucleo.ingerir_chaves(["K1", "K2", "K3"], "A"); nucleo.ingerir_chaves(["L1"], "B")
+    assert nucleo.reservar_chaves("A", 5, "Ana") == ([], 2)
+    assert not any(c["vendida"] for c in _chaves(banco).values())
+    vendidas, faltando = nucleo.reservar_chaves("A", 5, "Ana", parcial=True)
+    assert [c["chave"] for c in vendidas] == ["K1", "K2", "K3"] and faltando == 2
+    assert _chaves(banco)["L1"]["vendida"] == 0
+
+def test_vender_chaves_com_conflito_cancela_a_venda(banco):
+    ids, *_ = nucleo.ingerir_chaves(["K1", "K2"], "A")
+    nucleo.vender_chaves([ids[1]], "Ana")
+    assert nucleo.vender_chaves(ids, "Bob") == ([], [ids[1]])
+    chaves = _chaves(banco)
+    assert (chaves["K1"]["vendida"], chaves["K2"]["comprador"]) == (0, "Ana")
+
+# --- Ordem manual ---
+def test_mover_chaves_usa_a_folga(banco):
+    ids, *_ = nucleo.ingerir_chaves([f"K{i}" for i in range(10)], "A")
+    novas = nucleo.mover_chaves([ids[9]], depois_de=ids[0])
+    assert list(novas) == [ids[9]] and _ordem(banco) == ["K0", "K9"] + [f"K{i}" for i in range(1, 9)]
+
+def test_mover_chaves_reespaca_quando_a_folga_acaba(banco):
+    ids, *_ = nucleo.ingerir_chaves([f"K{i}" for i in range(200)], "A")
+    banco.executar("UPDATE chaves SET ordem_manual = id")  # Vizinhas consecutivas: nenhuma folga.
+    novas = nucleo.mover_chaves([ids[199], ids[198]], depois_de=ids[0])
+    assert _ordem(banco) == ["K0", "K199", "K198"] + [f"K{i}" for i in range(1, 198)]
+    assert ids[199] in novas and ids[1] in novas and len(novas) < len(ids)  # Só uma janela em volta do ponto é reespaçada.
+    ordens = [r[0] for r in banco.consultar("SELECT ordem_manual FROM chaves ORDER BY ordem_manual, id")]
+    assert len(set(ordens)) == len(ordens)
+    assert {i: banco.consultar_valor("SELECT ordem_manual FROM chaves WHERE id = ?", (i,)) for i in novas} == novas
+    assert list(nucleo.mover_chaves([ids[5]], depois_de=ids[199])) == [ids[5]]  # A janela reespaçada voltou a ter folga.
+
+# --- Estoque em memória ---
+def test_estoque_compacto_filtra_como_filtro_chaves(banco):
+    ids, *_ = nucleo.ingerir_chaves([f"A{i}" for i in range(20)], "A"); nucleo.ingerir_chaves([f"B{i}" for i in range(10)], "B", "Loja")
+    nucleo.vender_chaves(ids[::3], "Ana", canal="Loja")
+    estoque = nucleo.EstoqueCompacto(); estoque.carregar(banco.conexao().execute(f"SELECT {', '.join(nucleo.COLUNAS_ESTOQUE)} FROM chaves"))
+    linhas = [dict(r) for r in banco.consultar("SELECT * FROM chaves")]
+    for filtros in ({}, {"categoria": "A"}, {"canal": "Loja"}, {"canal": "Nenhum"}, {"status": "Vendida"}, {"categoria": "A", "status": "Disponível"}):
+        teste = nucleo.filtro_chaves(**filtros)
+        assert estoque.filtrar(**filtros) == sorted(nucleo.chave_ordem(r) for r in linhas if teste(r)), filtros
+    item = estoque[ids[1]]; estoque.gravar({**dict(item), "vendida": 1, "comprador": "Bob"})
+    assert item["comprador"] == "Bob" and ids[1] in [i for _, i in estoque.filtrar(status="Vendida")]
+    estoque.remover(ids[2])
+    assert ids[2] not in estoque and len(estoque) == 29 and ids[2] not in [i for _, i in estoque.filtrar()]